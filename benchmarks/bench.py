@@ -0,0 +1,870 @@
+#!/usr/bin/env python3
+"""pfim benchmark suite.
+
+Builds a synthetic ledger (see ledger.py) in a scratch directory and times
+every command path through PfimCore and PfimData: record, bulk insert,
+import, every report filter/kind/sort combination, summaries, the report
+renderer, update and delete, balance lookups and running balances,
+report --search with and without the full-text index, reports on yearly
+partitions (migration and archiving included), summaries on several
+processes (--jobs), report --analytics when NumPy is installed, startup,
+the asyncio facade, processes recording at once with and without
+`pfim serve`, backups, snapshots and compaction, and the memory a whole
+report holds. Besides timings it runs checks: every filtered report must
+plan as an index search, importing pfim.__main__ must stay within a budget
+and must not import the database layer, a writer must keep up with
+concurrent async readers, no entry recorded by concurrent processes may be
+lost, and a backup must hold the ledger and only write what changed.
+
+    python benchmarks/bench.py --size 10k --output base.json
+    python benchmarks/bench.py --size 10k --baseline base.json
+
+Results are written as JSON. With --baseline, a case slower than the
+baseline by more than --threshold is a regression. The exit status is 1
+when there is a regression or a failed check.
+"""
+
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+import ledger  # noqa: E402
+from pfim.pfim import (_INSERT_SQL, _REPORT_COLUMNS,  # noqa: E402
+    PfimCore, PfimData, PfimEntryBatch, Report, ReportSummary, TagTable,
+    _encode_cursor, _row_chunks)
+
+_IMPORT_SIZE = 100_000
+_RENDER_SIZE = 200_000
+_STATS_SIZE = 1_000_000
+_RECORDS = 1000
+_BENCH_TAG = "bench"
+
+# report filters, with the fraction of the ledger span they cover
+_FILTERS = {
+    "all": {},
+    "tag": {"tagQuery": "groceries"},
+    "on": {"onQuery": 0.5},
+    "after": {"afterQuery": 0.75},
+    "before": {"beforeQuery": 0.25},
+    "range": {"afterQuery": 0.4, "beforeQuery": 0.6},
+    "tag-range": {"tagQuery": "groceries", "afterQuery": 0.4,
+        "beforeQuery": 0.6},
+}
+_KINDS = {"any": {}, "exp": {"expQuery": True}, "inc": {"incQuery": True}}
+_SORTS = {"none": {}, "date": {"sortDate": True}, "tag": {"sortTag": True},
+    "amount": {"sortAmount": True}}
+_GROUPS = (None, "tag", "month", "year")
+# reports timed on the single file and on yearly partitions; "year" is
+# replaced by the bounds of the year in the middle of the ledger
+_PARTITION_REPORTS = {
+    "on": {"onQuery": 0.5},
+    "year": {"year": True},
+    "year-summary": {"year": True, "summaryOnly": True},
+    "days-summary": dict(_FILTERS["range"], summaryOnly=True),
+    "all-by-year": {"groupBy": "year"},
+    "range-top": dict(_FILTERS["range"], sortAmount=True, limitQuery=100),
+}
+# --jobs values of the parallel summaries, capped to the CPUs
+_JOBS = (1, 2, 4, 8)
+# report --limit pages, starting at these fractions of the ledger span
+_PAGE_SIZE = 100
+_PAGE_DEPTHS = (0.0, 0.5, 0.95)
+# balance lookups at these fractions of the ledger span, and the entries
+# recorded near its start to time back-dated writes
+_BALANCE_DEPTHS = (0.05, 0.5, 0.95)
+_BACKDATED = 100
+# processes recording at once, and the entries each of them records
+_WRITERS = (1, 2, 4, 8)
+_WRITER_RECORDS = 200
+# entries recorded between two incremental backups
+_BACKUP_RECORDS = 100
+# report --search texts: a frequent word, two words, a prefix, no match
+_SEARCHES = {"word": "Hotel", "words": "Hotel 42", "prefix": "Hot*",
+    "none": "Nothing"}
+
+
+class Suite:
+    """Run benchmark cases and checks, collecting their results."""
+
+    def __init__(self, size: int, workdir: str, seed: int = ledger.SEED,
+        repeat: int = 3, pattern: Optional[str] = None,
+        import_budget_ms: float = 25.0, write_budget_ms: float = 50.0):
+        self.size = size
+        self.seed = seed
+        self.import_budget_ms = import_budget_ms
+        self.write_budget_ms = write_budget_ms
+        self.workdir = workdir
+        self.repeat = repeat
+        self.pattern = re.compile(pattern) if pattern else None
+        self.dbname = os.path.join(workdir, "ledger.db")
+        self.results = {}
+        self.checks = {}
+
+    def selected(self, name: str) -> bool:
+        return self.pattern is None or bool(self.pattern.search(name))
+
+    def time(self, name: str, func: Callable, setup: Callable = None,
+        repeat: int = None) -> None:
+        """Time func, which returns the number of rows it processed."""
+        if not self.selected(name):
+            return
+        runs, rows = [], 0
+        for _ in range(repeat or self.repeat):
+            arg = setup() if setup is not None else None
+            start = time.perf_counter()
+            rows = func(arg) if setup is not None else func()
+            runs.append(time.perf_counter() - start)
+        seconds = statistics.median(runs)
+        self.results[name] = {"seconds": seconds, "runs": runs, "rows": rows,
+            "rate": rows / seconds if rows and seconds else None}
+        rate = f"{rows / seconds:12.0f} rows/s" if rows and seconds else ""
+        print(f"{name:40s} {seconds * 1e3:10.2f} ms {rate}", file=sys.stderr)
+
+    def check(self, name: str, ok: bool, detail) -> None:
+        if not self.selected(name):
+            return
+        self.checks[name] = {"ok": bool(ok), "detail": detail}
+        if not ok:
+            print(f"{name:40s} FAILED: {detail}", file=sys.stderr)
+
+    def day(self, fraction: float) -> str:
+        span = ledger.span_days(self.size)
+        return (ledger.START + timedelta(int(span * fraction))).isoformat()
+
+    def options(self, *parts: Dict) -> Dict:
+        kw = {}
+        for part in parts:
+            for opt, value in part.items():
+                # dates are given as a fraction of the ledger span
+                kw[opt] = self.day(value) if isinstance(value, float) else value
+        return kw
+
+    def run(self) -> None:
+        self.bench_bulk_insert()
+        self.bench_import()
+        # repeats must hit the database, not the result cache
+        core = PfimCore(self.dbname, cache_size=0)
+        self.bench_record(core)
+        self.bench_update_delete(core)
+        self.bench_reports(core)
+        self.bench_summaries(core)
+        self.bench_pages(core)
+        self.bench_balances(core)
+        self.bench_parallel(core)
+        self.bench_search(core)
+        self.bench_analytics(core)
+        self.bench_partitions(core)
+        self.bench_report_summary(core._db)
+        self.bench_render(core._db)
+        self.bench_memory(core)
+        self.bench_backup(core)
+        core._db.close()
+        self.bench_startup()
+        self.bench_async()
+        self.bench_writers()
+
+    def bench_bulk_insert(self) -> None:
+        # the ledger every other case reads is built here, so this one runs
+        # whatever the pattern; the timing includes generating the ledger
+        data = PfimData(self.dbname)
+        start = time.perf_counter()
+        count = data.add_entries(_INSERT_SQL,
+            ledger.generate(self.size, self.seed))
+        seconds = time.perf_counter() - start
+        data.close()
+        self.record("bulk_insert", seconds, count)
+
+    def bench_import(self) -> None:
+        size = min(self.size, _IMPORT_SIZE)
+        statement = os.path.join(self.workdir, "statement.csv")
+        ledger.write_csv(statement, size, self.seed)
+        dbname = os.path.join(self.workdir, "import.db")
+
+        def setup():
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(dbname + suffix):
+                    os.remove(dbname + suffix)
+            return PfimCore(dbname)
+
+        def run(core):
+            count, _ = core.import_entries(
+                {"impFile": statement, "impFormat": "csv"})
+            core._db.close()
+            return count
+        self.time("import_csv", run, setup)
+
+    def bench_record(self, core: PfimCore) -> None:
+        day = self.day(0.5)
+
+        def run():
+            for i in range(_RECORDS):
+                core.record({"expense": 12.5, "recdate": day,
+                    "rectag": _BENCH_TAG, "descr": f"Record {i}"})
+            return _RECORDS
+        self.time("record", run, repeat=1)
+
+    def bench_update_delete(self, core: PfimCore) -> None:
+        # the entries added by bench_record
+        day = self.day(0.5)
+        self.time("update", lambda: core.update(
+            {"upExpense": [day, "12.5", "25"]}), repeat=1)
+        self.time("delete", lambda: core.delete(
+            {"rmDate": day, "rmTag": _BENCH_TAG}), repeat=1)
+        # a rename touches the tag dictionary only, however many entries
+        # the tag has
+        moves = (["groceries", "home/groceries"],
+            ["home/groceries", "groceries"])
+        self.time("rename_tag", lambda: sum(core.rename_tag(
+            {"upRename": move}) for move in moves), repeat=1)
+
+    def bench_reports(self, core: PfimCore) -> None:
+        for (fname, filt), (kname, kind), (sname, sort) in itertools.product(
+            _FILTERS.items(), _KINDS.items(), _SORTS.items()):
+            kw = self.options(filt, kind, sort)
+            name = f"report/{fname}/{kname}/{sname}"
+
+            def run(kw=kw):
+                core.report(kw)
+                return sum(map(len, core.make_output().report))
+            self.time(name, run)
+            # with a sort the planner may prefer walking an index in order
+            if (filt or kind) and not sort:
+                query = core.report(kw)
+                plan = core._db.query_plan(query.query, *query.args)
+                self.check(f"plan/{fname}/{kname}", _uses_index(plan), plan)
+
+    def bench_summaries(self, core: PfimCore) -> None:
+        # "range" is month aligned and answered by the rollup, "days" is not
+        filters = {"all": {}, "tag": _FILTERS["tag"],
+            "range": {"afterQuery": self.month_end(0.4),
+                "beforeQuery": self.month_start(0.6)},
+            "days": _FILTERS["range"]}
+        for (fname, filt), (kname, kind), group in itertools.product(
+            filters.items(), _KINDS.items(), _GROUPS):
+            kw = self.options(filt, kind,
+                {"summaryOnly": True, "groupBy": group})
+
+            def run(kw=kw):
+                core.report(kw)
+                summary = core.make_output().summary
+                return (sum(s.count for s in summary.values())
+                    if group else summary.count)
+            self.time(f"summary/{fname}/{kname}/{group or 'none'}", run)
+
+    def bench_pages(self, core: PfimCore) -> None:
+        # a page starts after the key of the previous one, in date order
+        # or in the order of a sort option; the cursors are made up
+        sorts = {"date": (), "amount": ("sortAmount",)}
+        for (sname, sort), depth in itertools.product(sorts.items(),
+            _PAGE_DEPTHS):
+            day = date.fromisoformat(self.day(depth)).toordinal()
+            kw = dict(dict.fromkeys(sort, True), allQuery=True,
+                limitQuery=_PAGE_SIZE,
+                cursorQuery=_encode_cursor(sort, (day, "", "", -10.0, 0)))
+
+            def run(kw=kw):
+                core.report(kw)
+                return sum(map(len, core.make_output().report))
+            self.time(f"page/{sname}/{depth:g}", run)
+        # the last page in date order costs about what the first does
+        first, last = (self.results.get(f"page/date/{depth:g}")
+            for depth in (_PAGE_DEPTHS[0], _PAGE_DEPTHS[-1]))
+        if first and last:
+            self.check("page/constant",
+                last["seconds"] <= 3 * first["seconds"] + 1e-3,
+                f"{last['seconds'] * 1e3:.2f} ms deep, "
+                f"{first['seconds'] * 1e3:.2f} ms first")
+
+    def bench_balances(self, core: PfimCore) -> None:
+        # report --balance-as-of is an index lookup wherever the date
+        # falls, and a back-dated record updates as few nodes as a new one
+        data = core._db
+        for depth in _BALANCE_DEPTHS:
+
+            def lookup(day=self.day(depth)):
+                data.balance(day)
+                return 1
+            self.time(f"balance/as-of/{depth:g}", lookup)
+        first, last = (self.results.get(f"balance/as-of/{depth:g}")
+            for depth in (_BALANCE_DEPTHS[0], _BALANCE_DEPTHS[-1]))
+        if first and last:
+            self.check("balance/logarithmic",
+                last["seconds"] <= 3 * first["seconds"] + 1e-3,
+                f"{last['seconds'] * 1e3:.2f} ms late, "
+                f"{first['seconds'] * 1e3:.2f} ms early")
+        for fname in ("range", "after"):
+            kw = self.options(_FILTERS[fname], {"runningBalance": True})
+
+            def run(kw=kw):
+                core.report(kw)
+                return sum(map(len, core.make_output().report))
+            self.time(f"balance/running/{fname}", run)
+        day = self.day(_BALANCE_DEPTHS[0])
+
+        def record():
+            for i in range(_BACKDATED):
+                core.record({"expense": 7.5, "recdate": day,
+                    "rectag": _BENCH_TAG, "descr": f"Back-dated {i}"})
+            return _BACKDATED
+        self.time("balance/backdated", record, repeat=1)
+        if self.selected("balance/consistent"):
+            middle = self.day(0.5)
+            expected = next(data.fetch("SELECT total(amount) FROM pfim "
+                "WHERE opdate <= ?", middle))[0]
+            stale = data.check_balances()
+            self.check("balance/consistent", not stale and abs(
+                data.balance(middle) - expected) <= 1e-6 * max(1.0,
+                abs(expected)), f"{len(stale)} days with a stale balance")
+        core.delete({"rmDate": day, "rmTag": _BENCH_TAG})
+
+    def bench_parallel(self, core: PfimCore) -> None:
+        # a summary over the whole span that the rollup can not answer, by
+        # 1 to 8 processes; the results must be those of the serial path
+        kw = {"afterQuery": self.day(0.0), "beforeQuery": self.day(1.0),
+            "summaryOnly": True}
+        cpus = os.cpu_count() or 1
+        for group in (None, "tag"):
+            expected = None
+            for jobs in _JOBS:
+                if jobs > max(cpus, 2):
+                    break
+                jobkw = dict(kw, groupBy=group, jobs=jobs)
+
+                def run(kw=jobkw):
+                    core.report(kw)
+                    summary = core.make_output().summary
+                    return (sum(s.count for s in summary.values())
+                        if group else summary.count)
+                name = f"parallel/{group or 'none'}/{jobs}"
+                self.time(name, run)
+                if not self.selected(name):
+                    continue
+                core.report(jobkw)
+                summary = core.make_output().summary
+                result = summary if group else {None: summary}
+                if expected is None:
+                    expected = result
+                    continue
+                self.check(f"parallel/{group or 'none'}/{jobs}/same",
+                    _same_summaries(expected, result),
+                    f"{jobs} jobs differ from the serial summary")
+
+    def bench_search(self, core: PfimCore) -> None:
+        # the full-text index against the LIKE scan used without FTS5
+        search = core._db.has_search()
+        for (sname, text), mode in itertools.product(
+            _SEARCHES.items(), ("fts", "like")):
+            if mode == "fts" and not search:
+                continue
+            for summary in (False, True):
+                kw = {"searchQuery": text, "summaryOnly": summary}
+
+                def run(kw=kw, mode=mode):
+                    core._db._search = mode == "fts"
+                    core.report(kw)
+                    output = core.make_output()
+                    if kw["summaryOnly"]:
+                        return output.summary.count
+                    return sum(map(len, output.report))
+                kind = "summary" if summary else "report"
+                self.time(f"search/{mode}/{kind}/{sname}", run)
+        core._db._search = search
+
+    def bench_analytics(self, core: PfimCore) -> None:
+        # loading the columns, then each analysis on the loaded columns
+        from pfim import _analytics
+        if not _analytics.available():
+            return
+        core.report({"analytics": ["months"]})
+        columns = None
+
+        def load():
+            nonlocal columns
+            columns = _analytics.LedgerColumns.load(core._db, core._parts)
+            return len(columns)
+        self.time("analytics/load", load)
+        if columns is None:
+            return
+        for name in ("percentiles", "rolling", "tags", "months"):
+            self.time(f"analytics/{name}",
+                lambda name=name: (columns.run([name]), len(columns))[1])
+
+    def bench_partitions(self, core: PfimCore) -> None:
+        # the same reports on the single file, on yearly partitions and
+        # once the first half of the years is archived
+        from pfim._partition import partition_ledger
+        if not any(self.selected(f"partition/{name}") for name in (
+            "migrate", "archive", "file", "years", "archived")):
+            return
+        root = os.path.join(self.workdir, "ledger.d")
+        start = time.perf_counter()
+        counts = partition_ledger(core._db, root)
+        seconds = time.perf_counter() - start
+        self.record("partition/migrate", seconds, sum(counts.values()))
+        partitioned = PfimCore(root, cache_size=0)
+        year = int(self.day(0.5)[:4])
+        reports = {name: self.options({opt: value
+            for opt, value in opts.items() if opt != "year"},
+            {"afterQuery": f"{year - 1}-12-31",
+                "beforeQuery": f"{year + 1}-01-01"} if "year" in opts else {})
+            for name, opts in _PARTITION_REPORTS.items()}
+
+        def time_reports(layout, target):
+            for name, kw in reports.items():
+                def run(kw=kw):
+                    target.report(kw)
+                    output = target.make_output()
+                    if output.report is not None:
+                        return sum(map(len, output.report))
+                    summary = output.summary
+                    return (sum(s.count for s in summary.values())
+                        if isinstance(summary, dict) else summary.count)
+                self.time(f"partition/{layout}/{name}", run)
+        time_reports("file", core)
+        time_reports("years", partitioned)
+        start = time.perf_counter()
+        archived = sorted(counts)[:len(counts) // 2]
+        for year in archived:
+            partitioned._db.archive(year)
+        self.record("partition/archive", time.perf_counter() - start,
+            sum(counts[year] for year in archived))
+        time_reports("archived", partitioned)
+        partitioned._db.close()
+
+    def record(self, name: str, seconds: float, rows: int) -> None:
+        """Record a case timed once by its caller."""
+        if not self.selected(name):
+            return
+        self.results[name] = {"seconds": seconds, "runs": [seconds],
+            "rows": rows, "rate": rows / seconds if rows else None}
+        print(f"{name:40s} {seconds * 1e3:10.2f} ms "
+            f"{rows / seconds:12.0f} rows/s", file=sys.stderr)
+
+    def month_start(self, fraction: float) -> str:
+        return self.day(fraction)[:7] + "-01"
+
+    def month_end(self, fraction: float) -> str:
+        start = date.fromisoformat(self.month_start(fraction))
+        return (start - timedelta(1)).isoformat()
+
+    def bench_report_summary(self, data: PfimData) -> None:
+        amounts = [row[0] for row in data.fetch(
+            "SELECT amount FROM pfim LIMIT ?", _STATS_SIZE)]
+
+        def run():
+            summary = ReportSummary(amounts)
+            summary.median, summary.stdev
+            return summary.count
+        self.time("report_summary", run)
+
+    def bench_render(self, data: PfimData) -> None:
+        from pfim.pfim import PfimEntry
+        entries = [PfimEntry._make(row) for row in data.fetch(
+            "SELECT opdate, tag, description, amount FROM pfim"
+            " LEFT JOIN tags USING (tag_id) LIMIT ?", _RENDER_SIZE)]
+        for fmt in Report.FORMATS:
+            def run(fmt=fmt):
+                with open(os.devnull, "w") as fd:
+                    return Report(fmt).write(entries, fd)
+            self.time(f"render/{fmt}", run)
+        batches = list(_row_chunks(data.fetch(
+            "SELECT " + _REPORT_COLUMNS + " FROM pfim"
+            " LEFT JOIN tags USING (tag_id) LIMIT ?", _RENDER_SIZE)))
+        batches = [PfimEntryBatch.from_rows(rows, TagTable())
+            for rows in batches]
+        for fmt in Report.FORMATS:
+            def run(fmt=fmt):
+                with open(os.devnull, "w") as fd:
+                    return Report(fmt).write_batches(batches, fd)
+            self.time(f"render/batches/{fmt}", run)
+
+    def bench_memory(self, core: PfimCore) -> None:
+        # memory held by a whole report, as the per-row namedtuples reports
+        # used to be made of and as the batches they are made of now
+        name = "memory"
+        if not self.selected(name):
+            return
+        from pfim.pfim import PfimEntry
+        query = ("SELECT opdate, tag, description, amount FROM pfim"
+            " LEFT JOIN tags USING (tag_id)")
+        ways = {
+            "entries": lambda: [PfimEntry._make(row)
+                for row in core._db.fetch(query)],
+            "batches": lambda: (core.report({"allQuery": True}),
+                list(core.make_output().report))[1],
+        }
+        usage = {}
+        for way, build in ways.items():
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            report = build()
+            seconds = time.perf_counter() - start
+            usage[way] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            rows = sum(map(len, report)) if way == "batches" else len(report)
+            del report
+            self.results[f"{name}/{way}"] = {"seconds": seconds,
+                "runs": [seconds], "rows": rows, "rate": None,
+                "bytes": usage[way]}
+            print(f"{name + '/' + way:40s} {usage[way] / 2**20:10.1f} MB "
+                f"{usage[way] / max(rows, 1):12.1f} B/row", file=sys.stderr)
+        self.check("memory/batches", usage["batches"] < usage["entries"],
+            f"{usage['batches'] / max(usage['entries'], 1):.0%} of the "
+            "memory of per-row entries")
+
+    def bench_backup(self, core: PfimCore) -> None:
+        # pfim backup, full and incremental, snapshot and compact, rows
+        # being the entries copied; every copy must hold the ledger, and
+        # an incremental backup must write nothing when the ledger has not
+        # changed and only part of it after a few records
+        from pfim import _backup
+        data = core._db
+        entries = lambda: next(data.fetch("SELECT count(*) FROM pfim"))[0]
+        copies = {name: os.path.join(self.workdir, f"{name}.db")
+            for name in ("backup", "incremental", "snapshot")}
+        written = {"unchanged": [], "changed": []}
+
+        def full():
+            _backup.backup(data, copies["backup"])
+            return entries()
+        self.time("backup/full", full)
+
+        def incremental(case="unchanged"):
+            stats = _backup.backup(data, copies["incremental"],
+                incremental=True)
+            written.setdefault(case, []).append(stats.written / stats.size)
+            return entries()
+
+        def record():
+            day = self.day(0.99)
+            for i in range(_BACKUP_RECORDS):
+                core.record({"expense": 1.0, "recdate": day,
+                    "rectag": _BENCH_TAG, "descr": f"Backup {i}"})
+            return "changed"
+        incremental("first")
+        self.time("backup/incremental/unchanged", incremental)
+        self.time("backup/incremental/changed", incremental, record)
+        core.delete({"rmDate": self.day(0.99), "rmTag": _BENCH_TAG})
+        # back to the state of the ledger the other copies are compared to
+        incremental("deleted")
+
+        def snapshot(dest):
+            _backup.snapshot(data, dest)
+            return entries()
+        self.time("snapshot", snapshot,
+            lambda: _remove_db(copies["snapshot"]) or copies["snapshot"])
+        # a copy of the ledger whose older half has been deleted
+        thinned = os.path.join(self.workdir, "compact.db")
+
+        def thin():
+            _remove_db(thinned)
+            shutil.copyfile(copies["snapshot"], thinned)
+            copy = PfimData(thinned)
+            copy.delete("DELETE FROM pfim WHERE opdate < ?", self.day(0.5))
+            return copy
+
+        def compact(copy):
+            _backup.compact(copy)
+            copy.close()
+            return _count_entries(thinned)
+        self.time("compact", compact, thin)
+        if not self.selected("backup"):
+            return
+        expected = next(data.fetch(
+            "SELECT count(*), round(total(amount), 2) FROM pfim"))
+        differ = []
+        for name, path in copies.items():
+            conn = sqlite3.connect(path)
+            try:
+                if conn.execute("SELECT count(*), round(total(amount), 2) "
+                    "FROM pfim").fetchone() != tuple(expected):
+                    differ.append(name)
+            finally:
+                conn.close()
+        self.check("backup/consistent", not differ,
+            f"{', '.join(differ)} differ from the ledger" if differ else "ok")
+        unchanged = max(written["unchanged"], default=0)
+        changed = max(written["changed"], default=0)
+        self.check("backup/incremental", unchanged == 0 and changed < 0.5,
+            f"wrote {unchanged:.1%} of an unchanged ledger and {changed:.1%} "
+            f"after {_BACKUP_RECORDS} records")
+
+    def bench_startup(self) -> None:
+        env = dict(os.environ, PYTHONPATH=_ROOT, PFIM_NO_DAEMON="1")
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        cmd = [sys.executable, "-m", "pfim", "--version"]
+        subprocess.run(cmd, env=env, capture_output=True)
+        self.time("startup/version", lambda: subprocess.run(
+            cmd, env=env, capture_output=True) and 0, repeat=max(
+                5, self.repeat))
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import pfim.__main__"],
+            env=env, capture_output=True, text=True)
+        modules = {}
+        for line in proc.stderr.splitlines():
+            match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)",
+                line)
+            if match:
+                modules[match.group(4)] = int(match.group(2))
+        cumulative = modules.get("pfim.__main__", 0) + modules.get("pfim", 0)
+        self.check("startup/importtime",
+            cumulative <= self.import_budget_ms * 1000,
+            f"{cumulative / 1000:.1f} ms for a {self.import_budget_ms} ms "
+            "budget")
+        heavy = sorted(set(modules) & {"pfim.pfim", "sqlite3", "logging"})
+        self.check("startup/lazy-imports", not heavy,
+            f"imported {heavy}" if heavy else "ok")
+
+    def bench_async(self) -> None:
+        name = "async/writer"
+        if not self.selected(name):
+            return
+        for readers in (0, 4):
+            latencies = asyncio.run(_writer_latencies(self.dbname, readers))
+            p99 = latencies[int(len(latencies) * 0.99)]
+            self.results[f"{name}/{readers}"] = {"seconds": p99,
+                "runs": [p99], "rows": len(latencies), "rate": None}
+            print(f"{name + '/' + str(readers):40s} {p99 * 1e3:10.2f} ms p99",
+                file=sys.stderr)
+        p99 = self.results[f"{name}/4"]["seconds"]
+        self.check("async/starvation", p99 <= self.write_budget_ms / 1000,
+            f"write p99 {p99 * 1e3:.2f} ms with 4 readers for a "
+            f"{self.write_budget_ms} ms budget")
+
+    def bench_writers(self) -> None:
+        # 1 to 8 processes, like cron jobs, record into a ledger of their
+        # own at once, straight to the file or through a `pfim serve` that
+        # group-commits them; every entry must make it to the ledger
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        for mode in ("direct", "server"):
+            if not any(self.selected(f"writers/{mode}/{n}")
+                for n in _WRITERS):
+                continue
+            dbname = os.path.join(self.workdir, f"writers-{mode}.db")
+            sock = os.path.join(self.workdir, "pfim.sock")
+            PfimData(dbname).close()
+            server = None
+            if mode == "server":
+                server = subprocess.Popen([sys.executable, "-c",
+                    "import sys; from pfim._server import serve; "
+                    "serve(sys.argv[1], sys.argv[2])", sock, dbname],
+                    env=dict(os.environ, PYTHONPATH=_ROOT))
+                while not _listening(sock) and server.poll() is None:
+                    time.sleep(0.05)
+            lost = []
+            try:
+                for n in _WRITERS:
+
+                    def setup(n=n):
+                        ready, go = context.Semaphore(0), context.Event()
+                        procs = [context.Process(target=_record_entries,
+                            args=(dbname, server and sock, worker,
+                                self.day(0.5), ready, go))
+                            for worker in range(n)]
+                        for proc in procs:
+                            proc.start()
+                        for _ in procs:
+                            ready.acquire()
+                        return procs, go
+
+                    def run(arg, n=n):
+                        procs, go = arg
+                        before = _count_entries(dbname)
+                        go.set()
+                        for proc in procs:
+                            proc.join()
+                        added = _count_entries(dbname) - before
+                        failed = sum(proc.exitcode != 0 for proc in procs)
+                        if added != n * _WRITER_RECORDS or failed:
+                            lost.append(f"{n} writers: {added} of "
+                                f"{n * _WRITER_RECORDS} entries, {failed} "
+                                "failed processes")
+                        return added
+                    self.time(f"writers/{mode}/{n}", run, setup)
+            finally:
+                if server is not None:
+                    server.terminate()
+                    server.wait()
+            self.check(f"writers/{mode}/no-loss", not lost,
+                "; ".join(lost) or "ok")
+
+
+def _record_entries(dbname: str, sock: Optional[str], worker: int, day: str,
+    ready, go) -> None:
+    # a process of bench_writers: once go is set, records _WRITER_RECORDS
+    # entries into dbname, through the server listening on sock if any
+    if sock is None:
+        core = PfimCore(dbname, cache_size=0)
+    else:
+        from pfim._server import forward
+    ready.release()
+    go.wait()
+    for i in range(_WRITER_RECORDS):
+        descr = f"Writer {worker} entry {i}"
+        if sock is None:
+            core.record({"expense": 1.0, "recdate": day,
+                "rectag": _BENCH_TAG, "descr": descr})
+        elif forward(["record", "--exp", "1", "--date", day, "--tag",
+            _BENCH_TAG, "--descr", descr], sock) != 0:
+            sys.exit(1)
+
+
+def _listening(sock: str) -> bool:
+    from pfim._server import forward_probe
+    return os.path.exists(sock) and forward_probe(sock)
+
+
+def _remove_db(dbname: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(dbname + suffix):
+            os.remove(dbname + suffix)
+
+
+def _count_entries(dbname: str) -> int:
+    conn = sqlite3.connect(dbname)
+    try:
+        return conn.execute("SELECT count(*) FROM pfim").fetchone()[0]
+    finally:
+        conn.close()
+
+
+async def _writer_latencies(dbname: str, readers: int,
+    writes: int = 200) -> List[float]:
+    from pfim._aio import AsyncPfimCore
+    async with AsyncPfimCore(dbname, readers=max(readers, 1)) as core:
+        stop = asyncio.Event()
+
+        async def read():
+            while not stop.is_set():
+                async for _ in core.report({"allQuery": True}):
+                    if stop.is_set():
+                        break
+
+        store = core.data.data.store(ledger.START.isoformat())
+        tag_id = store.tag_ids([_BENCH_TAG])[_BENCH_TAG]
+        tasks = [asyncio.create_task(read()) for _ in range(readers)]
+        await asyncio.sleep(0.1)
+        latencies = []
+        for i in range(writes):
+            start = time.perf_counter()
+            await core.data.add_entry(_INSERT_SQL, ledger.START.isoformat(),
+                tag_id, "Async write", -1.0)
+            latencies.append(time.perf_counter() - start)
+        stop.set()
+        await asyncio.gather(*tasks)
+        await core.data.delete("DELETE FROM pfim WHERE tag_id = ?", tag_id)
+    return sorted(latencies)
+
+
+def _uses_index(plan: List[str]) -> bool:
+    # every access to the ledger table must be an index search
+    return all(not detail.startswith("SCAN pfim") for detail in plan
+        if re.match(r"(SCAN|SEARCH) pfim\b", detail))
+
+
+def _same_summaries(expected: Dict, result: Dict) -> bool:
+    # sums are added in another order, so they may differ by rounding
+    close = lambda a, b: (a == b or a is not None and b is not None
+        and abs(a - b) <= 1e-9 * max(abs(a), abs(b), 1.0))
+    return expected.keys() == result.keys() and all(
+        e.count == r.count and e.minimum == r.minimum
+        and e.maximum == r.maximum and close(e.mean, r.mean)
+        and close(e.stdev, r.stdev)
+        for e, r in ((expected[key], result[key]) for key in expected))
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Return the cases slower than baseline by more than threshold."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base and result["seconds"] > base["seconds"] * (1 + threshold):
+            regressions.append(
+                f"{name}: {base['seconds'] * 1e3:.2f} ms -> "
+                f"{result['seconds'] * 1e3:.2f} ms")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="pfim benchmark suite")
+    parser.add_argument("--size", choices=ledger.SIZES, default="10k",
+        help="Ledger size [default: 10k]")
+    parser.add_argument("--seed", type=int, default=ledger.SEED,
+        help=f"Ledger seed [default: {ledger.SEED}]")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="Runs per case, the median is reported [default: 3]")
+    parser.add_argument("-k", dest="pattern", metavar="REGEX",
+        help="Only run the cases whose name matches REGEX")
+    parser.add_argument("--output", metavar="FILE",
+        help="Write results as JSON to FILE [default: stdout]")
+    parser.add_argument("--baseline", metavar="FILE",
+        help="Compare the results with a previous JSON output")
+    parser.add_argument("--threshold", type=float, default=0.2,
+        help="Allowed slowdown over the baseline [default: 0.2]")
+    parser.add_argument("--import-budget", type=float, default=25.0,
+        metavar="MS", help="Budget for importing pfim.__main__ [default: 25]")
+    parser.add_argument("--write-budget", type=float, default=50.0,
+        metavar="MS", help="Budget for the p99 latency of an async write "
+        "under 4 readers [default: 50]")
+    parser.add_argument("--workdir", metavar="DIR",
+        help="Scratch directory [default: a temporary directory]")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pfim-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    suite = Suite(ledger.SIZES[args.size], workdir, args.seed, args.repeat,
+        args.pattern, args.import_budget, args.write_budget)
+    try:
+        suite.run()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {"size": args.size, "entries": suite.size, "seed": args.seed,
+            "repeat": args.repeat, "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+            "time": datetime.now().isoformat(timespec="seconds")},
+        "results": suite.results,
+        "checks": suite.checks,
+    }
+    failed = [name for name, check in suite.checks.items() if not check["ok"]]
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+        if baseline.get("meta", {}).get("size") != args.size:
+            print("Baseline was run with another ledger size", file=sys.stderr)
+        report["regressions"] = compare(suite.results, baseline, args.threshold)
+        for line in report["regressions"]:
+            print(f"REGRESSION {line}", file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(text + "\n")
+    else:
+        print(text)
+    return 1 if failed or report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Deterministic synthetic ledgers for the benchmark suite.
+
+Entries are generated day by day, in date order as a real ledger grows.
+Every month has a salary and a rent entry; the other entries are drawn
+from weighted tags with log-normal amounts, so a few tags dominate the
+ledger and amounts have a long tail. The same size and seed always give
+the same ledger.
+"""
+
+import csv
+import random
+from datetime import date, timedelta
+from typing import Generator, Tuple
+
+SEED = 20240101
+START = date(2000, 1, 1)
+SIZES = {"10k": 10_000, "1m": 1_000_000, "5m": 5_000_000,
+    "10m": 10_000_000, "50m": 50_000_000}
+
+# tag: (weight, median amount, spread, merchants); negative means expense
+_TAGS = {
+    "food": (30, -14.0, 0.6, ("Cafe", "Bistro", "Pizzeria", "Canteen")),
+    "groceries": (20, -45.0, 0.5, ("Market", "Grocer", "Bakery")),
+    "transport": (14, -9.0, 0.7, ("Bus", "Metro", "Taxi", "Fuel")),
+    "shopping": (10, -38.0, 0.9, ("Store", "Online shop", "Bookshop")),
+    "leisure": (8, -25.0, 0.8, ("Cinema", "Concert", "Museum")),
+    "utilities": (5, -60.0, 0.3, ("Power", "Water", "Internet", "Phone")),
+    "health": (3, -55.0, 0.9, ("Pharmacy", "Dentist", "Clinic")),
+    "travel": (2, -420.0, 0.7, ("Airline", "Hotel", "Rail")),
+    "gifts": (2, -50.0, 0.8, ("Friend", "Family")),
+    "refund": (3, 30.0, 0.8, ("Store", "Online shop")),
+    "freelance": (2, 350.0, 0.6, ("Client",)),
+    "interest": (1, 4.0, 0.5, ("Bank",)),
+}
+_NAMES = tuple(_TAGS)
+_CUM_WEIGHTS = []
+for _name in _NAMES:
+    _CUM_WEIGHTS.append(
+        _TAGS[_name][0] + (_CUM_WEIGHTS[-1] if _CUM_WEIGHTS else 0))
+
+Entry = Tuple[str, str, str, float]
+
+
+def span_days(size: int) -> int:
+    """Days covered by a ledger of size entries: 5 per day, up to 30 years."""
+    years = min(30, max(1, size // 1800))
+    return (date(START.year + years, 1, 1) - START).days
+
+
+def generate(size: int, seed: int = SEED) -> Generator[Entry, None, None]:
+    """Yield size entries as (ISO date, tag, description, amount)."""
+    rng = random.Random(seed)
+    days = span_days(size)
+    per_day, extra = divmod(size, days)
+    produced = 0
+    for offset in range(days):
+        day = START + timedelta(offset)
+        isoday = day.isoformat()
+        count = per_day + (offset < extra)
+        if day.day == 1 and count >= 2:
+            yield isoday, "salary", "Employer payroll", round(
+                rng.gauss(3200.0, 40.0), 2)
+            yield isoday, "rent", "Landlord", -1150.0
+            count -= 2
+            produced += 2
+        for tag in rng.choices(_NAMES, cum_weights=_CUM_WEIGHTS, k=count):
+            weight, median, spread, merchants = _TAGS[tag]
+            amount = round(abs(median) * rng.lognormvariate(0.0, spread), 2)
+            yield (isoday, tag,
+                f"{rng.choice(merchants)} {rng.randrange(1, 100)}",
+                -amount if median < 0 else amount)
+        produced += count
+    assert produced == size
+
+
+def write_csv(path: str, size: int, seed: int = SEED) -> None:
+    """Write a ledger as a CSV statement that 'pfim import' reads."""
+    with open(path, "w", newline="") as fd:
+        writer = csv.writer(fd)
+        writer.writerow(("date", "tag", "description", "amount"))
+        writer.writerows(generate(size, seed))
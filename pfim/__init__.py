@@ -7,3 +7,34 @@
 # import _version
 from ._version import PFIM_VERSION
 
+# The names below are imported on first access (PEP 562), so importing the
+# package, e.g. for ``pfim --version``, does not load the core module.
+_LAZY_NAMES = {
+    "PfimCore": ".pfim",
+    "PfimEntry": ".pfim",
+    "PfimEntryBatch": ".pfim",
+    "PfimData": ".pfim",
+    "InteractivePfim": ".pfim",
+    "OutputBeautify": ".pfim",
+    "Report": ".pfim",
+    "ReportSummary": ".pfim",
+    "AsyncPfimData": "._aio",
+    "AsyncPfimCore": "._aio",
+    "PfimBalanceEntry": "._aio",
+    "QueryStats": ".pfim",
+    "QueryProfile": "._profile",
+    "ReportPager": "._pager",
+}
+
+
+def __getattr__(name):
+    if name == "ipfim":
+        from .pfim import InteractivePfim
+        globals()["ipfim"] = InteractivePfim()
+        return globals()["ipfim"]
+    if name not in _LAZY_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(_LAZY_NAMES[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -1,17 +1,17 @@
+# Only the command-line parser is imported up front; the core module is
+# imported by main() once the arguments ask for it, so that --version and
+# --help stay cheap.
 from ._cmd_parser import _cmd_parser
-from .pfim import PfimCore
-from .pfim import PfimEntry
-from .pfim import PfimData
-from .pfim import InteractivePfim
-from .pfim import Output, OutputBeautify
-from .pfim import Report, ReportSummary
 
 # import _version
 from ._version import PFIM_VERSION
 
-ipfim = InteractivePfim()
 __all__ = ["get_version", "cpfim", "ipfim"]
 
+# sub-commands that a running `pfim serve` can execute on our behalf
+_FORWARDED = ("record", "update", "delete", "report", "rebuild-rollups",
+    "rebuild-search")
+
 
 def _cpfim():
     pass
@@ -21,7 +21,8 @@ def _ipfim():
 
 
 def main():
-    import sys 
+    import os
+    import sys
     parser = _cmd_parser()
     args = parser.parse_args()
     if len(sys.argv) == 1:
@@ -53,10 +54,29 @@ def main():
         
     # We are not in interactive mode
     if not args.interactive:
-        pass
+        if args.cmd == "serve":
+            from ._server import serve
+            serve(args.sockPath)
+        elif args.cmd:
+            # hand the command over to a running `pfim serve`, if any;
+            # --profile measures this process, so it always runs here
+            if (args.cmd in _FORWARDED and not args.profile
+                and not os.environ.get("PFIM_NO_DAEMON")):
+                from ._server import forward
+                status = forward(sys.argv[1:])
+                if status is not None:
+                    sys.exit(status)
+            from .pfim import PfimCore
+            # a single command has nothing to reuse a result cache for
+            sys.exit(PfimCore(cache_size=0).execute(vars(args)))
 
     # We are in interactive mode
     if args.interactive:
-        pass
+        from .pfim import InteractivePfim
+        ipfim = InteractivePfim()
+        if args.cmd == "report":
+            ipfim.report(vars(args))
+
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""asyncio facade over PfimData and PfimCore.
+
+Database work runs on executors, never on the event loop: reads on a
+bounded pool of reader threads (each holding one connection, as PfimData
+keeps one connection per thread) and writes on a single writer thread. In
+WAL mode readers and the writer do not block each other, and since the
+writer has a thread of its own, a burst of reports cannot starve it.
+
+Unlike PfimData, the facade lets sqlite3.Error propagate to the awaiting
+coroutine instead of exiting the process.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import sqlite3
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterable, List, Tuple
+
+from .pfim import (_CHUNK_SIZE, _DBNAME, PfimCore, PfimData, PfimEntry,
+    PfimOutput, PfimQuery, _make_entry, _merge_summaries, _open_data,
+    _summary_moments)
+
+_READERS = 4
+_FETCH_BATCH = 128
+_PREFETCH = 2
+# seconds a reader waits for room in the queue before it looks again
+# whether the consumer is gone
+_PUT_WAIT = 0.1
+_END = object()
+
+# an entry of a --running-balance report, and the balance after it
+PfimBalanceEntry = namedtuple("PfimBalanceEntry",
+    PfimEntry._fields + ("balance",))
+
+
+class _Stopped(Exception):
+    pass
+
+
+class AsyncPfimData:
+    """Non-blocking PFIM database interface."""
+
+    def __init__(self, dbname: str = _DBNAME, readers: int = _READERS,
+        data: PfimData = None):
+        self.data = data if data is not None else _open_data(dbname)
+        self._readers = ThreadPoolExecutor(readers,
+            thread_name_prefix="pfim-reader")
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="pfim-writer")
+
+    async def _run(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(func, *args))
+
+    def _write(self, stores: List[PfimData], query: str, args: Tuple) -> int:
+        return sum(data._run_query(query, args, out=True).rowcount
+            for data in stores)
+
+    def _add_entry(self, query: str, args: Tuple) -> int:
+        # the first value of an entry is its date, which picks the
+        # partition it is written to
+        return self._write([self.data.store(args[0])], query, args)
+
+    def _change(self, query: str, args: Tuple) -> int:
+        # an update or delete runs on every writable partition
+        return self._write(self.data.stores(), query, args)
+
+    async def add_entry(self, query: str, *args) -> None:
+        await self._run(self._writer, self._add_entry, query, args)
+
+    async def add_entries(self, query: str, rows: Iterable,
+        chunksize: int = _CHUNK_SIZE) -> int:
+        return await self._run(self._writer, self.data.add_entries, query,
+            rows, chunksize)
+
+    async def update(self, query: str, *args) -> int:
+        return await self._run(self._writer, self._change, query, args)
+
+    async def delete(self, query: str, *args) -> int:
+        return await self._run(self._writer, self._change, query, args)
+
+    async def fetchall(self, query: str, *args) -> List[Tuple]:
+        def fetchall():
+            return self.data._run_query(query, args, out=True).fetchall()
+        return await self._run(self._readers, fetchall)
+
+    async def fetch(self, query: str, *args, batch: int = _FETCH_BATCH,
+        prefetch: int = _PREFETCH) -> AsyncIterator[Tuple]:
+        """Stream the rows of query.
+
+        A reader thread fetches batches of rows into a queue holding at
+        most prefetch batches; it waits while the queue is full, so a slow
+        consumer holds the query back instead of piling rows up in memory.
+        Leaving the loop early, or cancelling the consuming task, stops the
+        reader and interrupts the statement if it is still running. A
+        reader waiting for room gives up once the loop is closed.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(prefetch)
+        stop = threading.Event()
+        lock = threading.Lock()
+        running = {}
+
+        def put(item):
+            try:
+                future = asyncio.run_coroutine_threadsafe(queue.put(item),
+                    loop)
+            except RuntimeError:
+                # the loop is closed
+                raise _Stopped from None
+            while not stop.is_set() and not loop.is_closed():
+                try:
+                    return future.result(_PUT_WAIT)
+                except concurrent.futures.TimeoutError:
+                    pass
+            future.cancel()
+            raise _Stopped
+
+        def produce():
+            conn = self.data._connect_for(query)
+            with lock:
+                running["conn"] = conn
+            try:
+                cursor = conn.execute(query, args)
+                while not stop.is_set():
+                    rows = cursor.fetchmany(batch)
+                    if not rows:
+                        break
+                    put(rows)
+                cursor.close()
+                put(_END)
+            except sqlite3.Error as err:
+                if not stop.is_set():
+                    try:
+                        put(err)
+                    except _Stopped:
+                        pass
+            except _Stopped:
+                pass
+            finally:
+                with lock:
+                    running.pop("conn", None)
+
+        producer = loop.run_in_executor(self._readers, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                for row in item:
+                    yield row
+                # queue.get() does not suspend when a batch is ready: yield
+                # to the loop so other tasks (writes) get their turn
+                await asyncio.sleep(0)
+            await producer
+        finally:
+            if not producer.done():
+                stop.set()
+                with lock:
+                    if "conn" in running:
+                        running["conn"].interrupt()
+                # make room for a put the reader may be blocked on
+                while not queue.empty():
+                    queue.get_nowait()
+
+    async def close(self) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._shutdown)
+
+    def _shutdown(self) -> None:
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.data.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class AsyncPfimCore:
+    """Non-blocking counterpart of PfimCore.
+
+    Commands are compiled by a PfimCore and executed through an
+    AsyncPfimData. Compiling a report reads the database too (whether
+    there is a full-text index, which partitions the dates span, the date
+    span split by --jobs), so it runs on a reader thread, with a PfimCore
+    of its own that concurrent reports do not share. A command that
+    PfimCore would end with sys.exit raises RuntimeError instead.
+    """
+
+    def __init__(self, dbname: str = _DBNAME, readers: int = _READERS):
+        self.data = AsyncPfimData(dbname, readers)
+        self._core = PfimCore(data=self.data.data)
+
+    def _sync(self, func, *args):
+        try:
+            return func(*args)
+        except SystemExit as exc:
+            raise RuntimeError(
+                f"pfim command failed with status {exc.code}") from None
+
+    async def record(self, kw: Dict) -> PfimQuery:
+        return await self.data._run(self.data._writer, self._sync,
+            self._core.record, kw)
+
+    async def import_entries(self, kw: Dict) -> Tuple[int, int]:
+        return await self.data._run(self.data._writer, self._sync,
+            self._core.import_entries, kw)
+
+    async def update(self, kw: Dict) -> int:
+        """Apply an update command, see PfimCore.update; returns the
+        number of updated entries."""
+        return await self.data._run(self.data._writer, self._sync,
+            self._core.update, kw)
+
+    async def delete(self, kw: Dict) -> int:
+        """Apply a delete command, see PfimCore.delete; returns the number
+        of deleted entries."""
+        return await self.data._run(self.data._writer, self._sync,
+            self._core.delete, kw)
+
+    def _compile(self, kw: Dict) -> PfimCore:
+        core = PfimCore(data=self.data.data, cache_size=0)
+        self._sync(core.report, kw)
+        return core
+
+    async def _compiled(self, kw: Dict) -> PfimCore:
+        return await self.data._run(self.data._readers, self._compile, kw)
+
+    async def compile(self, kw: Dict) -> PfimQuery:
+        """Compile report options on a reader thread."""
+        return (await self._compiled(kw))._query
+
+    async def report(self, kw: Dict) -> AsyncIterator[PfimEntry]:
+        """Stream the entries of a report, see AsyncPfimData.fetch.
+
+        With --running-balance the entries are PfimBalanceEntry, which end
+        with the balance after the entry.
+        """
+        core = await self._compiled(kw)
+        if core._mode == "summary":
+            raise ValueError("Use summary() for --summary-only reports")
+        balance = None
+        async for row in self._rows(core):
+            entry = _make_entry(row)
+            if not core._running:
+                yield entry
+                continue
+            if balance is None:
+                balance = await self.data._run(self.data._readers,
+                    self._sync, core._opening, row)
+            balance += entry.amount
+            yield PfimBalanceEntry(*entry, balance)
+
+    async def _rows(self, core: PfimCore) -> AsyncIterator[Tuple]:
+        # a report of a partitioned ledger that spans decades is made of
+        # one statement per decade: their rows are read whole, then merged
+        if len(core._parts) == 1:
+            async for row in self.data.fetch(core._query.query,
+                *core._query.args):
+                yield row
+            return
+        for row in core._merge(await self._fetch_parts(core._parts)):
+            yield row
+
+    async def summary(self, kw: Dict) -> PfimOutput:
+        """Run a --summary-only/--group-by report."""
+        kw = dict(kw, summaryOnly=True)
+        core = await self._compiled(kw)
+        if core._chunks:
+            # --jobs: the worker processes are waited for on a thread
+            rows = await asyncio.to_thread(core._fetch)
+        else:
+            rows = core._merge(await self._fetch_parts(core._parts))
+        rows = _summary_moments(rows)
+        if rows is None:
+            rows = _merge_summaries(await self._fetch_parts(core._exact),
+                exact=True)
+        return PfimCore._summaries(rows, kw.get("groupBy"))
+
+    async def _fetch_parts(self, parts: Tuple[PfimQuery, ...]
+        ) -> List[List[Tuple]]:
+        return list(await asyncio.gather(*(
+            self.data.fetchall(query.query, *query.args)
+            for query in parts)))
+
+    async def close(self) -> None:
+        await self.data.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,265 @@
+"""Columnar analytics of report entries, on NumPy.
+
+report --analytics loads the entries of a report as columns: the day
+(days since 1970-01-01), the amount, whether it is an expense (amounts
+of expenses are negative), and the tag as an index into a list of tag
+names. Rows are fetched with fetchmany(), chunk by chunk, each chunk
+turned into arrays at once, and every analysis is then a handful of
+vectorized operations over the columns:
+
+    percentiles  amount percentiles of expenses and of incomes
+    rolling      spend over the days ending on each day (--window)
+    tags         cumulative amount of every tag, month by month
+    months       monthly income, spend and net, with month-over-month
+                 deltas
+
+NumPy is optional. Without it, available() is False and report
+--analytics refuses to run; the rest of pfim does not need it.
+"""
+
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, List, Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .pfim import PfimData, PfimQuery
+
+_FETCH_CHUNK = 65536
+_PERCENTILES = (5, 25, 50, 75, 95, 99)
+_ROLLING_WINDOW = 30
+
+# one result: its name, column names and rows of values
+AnalyticsTable = namedtuple("AnalyticsTable", "name columns rows")
+
+
+def available() -> bool:
+    """Return whether NumPy, and so report --analytics, is available."""
+    return np is not None
+
+
+class LedgerColumns:
+    """The entries of a report as NumPy arrays, sorted by day."""
+
+    def __init__(self, days, amounts, codes, names: List[str]):
+        order = np.argsort(days, kind="stable")
+        self.days = days[order]
+        self.amounts = amounts[order]
+        self.spent = self.amounts < 0
+        # the tag of an entry is names[code]
+        self.codes = codes[order]
+        self.names = names
+
+    @classmethod
+    def load(cls, data: PfimData, parts: Sequence[PfimQuery],
+        chunksize: int = _FETCH_CHUNK) -> "LedgerColumns":
+        """Read the (day, amount, tag) rows of parts into columns.
+
+        Tags are dictionary encoded as they are read, into indexes of
+        names.
+        """
+        chunks: Dict[str, List] = {"days": [], "amounts": [], "codes": []}
+        codes: Dict[str, int] = {}
+        code = lambda tag: codes.setdefault(tag, len(codes))
+        for part in parts:
+            start = time.perf_counter()
+            rows = 0
+            try:
+                cursor = data._run_query(part.query, part.args, out=True)
+                while True:
+                    batch = cursor.fetchmany(chunksize)
+                    if not batch:
+                        break
+                    rows += len(batch)
+                    days, amounts, tags = zip(*batch)
+                    chunks["days"].append(np.array(days, dtype=np.int32))
+                    chunks["amounts"].append(
+                        np.array(amounts, dtype=np.float64))
+                    chunks["codes"].append(np.fromiter(map(code, tags),
+                        dtype=np.int32, count=len(tags)))
+            except sqlite3.Error as err:
+                data._logger.error(
+                    f"Failed to fetch data from database. {err}")
+                sys.exit(1)
+            if data._hooks:
+                data._emit(part.query, part.args,
+                    time.perf_counter() - start, rows)
+        empty = {"days": np.int32, "amounts": np.float64, "codes": np.int32}
+        columns = {name: np.concatenate(arrays) if arrays
+            else np.empty(0, dtype=empty[name])
+            for name, arrays in chunks.items()}
+        names = [None] * len(codes)
+        for tag, index in codes.items():
+            names[index] = tag
+        return cls(columns["days"], columns["amounts"], columns["codes"],
+            names)
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def _months(self):
+        # months since 1970-01, of every entry
+        return self.days.astype("datetime64[D]").astype(
+            "datetime64[M]").astype(np.int64)
+
+    @staticmethod
+    def _month_name(month: int) -> str:
+        return str(np.datetime64(int(month), "M"))
+
+    @staticmethod
+    def _day_name(day: int) -> str:
+        return str(np.datetime64(int(day), "D"))
+
+    def percentiles(self,
+        percents: Sequence[float] = _PERCENTILES) -> AnalyticsTable:
+        """Percentiles of the amounts of expenses, as positive spend, and
+        of incomes."""
+        columns = ["series", "count"] + [f"p{p:g}" for p in percents]
+        rows = []
+        for name, mask, sign in (("expenses", self.spent, -1.0),
+            ("incomes", ~self.spent, 1.0)):
+            values = self.amounts[mask] * sign
+            if not len(values):
+                rows.append([name, 0] + [None] * len(percents))
+                continue
+            rows.append([name, len(values)]
+                + np.percentile(values, percents).tolist())
+        return AnalyticsTable("percentiles", columns, rows)
+
+    def rolling(self, window: int = _ROLLING_WINDOW) -> AnalyticsTable:
+        """Spend over the window days ending on each day, first to last."""
+        columns = ["date", f"spend_{window}d"]
+        if not len(self):
+            return AnalyticsTable("rolling", columns, [])
+        first = int(self.days[0])
+        ndays = int(self.days[-1]) - first + 1
+        daily = np.bincount(self.days[self.spent] - first,
+            weights=-self.amounts[self.spent], minlength=ndays)
+        total = np.concatenate(([0.0], np.cumsum(daily)))
+        ends = np.arange(1, ndays + 1)
+        spend = total[ends] - total[np.maximum(ends - window, 0)]
+        return AnalyticsTable("rolling", columns,
+            [[self._day_name(first + offset), value]
+                for offset, value in enumerate(spend.tolist())])
+
+    def tags(self) -> AnalyticsTable:
+        """Cumulative amount of every tag at the end of every month, from
+        the first month the tag appears in."""
+        columns = ["month", "tag", "cumulative"]
+        if not len(self):
+            return AnalyticsTable("tags", columns, [])
+        months = self._months()
+        first = int(months[0])
+        nmonths, ntags = int(months[-1]) - first + 1, len(self.names)
+        cell = (months - first) * ntags + self.codes
+        size = nmonths * ntags
+        totals = np.bincount(cell, weights=self.amounts, minlength=size
+            ).reshape(nmonths, ntags).cumsum(axis=0)
+        seen = np.bincount(cell, minlength=size
+            ).reshape(nmonths, ntags).cumsum(axis=0) > 0
+        order = sorted(range(ntags), key=lambda tag: (
+            self.names[tag] is None, self.names[tag] or ""))
+        rows = []
+        for month, (values, started) in enumerate(zip(totals.tolist(),
+            seen.tolist())):
+            name = self._month_name(first + month)
+            rows.extend([name, self.names[tag], values[tag]]
+                for tag in order if started[tag])
+        return AnalyticsTable("tags", columns, rows)
+
+    def months(self) -> AnalyticsTable:
+        """Monthly income, spend and net, and their change over the
+        previous month; the change of spend is also given in percent."""
+        columns = ["month", "income", "spend", "net", "delta_spend",
+            "delta_net", "pct_spend"]
+        if not len(self):
+            return AnalyticsTable("months", columns, [])
+        months = self._months()
+        first = int(months[0])
+        nmonths = int(months[-1]) - first + 1
+        index = months - first
+        spend = np.bincount(index, weights=np.where(self.spent,
+            -self.amounts, 0.0), minlength=nmonths)
+        income = np.bincount(index, weights=np.where(self.spent,
+            0.0, self.amounts), minlength=nmonths)
+        net = income - spend
+        delta_spend = np.concatenate(([np.nan], np.diff(spend)))
+        delta_net = np.concatenate(([np.nan], np.diff(net)))
+        previous = np.concatenate(([np.nan], spend[:-1]))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pct = np.where(previous > 0, delta_spend / previous * 100,
+                np.nan)
+        rows = []
+        for month, values in enumerate(zip(income.tolist(), spend.tolist(),
+            net.tolist(), delta_spend.tolist(), delta_net.tolist(),
+            pct.tolist())):
+            rows.append([self._month_name(first + month)] + [
+                None if value != value else value for value in values])
+        return AnalyticsTable("months", columns, rows)
+
+    def run(self, names: Iterable[str],
+        window: int = _ROLLING_WINDOW) -> List[AnalyticsTable]:
+        """Compute the analyses named by names, in that order."""
+        tables = []
+        for name in names:
+            if name == "rolling":
+                tables.append(self.rolling(window))
+            else:
+                tables.append(getattr(self, name)())
+        return tables
+
+
+def _cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+
+def write_tables(tables: Iterable[AnalyticsTable], fmt: str = "table",
+    file=sys.stdout) -> None:
+    """Render analytics tables as text tables, CSV or JSON lines.
+
+    CSV tables are separated by an empty line, and JSON lines carry the
+    name of their table as "analytics".
+    """
+    tables = list(tables)
+    if fmt == "jsonl":
+        import json
+        for table in tables:
+            for row in table.rows:
+                record = dict(zip(table.columns, row))
+                file.write(json.dumps(dict(analytics=table.name, **record),
+                    ensure_ascii=False) + "\n")
+        return
+    if fmt == "csv":
+        import csv
+        writer = csv.writer(file, lineterminator="\n")
+        for count, table in enumerate(tables):
+            if count:
+                file.write("\n")
+            writer.writerow(table.columns)
+            writer.writerows(table.rows)
+        return
+    for count, table in enumerate(tables):
+        if count:
+            file.write("\n")
+        cells = [[_cell(value) for value in row] for row in table.rows]
+        widths = [max([len(column)] + [len(row[i]) for row in cells])
+            for i, column in enumerate(table.columns)]
+        # text columns are left aligned, numbers right aligned
+        left = [not any(isinstance(row[i], (int, float))
+            for row in table.rows) for i in range(len(widths))]
+        line = lambda row: "  ".join(cell.ljust(width) if text
+            else cell.rjust(width) for cell, width, text in zip(row, widths,
+                left)).rstrip() + "\n"
+        file.write(table.name.upper() + "\n")
+        file.write(line([column.upper() for column in table.columns]))
+        for row in cells:
+            file.write(line(row))
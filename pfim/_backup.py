@@ -0,0 +1,337 @@
+"""`pfim backup`, `pfim snapshot` and `pfim compact`.
+
+A backup is copied with SQLite's online backup API, a few pages per step,
+so that the copy never holds a lock for long. Another connection writing
+to the ledger makes SQLite start the copy over. After a few restarts the
+rest of it is copied in one step, under a read lock, which in WAL mode
+does not hold writers up either.
+
+With --incremental the copy is staged in memory, or next to the ledger
+when it is larger than _MEMORY_STAGE, and only the pages whose content
+hash changed since the previous backup are written to the destination.
+Each backup keeps the hashes of its pages in a .pages file beside it.
+The file sizes and modification times of the source are kept there as
+well, and a file that has not changed since is not copied at all; on a
+partitioned ledger that is every year but the current one.
+
+A snapshot is a VACUUM INTO copy: compacted, and consistent as of the
+moment it started. compact rebuilds the ledger in place to give the space
+freed by deleted entries back to the file system.
+
+A partitioned ledger is backed up, or snapshotted, into a directory with
+a copy of each of its files, which is itself a partitioned ledger.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+from .pfim import PfimData
+
+# pages copied per step of the online backup, and the restarts after which
+# the rest is copied in one step
+_BACKUP_PAGES = 1024
+_BACKUP_RESTARTS = 3
+_PAGES_SUFFIX = ".pages"
+_STAGE_SUFFIX = ".backup-partial"
+_DIGEST_SIZE = 16
+# the largest database staged in memory for an incremental backup;
+# Connection.serialize() is new in Python 3.11
+_MEMORY_STAGE = 256 << 20
+_SERIALIZE = hasattr(sqlite3.Connection, "serialize")
+
+# files: the database files copied or compacted; size: their bytes, before
+# compaction for compact; written: the bytes written to the destination,
+# after compaction for compact
+CopyStats = namedtuple("CopyStats", "files size written seconds restarts")
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _source(path: str, immutable: bool, timeout: float) -> sqlite3.Connection:
+    uri = "file:" + quote(path) + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    return sqlite3.connect(uri, uri=True, timeout=timeout)
+
+
+def _remove(*paths: str) -> None:
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _sidecars(path: str) -> Tuple[str, str]:
+    # the WAL and shared memory files of an old copy, which SQLite would
+    # otherwise apply to the new one
+    return path + "-wal", path + "-shm"
+
+
+def _stamp(path: str) -> List[Optional[List[int]]]:
+    # size and modification time of a database and of its WAL; an empty
+    # WAL is created and removed by every connection, it does not count
+    stamp = []
+    for name in (path, path + "-wal"):
+        try:
+            stat = os.stat(name)
+        except FileNotFoundError:
+            stat = None
+        stamp.append([stat.st_size, stat.st_mtime_ns]
+            if stat is not None and stat.st_size else None)
+    return stamp
+
+
+def _targets(data: PfimData, dest: str) -> List[Tuple[str, bool, str]]:
+    # (path, immutable, destination) of every file of the ledger
+    files = data.files()
+    if data.partitioned:
+        os.makedirs(dest, exist_ok=True)
+    elif os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(files[0][0]))
+    return [(path, immutable,
+        os.path.join(dest, os.path.basename(path)) if data.partitioned
+        else dest) for path, immutable in files]
+
+
+def _online_copy(source: sqlite3.Connection, target: sqlite3.Connection,
+    pages: int) -> int:
+    """Copy source into the database target, pages at a time.
+
+    Returns the number of times the copy started over.
+    """
+    restarts = 0
+    left = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, left
+        if left is not None and remaining > left:
+            restarts += 1
+            if restarts >= _BACKUP_RESTARTS:
+                raise _Restarted
+        left = remaining
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    except _Restarted:
+        source.backup(target)
+    return restarts
+
+
+def _read_manifest(path: str) -> Tuple[dict, List[bytes]]:
+    # the header and the page hashes of a previous backup, nothing if
+    # there is none or it can not be read
+    try:
+        with open(path, "rb") as fd:
+            header = json.loads(fd.readline())
+            digests = fd.read()
+    except (OSError, ValueError):
+        return {}, []
+    return header, [digests[i:i + _DIGEST_SIZE]
+        for i in range(0, len(digests), _DIGEST_SIZE)]
+
+
+def _write_manifest(path: str, header: dict, digests: List[bytes]) -> None:
+    partial = path + ".partial"
+    with open(partial, "wb") as fd:
+        fd.write(json.dumps(header).encode() + b"\n")
+        fd.write(b"".join(digests))
+    os.replace(partial, path)
+
+
+def _page_size(path: str) -> int:
+    # from the database header, where 1 stands for 65536
+    with open(path, "rb") as fd:
+        fd.seek(16)
+        size = int.from_bytes(fd.read(2), "big")
+    return 65536 if size == 1 else size
+
+
+def _backup_file(path: str, immutable: bool, target: str, pages: int,
+    timeout: float) -> Tuple[int, int, int]:
+    # a full copy, written next to target and renamed over it
+    partial = target + ".partial"
+    _remove(partial)
+    source = _source(path, immutable, timeout)
+    try:
+        copy = sqlite3.connect(partial)
+        try:
+            restarts = _online_copy(source, copy, pages)
+        finally:
+            copy.close()
+    finally:
+        source.close()
+    _remove(*_sidecars(target), target + _PAGES_SUFFIX)
+    os.replace(partial, target)
+    size = os.path.getsize(target)
+    return size, size, restarts
+
+
+def _backup_pages(path: str, immutable: bool, target: str, pages: int,
+    timeout: float) -> Tuple[int, int, int]:
+    # an incremental copy: only the pages that changed are written
+    manifest = target + _PAGES_SUFFIX
+    header, digests = _read_manifest(manifest)
+    exists = os.path.exists(target)
+    if not exists or header.get("size") != os.path.getsize(target):
+        header, digests = {}, []
+    # stamped before copying, a write made meanwhile is copied next time
+    stamp = _stamp(path)
+    if digests and header.get("stamp") == stamp:
+        return header["size"], 0, 0
+    stage = path + _STAGE_SUFFIX
+    _remove(stage)
+    source = _source(path, immutable, timeout)
+    try:
+        page_size = source.execute("PRAGMA page_size").fetchone()[0]
+        pagecount = source.execute("PRAGMA page_count").fetchone()[0]
+        in_memory = _SERIALIZE and pagecount * page_size <= _MEMORY_STAGE
+        copy = sqlite3.connect(":memory:" if in_memory else stage)
+        try:
+            # a backup into an in-memory database fails unless their page
+            # sizes match
+            copy.execute(f"PRAGMA page_size = {page_size}")
+            restarts = _online_copy(source, copy, pages)
+            image = copy.serialize() if in_memory else None
+        finally:
+            copy.close()
+    finally:
+        source.close()
+    try:
+        if header.get("page_size") != page_size:
+            digests = []
+        # a backup interrupted while patching target has no manifest, the
+        # next one writes every page
+        _remove(manifest, *_sidecars(target))
+        written = 0
+        hashes = []
+        src = open(stage, "rb") if image is None else io.BytesIO(image)
+        with src, open(target, "r+b" if exists else "wb") as dst:
+            for pgno, page in enumerate(
+                iter(lambda: src.read(page_size), b"")):
+                digest = hashlib.blake2b(page,
+                    digest_size=_DIGEST_SIZE).digest()
+                hashes.append(digest)
+                if pgno >= len(digests) or digests[pgno] != digest:
+                    dst.seek(pgno * page_size)
+                    dst.write(page)
+                    written += len(page)
+            size = len(hashes) * page_size
+            dst.truncate(size)
+            dst.flush()
+            os.fsync(dst.fileno())
+    finally:
+        _remove(stage)
+    _write_manifest(manifest, {"size": size, "page_size": page_size,
+        "stamp": stamp}, hashes)
+    return size, written, restarts
+
+
+def backup(data: PfimData, dest: str, incremental: bool = False,
+    pages: int = _BACKUP_PAGES) -> CopyStats:
+    """Copy the ledger of data to dest with the online backup API.
+
+    dest is a file, or a directory for a partitioned ledger. With
+    incremental, only the pages changed since the previous backup to dest
+    are written.
+    """
+    copy = _backup_pages if incremental else _backup_file
+    start = time.perf_counter()
+    size = written = restarts = 0
+    targets = _targets(data, dest)
+    for path, immutable, target in targets:
+        copied = copy(path, immutable, target, pages, data.busy_timeout)
+        size += copied[0]
+        written += copied[1]
+        restarts += copied[2]
+    if data.partitioned:
+        _prune(dest, {os.path.basename(target) for *_, target in targets})
+    return CopyStats(len(targets), size, written,
+        time.perf_counter() - start, restarts)
+
+
+def _prune(dest: str, kept: set) -> None:
+    # the copies of years archived, or removed, since the last backup
+    from ._partition import _PARTITION_RE
+    for name in os.listdir(dest):
+        base = name[:-len(_PAGES_SUFFIX)] if name.endswith(
+            _PAGES_SUFFIX) else name
+        if _PARTITION_RE.match(base) and base not in kept:
+            _remove(os.path.join(dest, name))
+
+
+def snapshot(data: PfimData, dest: str) -> CopyStats:
+    """Write a compacted copy of the ledger of data to dest with VACUUM INTO.
+
+    dest must not exist. It is written as dest.partial, renamed once
+    complete.
+    """
+    logger = logging.getLogger("pfim.PfimBackup")
+    if not data.partitioned and os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(data.files()[0][0]))
+    if os.path.exists(dest):
+        logger.error(f"{dest} already exists")
+        sys.exit(1)
+    partial = dest + ".partial"
+    # left over by an interrupted snapshot
+    if os.path.isdir(partial):
+        import shutil
+        shutil.rmtree(partial)
+    _remove(partial)
+    start = time.perf_counter()
+    size = written = 0
+    targets = _targets(data, partial)
+    for path, immutable, target in targets:
+        source = _source(path, immutable, data.busy_timeout)
+        try:
+            source.execute("VACUUM INTO ?", (target,))
+        except sqlite3.Error as err:
+            logger.error(f"Failed to snapshot {path}. {err}")
+            sys.exit(1)
+        finally:
+            source.close()
+        size += sum(os.path.getsize(name)
+            for name in (path, path + "-wal") if os.path.exists(name))
+        written += os.path.getsize(target)
+    os.replace(partial, dest)
+    return CopyStats(len(targets), size, written,
+        time.perf_counter() - start, 0)
+
+
+def compact(data: PfimData) -> CopyStats:
+    """Rebuild every writable file of the ledger of data with VACUUM.
+
+    The space of deleted entries goes back to the file system, and the WAL
+    is truncated. Archives were compacted when they were made.
+    """
+    logger = logging.getLogger("pfim.PfimBackup")
+    start = time.perf_counter()
+    files = before = after = 0
+    for path, immutable in data.files():
+        if immutable:
+            continue
+        names = (path, path + "-wal")
+        before += sum(os.path.getsize(name)
+            for name in names if os.path.exists(name))
+        conn = sqlite3.connect(path, timeout=data.busy_timeout,
+            isolation_level=None)
+        try:
+            data._retrying(conn, conn.execute, "VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as err:
+            logger.error(f"Failed to compact {path}. {err}")
+            sys.exit(1)
+        finally:
+            conn.close()
+        after += sum(os.path.getsize(name)
+            for name in names if os.path.exists(name))
+        files += 1
+    return CopyStats(files, before, after, time.perf_counter() - start, 0)
@@ -0,0 +1,233 @@
+"""Transactional batch mode: apply a script of pfim commands at once.
+
+Every line of the script is a record, update or delete command, parsed
+with the regular command-line parser. Runs of commands of the same kind
+are grouped into set-based statements (one executemany for records, one
+UPDATE ... FROM (VALUES ...) or a DELETE joined with VALUES for updates
+and deletes) and the whole script is applied in a single transaction:
+either every command is applied or none is. SQLite older than 3.33 has
+no UPDATE ... FROM: there, updates are applied one by one.
+
+The script is parsed before the transaction starts, and compiled in it:
+the tags its commands create are rolled back with the rest. A transaction
+does not span the yearly files of a partitioned ledger, so batches are
+refused on one.
+
+Each group runs under a savepoint. When a group fails, its commands are
+replayed one by one, each under its own savepoint, to report the line
+that failed, and the transaction is rolled back.
+"""
+
+import logging
+import shlex
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, List, TextIO, Tuple
+
+from ._cmd_parser import _cmd_parser
+from .pfim import _INSERT_SQL, PfimCore, PfimQuery, _compile_delete
+
+_BATCHABLE = ("record", "update", "delete")
+# commands per grouped statement, 3 parameters each at most
+_GROUP_SIZE = 500
+# UPDATE ... FROM needs SQLite 3.33, updates run one by one before that
+_UPDATE_FROM = sqlite3.sqlite_version_info >= (3, 33, 0)
+
+# shape: what the command can be grouped with, None when it runs alone.
+# reads/writes: (date, column, value) keys an update matches and produces.
+_Command = namedtuple("_Command", "lineno cmd shape row query reads writes")
+
+
+class _BatchFailed(Exception):
+
+    def __init__(self, lineno: int, err: Exception):
+        super().__init__(f"Line {lineno}: {err}")
+
+
+def _compile(core: PfimCore, lineno: int, kw: Dict) -> _Command:
+    cmd = kw["cmd"]
+    if cmd == "record":
+        query = core._record_query(kw)
+        return _Command(lineno, cmd, ("record",), query.args, query, (), ())
+    if cmd == "update" and kw.get("upRename"):
+        # a rename changes the tag dictionary, not entries
+        core._logger.error("update --rename-tag can not be used in a batch")
+        sys.exit(1)
+    if cmd == "update":
+        column, opdate, old, new = core._update_target(kw)
+        query = core._update_query(core._db, column, opdate, old, new)
+        new, _, old = query.args
+        shape = ("update", column) if _UPDATE_FROM else None
+        return _Command(lineno, cmd, shape, (opdate, old, new),
+            query, ((opdate, column, old),), ((opdate, column, new),))
+    filters = core._store_filters(core._db, core._delete_filters(kw))
+    query = _compile_delete(filters)
+    # only deletes made of equalities become a row of an IN (VALUES ...)
+    shape = None
+    if filters and all(op == "=" for _, op, _ in filters):
+        shape = ("delete",) + tuple(column for column, _, _ in filters)
+    return _Command(lineno, cmd, shape, query.args, query, (), ())
+
+
+def _groups(commands: Iterable[_Command]) -> Iterable[List[_Command]]:
+    """Split commands into runs that one set-based statement can apply.
+
+    A set-based UPDATE matches rows on their values before the statement,
+    so an update joins a group only if it does not match what an earlier
+    update of the group matches or produces.
+    """
+    group, reads, writes = [], set(), set()
+    for command in commands:
+        if group and (command.shape is None
+            or command.shape != group[0].shape
+            or len(group) >= _GROUP_SIZE
+            or any(key in reads or key in writes for key in command.reads)):
+            yield group
+            group, reads, writes = [], set(), set()
+        group.append(command)
+        reads.update(command.reads)
+        writes.update(command.writes)
+    if group:
+        yield group
+
+
+def _group_statement(group: List[_Command]) -> PfimQuery:
+    shape = group[0].shape
+    args = tuple(value for command in group for value in command.row)
+    if shape[0] == "update":
+        column = shape[1]
+        values = ", ".join(["(?, ?, ?)"] * len(group))
+        return PfimQuery(f"UPDATE pfim SET {column} = v.column3 "
+            f"FROM (VALUES {values}) AS v "
+            f"WHERE pfim.opdate = v.column1 AND pfim.{column} = v.column2",
+            args)
+    # a row value IN (VALUES ...) scans the table: join the values with it
+    # so that every row of values is an index search
+    columns = shape[1:]
+    row = f"({', '.join('?' * len(columns))})"
+    match = " AND ".join(f"pfim.{column} = v.column{i}"
+        for i, column in enumerate(columns, 1))
+    return PfimQuery("DELETE FROM pfim WHERE id IN (SELECT pfim.id FROM "
+        f"(VALUES {', '.join([row] * len(group))}) AS v "
+        f"JOIN pfim ON {match})", args)
+
+
+def _apply(conn: sqlite3.Connection, group: List[_Command]) -> int:
+    conn.execute("SAVEPOINT pfim_batch")
+    try:
+        if group[0].shape == ("record",):
+            count = conn.executemany(
+                _INSERT_SQL, [command.row for command in group]).rowcount
+        elif len(group) == 1:
+            query = group[0].query
+            count = conn.execute(query.query, query.args).rowcount
+        else:
+            query = _group_statement(group)
+            count = conn.execute(query.query, query.args).rowcount
+    except sqlite3.Error as err:
+        conn.execute("ROLLBACK TO pfim_batch")
+        conn.execute("RELEASE pfim_batch")
+        # find the failing command
+        for command in group:
+            conn.execute("SAVEPOINT pfim_batch")
+            try:
+                conn.execute(command.query.query, command.query.args)
+            except sqlite3.Error as cmderr:
+                raise _BatchFailed(command.lineno, cmderr)
+            finally:
+                conn.execute("ROLLBACK TO pfim_batch")
+                conn.execute("RELEASE pfim_batch")
+        raise _BatchFailed(group[0].lineno, err)
+    conn.execute("RELEASE pfim_batch")
+    return count
+
+
+def _parse(fd: TextIO) -> List[Tuple[int, Dict]]:
+    # the (line number, options) of the commands of the script
+    logger = logging.getLogger("pfim.PfimBatch")
+    parser = _cmd_parser()
+    commands = []
+    for lineno, line in enumerate(fd, 1):
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        if argv[0] not in _BATCHABLE:
+            logger.error(f"Line {lineno}: '{argv[0]}' can not be used in a "
+                f"batch, only {', '.join(_BATCHABLE)}")
+            sys.exit(1)
+        try:
+            commands.append((lineno, vars(parser.parse_args(argv))))
+        except SystemExit:
+            # the parser has reported why
+            logger.error(f"Line {lineno}: invalid command, nothing applied")
+            sys.exit(1)
+    return commands
+
+
+def _compile_all(core: PfimCore, commands: List[Tuple[int, Dict]]
+    ) -> List[_Command]:
+    compiled = []
+    for lineno, kw in commands:
+        try:
+            compiled.append(_compile(core, lineno, kw))
+        except SystemExit:
+            # PfimCore has reported why
+            raise _BatchFailed(lineno, "invalid command") from None
+    return compiled
+
+
+def run_batch(core: PfimCore, kw: Dict, file=sys.stdout) -> int:
+    """Apply the commands of kw["batFile"] in one transaction.
+
+    Prints the number of commands and of affected entries per command, and
+    returns the exit status.
+    """
+    logger = logging.getLogger("pfim.PfimBatch")
+    if core._db.partitioned:
+        # one transaction can not span the files of a partitioned ledger
+        logger.error("Batches are not supported on a partitioned ledger")
+        return 1
+    filename = kw.get("batFile") or "-"
+    start = time.perf_counter()
+    try:
+        fd = sys.stdin if filename == "-" else open(filename, "r")
+    except OSError as err:
+        logger.error(f"Can not open {filename}. {err.strerror}")
+        return 1
+    try:
+        commands = _parse(fd)
+    except (OSError, UnicodeDecodeError) as err:
+        logger.error(f"Can not read {filename}. {err}")
+        return 1
+    finally:
+        if fd is not sys.stdin:
+            fd.close()
+    counts = {cmd: [0, 0] for cmd in _BATCHABLE}
+    statements = 0
+    conn = core._db._connect()
+    try:
+        core._db._retrying(conn, conn.execute, "BEGIN IMMEDIATE")
+        commands = _compile_all(core, commands)
+        for group in _groups(commands):
+            rows = _apply(conn, group)
+            counts[group[0].cmd][0] += len(group)
+            counts[group[0].cmd][1] += max(rows, 0)
+            statements += 1
+        core._db._settle_balances(conn)
+        conn.commit()
+    except (_BatchFailed, sqlite3.Error) as err:
+        if conn.in_transaction:
+            conn.rollback()
+        # the ids of the tags created by the batch are gone
+        core._db.forget_tags()
+        logger.error(f"Batch failed, nothing applied. {err}")
+        return 1
+    elapsed = time.perf_counter() - start
+    print(f"Applied {len(commands)} commands with {statements} statements "
+        f"in {elapsed:.2f}s", file=file)
+    for cmd, (ncommands, rows) in counts.items():
+        if ncommands:
+            print(f"    {cmd}: {ncommands} commands, {rows} entries", file=file)
+    return 0
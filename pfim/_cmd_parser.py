@@ -1,10 +1,20 @@
-from curses.panel import update_panels
 from ._version import PFIM_VERSION
 from datetime import date
 
 
 def _cmd_parser():
     import argparse
+
+    def positive(text):
+        # an int of at least 1
+        try:
+            value = int(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid int value: '{text}'")
+        if value < 1:
+            raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+        return value
+
     DESCRIPTION = """
     pfim is a small command-line tool for tracking personal finance. It track
     your incomes and expenses, and can show a report based a given request
@@ -30,9 +40,11 @@ def _cmd_parser():
         help="List all pfim sub-commands")
     parser.add_argument("--help-cmd", type=str, dest="helpCmd", metavar="cmd",
         help="Show documentation for a given command")
+    parser.add_argument("--profile", action="store_true", dest="profile",
+        help="Print the time spent in each database statement to stderr")
 
     # sub-commands parser
-    subparsers = parser.add_subparsers(title="pfim sub-commands")
+    subparsers = parser.add_subparsers(title="pfim sub-commands", dest="cmd")
 
     # -- record subcommand
     recparser = subparsers.add_parser(
@@ -55,6 +67,33 @@ def _cmd_parser():
         metavar="VALUE",
         help="This record is an income of this VALUE")
     
+    # -- import subcommand
+    impparser = subparsers.add_parser(
+        name="import",
+        usage="\n\tpfim import [OPTIONS] FILE",
+        help="Import entries from a bank statement file")
+    impparser.add_argument("impFile", type=str, metavar="FILE",
+        help="CSV, OFX or QIF statement file. Use - to read from stdin")
+    impparser.add_argument("--format", type=str, dest="impFormat",
+        choices=("csv", "ofx", "qif"),
+        help="Format of FILE. [default: guessed from FILE extension]")
+    impparser.add_argument("--map", type=str, dest="impMap", action="append",
+        metavar="FIELD=COLUMN", default=[],
+        help=("Read the entry FIELD (date, tag, description or amount) "
+            "from the CSV column COLUMN. Can be repeated"))
+    impparser.add_argument("--date-format", type=str, dest="impDateFmt",
+        metavar="FMT",
+        help="strptime format of the dates in FILE. [default: YYYY-MM-DD]")
+    impparser.add_argument("--delimiter", type=str, dest="impDelim",
+        metavar="CHAR", default=",",
+        help="CSV field delimiter. [default: ,]")
+    impparser.add_argument("--tag", type=str, dest="impTag", metavar="TAG",
+        default="N/A",
+        help="Tag for entries that come without one. [default: N/A]")
+    impparser.add_argument("--chunk-size", type=int, dest="impChunk",
+        metavar="N", default=10000,
+        help="Number of entries committed per transaction. [default: 10000]")
+
     # -- report subcommand
     repparser = subparsers.add_parser(
         name="report",
@@ -79,14 +118,156 @@ def _cmd_parser():
         help="Show report for records for the given date YYYY-MM-DD")
     repparser.add_argument("--for-tag", type=str, dest="tagQuery",
         metavar="TAG",
-        help="Show report for records for the given TAG")
+        help=("Show report for records for the given TAG and the tags "
+            "under it, e.g. home for home/utilities/power"))
     repparser.add_argument("--for-exp", action="store_true", dest="expQuery",
         help="Show report only for records for expenses")
     repparser.add_argument("--for-inc", action="store_true", dest="incQuery",
         help="Show report only for records for incomes")
     repparser.add_argument("--all", action="store_true", dest="allQuery",
         help="Show report for all records")
+    repparser.add_argument("--search", type=str, dest="searchQuery",
+        metavar="TEXT",
+        help=("Show records whose description has all the words of TEXT, "
+            "best matches first. End a word with * to match it as a prefix"))
+    repparser.add_argument("--limit", type=positive, dest="limitQuery",
+        metavar="N",
+        help=("Show a page of at most N records, in the order of the sort "
+            "options then by date. A full page ends with the --after-cursor "
+            "TOKEN of the next one"))
+    repparser.add_argument("--after-cursor", type=str, dest="cursorQuery",
+        metavar="TOKEN",
+        help=("Show the records following a page, given the TOKEN printed "
+            "after it. The other options must be those of the page"))
+    repparser.add_argument("--running-balance", action="store_true",
+        dest="runningBalance",
+        help=("Show the balance after each record, in date order. It starts "
+            "from the records before the first one shown that match the "
+            "--for-* and --search options"))
+    repparser.add_argument("--balance-as-of", type=str, dest="balanceQuery",
+        metavar="YYYY-MM-DD",
+        help=("Only show the balance of the records dated up to and "
+            "including YYYY-MM-DD"))
+    repparser.add_argument("--summary-only", action="store_true",
+        dest="summaryOnly",
+        help="Only show the summary, computed by the database")
+    repparser.add_argument("--group-by", type=str, dest="groupBy",
+        choices=("tag", "month", "year"),
+        help="Show one summary per tag, month or year. Implies --summary-only")
+    repparser.add_argument("--analytics", type=str, dest="analytics",
+        action="append",
+        choices=("percentiles", "rolling", "tags", "months"),
+        help=("Show an analysis of the selected records instead of the "
+            "records: amount percentiles, rolling spend, cumulative amount "
+            "per tag or monthly totals with month-over-month changes. Can be "
+            "repeated. Needs NumPy"))
+    repparser.add_argument("--window", type=int, dest="window",
+        metavar="DAYS", default=30,
+        help="Days of the rolling spend of --analytics rolling. [default: 30]")
+    repparser.add_argument("--jobs", type=int, dest="jobs", metavar="N",
+        default=1,
+        help=("Compute a summary with N processes, each reading a range of "
+            "dates. 0 uses one per CPU. [default: 1]"))
+    repparser.add_argument("--format", type=str, dest="outFormat",
+        choices=("table", "csv", "jsonl"), default="table",
+        help="Output format of the report. [default: table]")
     
+    # -- rebuild-rollups subcommand
+    rollparser = subparsers.add_parser(
+        name="rebuild-rollups",
+        usage="\n\tpfim rebuild-rollups [OPTIONS]",
+        help=("Rebuild the monthly rollup used by summaries and the balance "
+            "index"))
+    rollparser.add_argument("--check", action="store_true", dest="rollCheck",
+        help=("Only check the rollup and the balance index against the "
+            "records, do not rebuild them"))
+
+    # -- rebuild-search subcommand
+    srchparser = subparsers.add_parser(
+        name="rebuild-search",
+        usage="\n\tpfim rebuild-search [OPTIONS]",
+        help="Rebuild the full-text index used by report --search")
+    srchparser.add_argument("--check", action="store_true",
+        dest="searchCheck",
+        help="Only check the index against the records, do not rebuild it")
+
+    # -- partition subcommand
+    partparser = subparsers.add_parser(
+        name="partition",
+        usage="\n\tpfim partition [OPTIONS]",
+        help="Move the ledger to one database file per year")
+    partparser.add_argument("--dir", type=str, dest="partDir",
+        metavar="PATH",
+        help=("Directory of the yearly databases. The ledger is read from "
+            "there from then on, a directory other than the default being "
+            "recorded in ~/.pfimdata.dir. [default: ~/.pfimdata.d]"))
+    partparser.add_argument("--chunk-size", type=int, dest="partChunk",
+        metavar="N", default=10000,
+        help="Number of entries buffered before writing. [default: 10000]")
+
+    # -- archive subcommand
+    arcparser = subparsers.add_parser(
+        name="archive",
+        usage="\n\tpfim archive [OPTIONS]",
+        help="Compact closed years of a partitioned ledger into read-only files")
+    arcparser.add_argument("--through", type=int, dest="arcYear",
+        metavar="YYYY",
+        help="Archive every year up to YYYY. [default: last year]")
+
+    # -- backup subcommand
+    bakparser = subparsers.add_parser(
+        name="backup",
+        usage="\n\tpfim backup [OPTIONS] DEST",
+        help="Copy the ledger while it is in use")
+    bakparser.add_argument("bakDest", type=str, metavar="DEST",
+        help=("File to copy the ledger to, or directory for a partitioned "
+            "ledger"))
+    bakparser.add_argument("--incremental", action="store_true",
+        dest="bakIncremental",
+        help=("Only write the pages that changed since the previous "
+            "backup to DEST"))
+    bakparser.add_argument("--pages", type=int, dest="bakPages",
+        metavar="N", default=1024,
+        help="Number of pages copied per step. [default: 1024]")
+
+    # -- snapshot subcommand
+    snapparser = subparsers.add_parser(
+        name="snapshot",
+        usage="\n\tpfim snapshot DEST",
+        help="Write a compacted point-in-time copy of the ledger")
+    snapparser.add_argument("snapDest", type=str, metavar="DEST",
+        help=("New file to write the copy to, or directory for a "
+            "partitioned ledger"))
+
+    # -- compact subcommand
+    subparsers.add_parser(
+        name="compact",
+        usage="\n\tpfim compact",
+        help=("Give the space of deleted records back to the file system, "
+            "e.g. after 'delete --before'"))
+
+    # -- serve subcommand
+    srvparser = subparsers.add_parser(
+        name="serve",
+        usage="\n\tpfim serve [OPTIONS]",
+        help="Run a pfim server that other pfim invocations forward to")
+    srvparser.add_argument("--socket", type=str, dest="sockPath",
+        metavar="PATH",
+        help="Unix socket to listen on. [default: $PFIM_SOCKET or ~/.pfim.sock]")
+
+    # -- batch subcommand parser
+    batparser = subparsers.add_parser(
+        name="batch",
+        usage="\n\tpfim batch [FILE]",
+        help="Apply a script of record, update and delete commands at once")
+    batparser.add_argument("batFile", type=str, metavar="FILE", nargs="?",
+        default="-",
+        help=("File with one pfim command per line, e.g. "
+            "'update --tag 2021-05-13 freeL work'. Everything is applied "
+            "in a single transaction, which can not span the yearly files "
+            "of a partitioned ledger: batches are refused there. "
+            "[default: - for stdin]"))
+
     # -- update subcommand parser
     # upcmds = (update|update-rcv|update-spent)
     # upOpts = [(old-tag, new-tag)|(old-date,new-date)|(old-amount,
@@ -96,22 +277,28 @@ def _cmd_parser():
         formatter_class=argparse.RawTextHelpFormatter,
         usage="\n\tpfim update [OPTIONS]",
         help="Update record(s) for given query")
-    updparser.add_argument("--expense", nargs=3, dest="upExpense",
+    updpex = updparser.add_mutually_exclusive_group()
+    updpex.add_argument("--expense", nargs=3, dest="upExpense",
         metavar="",
         help=("Update the income for a given date. \nThe format is: "
             "--expense YYYY-DD-MM OLD_VALUE NEW_VALUE"
             "\n\tExample: pfim update --expense 2021-12-19 230.15 320.10"))
-    updparser.add_argument("--income", nargs=3, dest="upIncome",
+    updpex.add_argument("--income", nargs=3, dest="upIncome",
         metavar="",
         help=("Update the income for a given date. \nThe format is: "
             "--expense YYYY-DD-MM OLD_VALUE NEW_VALUE"
             "\n\tExample: pfim update --income 2021-03-23 780.25 1125.10"))
-    updparser.add_argument("--tag", nargs=3, dest="upTag",
+    updpex.add_argument("--tag", nargs=3, dest="upTag",
         metavar="",
         help=("Update the tag for a given date. \nThe format is: "
             "--tag YYYY-DD-MM OLD_TAG NEW_TAG"
             "\n\tExample: pfim update --tag 2021-05-13 freeL work"))
-    updparser.add_argument("--descr", nargs=4, dest="upDescr",
+    updpex.add_argument("--rename-tag", nargs=2, dest="upRename",
+        metavar="",
+        help=("Rename a tag, and the tags under it, in every record. "
+            "\nThe format is: --rename-tag OLD_TAG NEW_TAG"
+            "\n\tExample: pfim update --rename-tag home/power home/energy"))
+    updpex.add_argument("--descr", nargs=3, dest="upDescr",
         metavar="",
         help=(  """Update a record description for given date.
 The format is: --desc YYYY-MM-DD OLD_DESCR NEW_DESCR
@@ -0,0 +1,221 @@
+"""Streaming readers for bank statement files.
+
+Each reader walks its input once and yields rows in PfimEntry field order
+(date, tag, description, amount), with the date as a validated ISO string,
+so that they can be handed straight to PfimData.add_entries.
+"""
+
+import csv
+import re
+from datetime import datetime
+from typing import Dict, Iterator, Mapping, Optional, TextIO, Tuple
+
+from .pfim import PfimEntry, _validate_datestr
+
+_FORMATS = ("csv", "ofx", "qif")
+_BLOCKSIZE = 1 << 16
+
+
+def _parse_amount(value: str) -> float:
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        return float(value.replace(",", "").replace(" ", ""))
+
+
+def guess_format(filename: str) -> str:
+    """Guess the statement format from the file extension."""
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return ext if ext in _FORMATS else "csv"
+
+
+class StatementReader:
+    """Base class of statement readers.
+
+    Iterating over a reader yields tuples in PfimEntry field order. Rows that
+    cannot be converted are counted in ``rejected`` and skipped.
+    """
+
+    def __init__(self, fd: TextIO, tag: str = "N/A",
+        date_format: Optional[str] = None):
+        self._fd = fd
+        self._tag = tag
+        self._date_format = date_format
+        self.rejected = 0
+
+    def _datestr(self, value: str) -> Optional[str]:
+        value = value.strip()
+        if self._date_format:
+            try:
+                value = datetime.strptime(
+                    value, self._date_format).date().isoformat()
+            except ValueError:
+                return None
+        return value if _validate_datestr(value) else None
+
+    def __iter__(self) -> Iterator[Tuple]:
+        raise NotImplementedError
+
+
+class CsvReader(StatementReader):
+    """Read a CSV statement with a header line.
+
+    ``fields`` maps PfimEntry field names to CSV column names. Fields that
+    are not mapped are looked up by their own name, and a missing tag or
+    description column falls back to the default tag and "N/A".
+    """
+
+    def __init__(self, fd: TextIO, fields: Optional[Mapping[str, str]] = None,
+        delimiter: str = ",", **kw):
+        super().__init__(fd, **kw)
+        self._fields = dict(fields or {})
+        self._delimiter = delimiter
+
+    def _column_indexes(self, header) -> Dict[str, Optional[int]]:
+        lookup = {name.strip().lower(): i for i, name in enumerate(header)}
+        indexes = {}
+        for field in PfimEntry._fields:
+            column = self._fields.get(field, field).strip().lower()
+            indexes[field] = lookup.get(column)
+        for field in ("date", "amount"):
+            if indexes[field] is None:
+                raise ValueError(
+                    f"missing column '{self._fields.get(field, field)}'")
+        return indexes
+
+    def __iter__(self) -> Iterator[Tuple]:
+        reader = csv.reader(self._fd, delimiter=self._delimiter)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return
+        idx = self._column_indexes(header)
+        idate, iamount = idx["date"], idx["amount"]
+        itag, idescr = idx["tag"], idx["description"]
+        tag = self._tag
+        datestr = self._datestr
+        for row in reader:
+            try:
+                opdate = datestr(row[idate])
+                amount = _parse_amount(row[iamount])
+                rtag = row[itag] if itag is not None else tag
+                descr = row[idescr] if idescr is not None else "N/A"
+            except (IndexError, ValueError):
+                opdate = None
+            if opdate is None:
+                self.rejected += 1
+                continue
+            yield (opdate, rtag or tag, descr, amount)
+
+
+class OfxReader(StatementReader):
+    """Read the STMTTRN transactions of an OFX (SGML or XML) statement."""
+
+    _TOKEN = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<]*)")
+
+    def _tokens(self) -> Iterator[Tuple[str, str, str]]:
+        rest = ""
+        while True:
+            block = self._fd.read(_BLOCKSIZE)
+            if not block:
+                break
+            text = rest + block
+            cut = text.rfind("<")
+            text, rest = text[:cut], text[cut:]
+            for m in self._TOKEN.finditer(text):
+                yield m.group(1), m.group(2).upper(), m.group(3).strip()
+        for m in self._TOKEN.finditer(rest):
+            yield m.group(1), m.group(2).upper(), m.group(3).strip()
+
+    def __iter__(self) -> Iterator[Tuple]:
+        trn = None
+        for closing, name, value in self._tokens():
+            if name == "STMTTRN":
+                if not closing:
+                    trn = {}
+                    continue
+                if trn is not None:
+                    entry = self._entry(trn)
+                    if entry is None:
+                        self.rejected += 1
+                    else:
+                        yield entry
+                trn = None
+            elif trn is not None and not closing:
+                trn[name] = value
+
+    def _entry(self, trn: Dict[str, str]) -> Optional[Tuple]:
+        posted = trn.get("DTPOSTED", "")[:8]
+        opdate = None
+        if len(posted) == 8:
+            opdate = self._datestr(f"{posted[:4]}-{posted[4:6]}-{posted[6:]}")
+        try:
+            amount = _parse_amount(trn.get("TRNAMT", ""))
+        except ValueError:
+            return None
+        if opdate is None:
+            return None
+        descr = trn.get("NAME") or trn.get("MEMO") or "N/A"
+        return (opdate, self._tag, descr, amount)
+
+
+class QifReader(StatementReader):
+    """Read the transactions of a QIF statement.
+
+    Dates are read as month/day/year, with either ``/``, ``-`` or ``'``
+    separators and two or four digit years, unless a date format is given.
+    """
+
+    def _qif_datestr(self, value: str) -> Optional[str]:
+        if self._date_format:
+            return self._datestr(value)
+        parts = re.split(r"[/'\-.]", value.strip())
+        if len(parts) != 3:
+            return None
+        try:
+            month, day, year = (int(p) for p in parts)
+        except ValueError:
+            return None
+        if year < 100:
+            year += 2000 if year < 70 else 1900
+        return self._datestr(f"{year:04d}-{month:02d}-{day:02d}")
+
+    def __iter__(self) -> Iterator[Tuple]:
+        trn = {}
+        for line in self._fd:
+            code, value = line[:1], line[1:].rstrip("\r\n")
+            if code == "^":
+                if trn:
+                    entry = self._entry(trn)
+                    if entry is None:
+                        self.rejected += 1
+                    else:
+                        yield entry
+                trn = {}
+            elif code in "DTUPML" and code:
+                trn.setdefault(code, value)
+
+    def _entry(self, trn: Dict[str, str]) -> Optional[Tuple]:
+        opdate = self._qif_datestr(trn.get("D", ""))
+        try:
+            amount = _parse_amount(trn.get("T") or trn.get("U", ""))
+        except ValueError:
+            return None
+        if opdate is None:
+            return None
+        descr = trn.get("P") or trn.get("M") or "N/A"
+        return (opdate, trn.get("L") or self._tag, descr, amount)
+
+
+def make_reader(fd: TextIO, fmt: str = "csv", **kw) -> StatementReader:
+    """Return the statement reader for the given format."""
+    if fmt == "ofx":
+        kw.pop("fields", None)
+        kw.pop("delimiter", None)
+        return OfxReader(fd, **kw)
+    if fmt == "qif":
+        kw.pop("fields", None)
+        kw.pop("delimiter", None)
+        return QifReader(fd, **kw)
+    return CsvReader(fd, **kw)
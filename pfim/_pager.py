@@ -0,0 +1,94 @@
+"""A less-like pager over the pages of a report.
+
+`pfim -i report [OPTIONS]` shows a report a screenful at a time. Every
+screen is a keyset page, as read by report --limit and --after-cursor, so
+moving forward costs the same however deep the page is; the pages seen so
+far are kept to move back. While a page is on screen, the next one is read
+on a background thread.
+
+Commands, each followed by Enter:
+
+    Enter, n, f  next page
+    b, p         previous page
+    g            first page
+    q            quit
+"""
+
+import shutil
+import sys
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, TextIO, Union
+
+from .pfim import PfimCore, Report, _ListWriter
+
+# screen lines that are not entries: the table header and the prompt
+_CHROME = 2
+_MIN_PAGE = 5
+
+# the rendered lines of a page, and the cursor of the page after it
+Page = namedtuple("Page", "lines cursor")
+
+
+class ReportPager:
+    """Page through the report given by the options kw."""
+
+    def __init__(self, core: PfimCore, kw: Dict, pagesize: int = None,
+        stdin: TextIO = sys.stdin, stdout: TextIO = sys.stdout):
+        if pagesize is None:
+            pagesize = max(shutil.get_terminal_size().lines - _CHROME,
+                _MIN_PAGE)
+        self._core = core
+        self._kw = dict(kw, limitQuery=pagesize, outFormat="table")
+        self._stdin = stdin
+        self._stdout = stdout
+        self._color = stdout.isatty()
+        # pages are read one at a time, by the core on a thread of its own
+        self._reader = ThreadPoolExecutor(1, thread_name_prefix="pfim-pager")
+
+    def _load(self, cursor: Union[str, None]) -> Page:
+        self._core.report(dict(self._kw, cursorQuery=cursor))
+        output = self._core.make_output()
+        out: List[str] = []
+        Report("table", color=self._color,
+            balance=bool(self._kw.get("runningBalance"))).write_batches(
+            output.report, _ListWriter(out))
+        return Page("".join(out).splitlines(), self._core.cursor)
+
+    def _read(self, cursor: Union[str, None]) -> Future:
+        return self._reader.submit(self._load, cursor)
+
+    def run(self) -> int:
+        """Show pages until the user quits; return the number of pages
+        read."""
+        try:
+            pages = [self._read(self._kw.get("cursorQuery")).result()]
+            index, ahead = 0, None
+            while True:
+                page = pages[index]
+                self._stdout.write("\n".join(page.lines) + "\n")
+                last = index + 1 == len(pages)
+                if last and page.cursor is not None and ahead is None:
+                    # read on while this page is being looked at
+                    ahead = self._read(page.cursor)
+                end = last and page.cursor is None
+                self._stdout.write(f"-- page {index + 1}"
+                    + (" (END)" if end else "") + " -- ")
+                self._stdout.flush()
+                command = self._stdin.readline()
+                if not command or command.strip() == "q":
+                    return len(pages)
+                command = command.strip()
+                if command in ("", "n", "f"):
+                    if not last:
+                        index += 1
+                    elif ahead is not None:
+                        pages.append(ahead.result())
+                        ahead = None
+                        index += 1
+                elif command in ("b", "p"):
+                    index = max(index - 1, 0)
+                elif command == "g":
+                    index = 0
+        finally:
+            self._reader.shutdown()
@@ -0,0 +1,85 @@
+"""Parallel summaries: consecutive date ranges aggregated by worker processes.
+
+A report --summary-only --jobs N is split into chunks of consecutive
+dates, several per worker so that busy and quiet periods even out. Every
+chunk runs the summary statement of the serial path, bounded to its dates,
+in a ProcessPoolExecutor whose workers each hold a read-only connection of
+their own. The count/sum/min/max/sum of squares rows of the chunks are
+merged per group, as those of partitions are.
+
+Workers are spawned rather than forked: the parent runs threads (the log
+writer, the group commit writer of pfim serve) and holds connections,
+neither of which survives a fork.
+"""
+
+import multiprocessing
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, timedelta
+from typing import List, Sequence, Tuple
+
+from .pfim import PfimData, PfimQuery, _merge_summaries, _open_data
+
+# chunks per worker
+_CHUNKS_PER_JOB = 4
+
+# the read-only PfimData of a worker process
+_data = None
+
+
+def _init_worker(path: str) -> None:
+    global _data
+    _data = _open_data(path, readonly=True)
+
+
+def _aggregate(query: str, args: Tuple) -> Tuple[List[Tuple], float]:
+    start = time.perf_counter()
+    rows = _data._connect_for(query).execute(query, args).fetchall()
+    return rows, time.perf_counter() - start
+
+
+def date_chunks(first: str, last: str, count: int) -> List[Tuple[str, str]]:
+    """Split the dates first to last, both included, into count ranges.
+
+    The ranges are (first, last) YYYY-MM-DD pairs of about the same number
+    of days; there are fewer of them when there are fewer days.
+    """
+    start, end = date.fromisoformat(first), date.fromisoformat(last)
+    step = -(-((end - start).days + 1) // count)
+    chunks = []
+    while start <= end:
+        stop = min(start + timedelta(days=step - 1), end)
+        chunks.append((start.isoformat(), stop.isoformat()))
+        start = stop + timedelta(days=1)
+    return chunks
+
+
+def parallel_summary(data: PfimData, parts: Sequence[PfimQuery],
+    jobs: int) -> List[Tuple]:
+    """Run summary statements on jobs processes and merge their rows.
+
+    The statements are reported to the hooks of data with the time they
+    took in their worker.
+    """
+    # bounded to a date range, a summary grouped by tag is only as fast
+    # per row as the serial one with the planner statistics
+    data.analyze()
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(min(jobs, len(parts)), mp_context=context,
+            initializer=_init_worker, initargs=(data.path,)) as pool:
+            futures = [pool.submit(_aggregate, part.query, part.args)
+                for part in parts]
+            results = []
+            for part, future in zip(parts, futures):
+                rows, seconds = future.result()
+                if data._hooks:
+                    data._emit(part.query, part.args, seconds, len(rows))
+                results.append(rows)
+    except (sqlite3.Error, BrokenProcessPool) as err:
+        data._logger.error(f"Failed to fetch data from database. {err}")
+        sys.exit(1)
+    return _merge_summaries(results)
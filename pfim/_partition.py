@@ -0,0 +1,394 @@
+"""Year-partitioned storage: one database file per year.
+
+A partitioned ledger is a directory holding a pfim-YYYY.db for every year
+with entries. Each is a regular pfim database, with its own indexes,
+monthly rollup, full-text index and tag dictionary: tag ids differ from
+one year to the next, and statements join each partition's ledger with
+its own dictionary. A closed year can be archived: its
+file is compacted into a read-only pfim-YYYY.archive.db.
+
+Reads ATTACH the partitions they need and read the union of their tables
+in one statement. The report compiler only names the partitions that
+overlap the dates of a report (see PfimData.sources), so a report on one
+year never opens the files of the others. SQLite attaches at most 10
+databases to a connection: years are grouped by decade, each decade has
+a connection of its own, and a report spanning decades runs one statement
+per decade whose rows PfimCore merges.
+
+Writes go to the partition of the entry's year, through a PfimData of its
+own.
+"""
+
+import functools
+import os
+import re
+import shutil
+import sqlite3
+import sys
+from datetime import date
+from typing import Dict, Iterable, List, Tuple, Union
+from urllib.parse import quote
+
+from .pfim import _CHUNK_SIZE, _INSERT_SQL, _SCHEMA, PfimData, _has_fts5
+
+_PARTITION_FILE = "pfim-{year}.db"
+_ARCHIVE_FILE = "pfim-{year}.archive.db"
+_PARTITION_RE = re.compile(r"pfim-(\d{4})(\.archive)?\.db$")
+_SCHEMA_RE = re.compile(r"\by(\d{4})\.")
+# years per connection, SQLite's default limit of attached databases
+_BLOCK_YEARS = 10
+_PARTITION_CACHE = "-16384"
+
+
+def _year(day: Union[str, date, int]) -> int:
+    # the year of a YYYY-MM-DD date, a date or a year
+    return day if isinstance(day, int) else int(str(day)[:4])
+
+
+def _schema(year: int) -> str:
+    return f"y{year}"
+
+
+@functools.lru_cache(maxsize=256)
+def _query_years(query: str) -> Tuple[int, ...]:
+    # the partitions a compiled statement reads
+    return tuple(sorted({int(year) for year in _SCHEMA_RE.findall(query)}))
+
+
+class PartitionedPfimData(PfimData):
+    """PFIM database interface over a directory of yearly databases.
+
+    Statements compiled by PfimCore for partitions name them as yYYYY
+    schemas. They run on the connection of the partitions' decade, which
+    attaches them on first use; archives are attached read-only and
+    immutable, so reading them takes no lock. Statements that name no
+    partition run on a connection with nothing attached.
+    """
+
+    partitioned = True
+
+    def __init__(self, root: str, readonly: bool = False):
+        self._root = root
+        # directory mtime and {year: (path, archived)} as last listed
+        self._listing = (None, {})
+        self._stores: Dict[int, PfimData] = {}
+        super().__init__(":memory:", readonly)
+
+    def _migrate(self) -> None:
+        # every partition is migrated by its own PfimData
+        if not os.path.isdir(self._root):
+            self._logger.error(f"No partitioned ledger in {self._root}")
+            sys.exit(1)
+
+    def years(self) -> Dict[int, Tuple[str, bool]]:
+        """Return {year: (path, archived)} for every partition."""
+        mtime = os.stat(self._root).st_mtime_ns
+        if self._listing[0] != mtime:
+            years = {}
+            for name in os.listdir(self._root):
+                match = _PARTITION_RE.match(name)
+                if match is None:
+                    continue
+                year, archived = int(match.group(1)), bool(match.group(2))
+                # while a year is being archived both files exist, and the
+                # archive is complete once it has its final name
+                if archived or year not in years:
+                    years[year] = (os.path.join(self._root, name), archived)
+            self._listing = (mtime, years)
+        return self._listing[1]
+
+    def _span(self, first: str = None, last: str = None) -> List[int]:
+        low = _year(first) if first is not None else 0
+        high = _year(last) if last is not None else 9999
+        return [year for year in sorted(self.years()) if low <= year <= high]
+
+    @property
+    def path(self) -> str:
+        return self._root
+
+    def files(self) -> List[Tuple[str, bool]]:
+        return [self.years()[year] for year in sorted(self.years())]
+
+    def date_span(self) -> Tuple[Union[str, None], Union[str, None]]:
+        # the bounds of the years, which is all a chunked read needs
+        years = self._span()
+        if not years:
+            return None, None
+        return f"{years[0]}-01-01", f"{years[-1]}-12-31"
+
+    def sources(self, first: str = None, last: str = None
+        ) -> List[Tuple[str, ...]]:
+        blocks = {}
+        for year in self._span(first, last):
+            blocks.setdefault(year // _BLOCK_YEARS, []).append(_schema(year))
+        return [tuple(schemas) for _, schemas in sorted(blocks.items())]
+
+    def _connect_for(self, query: str) -> sqlite3.Connection:
+        years = _query_years(query)
+        if not years:
+            return self._connect()
+        blocks = getattr(self._local, "blocks", None)
+        if blocks is None:
+            blocks = self._local.blocks = {}
+        block = years[0] // _BLOCK_YEARS
+        if block not in blocks:
+            blocks[block] = (self._open(":memory:", uri=True), {})
+        conn, attached = blocks[block]
+        partitions = self.years()
+        for year in years:
+            schema = _schema(year)
+            path, archived = partitions.get(year, (None, False))
+            if path is None or attached.get(schema) == path:
+                continue
+            # the year has been archived since it was attached
+            if schema in attached:
+                conn.execute(f"DETACH DATABASE {schema}")
+                del attached[schema]
+            uri = "file:" + quote(path)
+            if archived:
+                uri += "?mode=ro&immutable=1"
+            elif self.readonly:
+                uri += "?mode=ro"
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (uri,))
+            conn.execute(f"PRAGMA {schema}.cache_size={_PARTITION_CACHE}")
+            attached[schema] = path
+            version = conn.execute(
+                f"PRAGMA {schema}.user_version").fetchone()[0]
+            if version < len(_SCHEMA):
+                self._upgrade(year, path, archived)
+        return conn
+
+    def _upgrade(self, year: int, path: str, archived: bool) -> None:
+        # a partition only written to by an older pfim is migrated by
+        # opening it; an archive can not be
+        if archived or self.readonly:
+            self._logger.error(f"{path} has an outdated schema. "
+                + (f"Rename it to {_PARTITION_FILE.format(year=year)}, make "
+                    "it writable and open it once to upgrade it"
+                    if archived else "Open it read-write once to upgrade it"))
+            sys.exit(1)
+        self.store(year)
+
+    def data_version(self) -> Tuple:
+        # the partitions attached by this thread, and the directory, whose
+        # mtime moves when a year is added or archived
+        stamp = [os.stat(self._root).st_mtime_ns]
+        for conn, attached in getattr(self._local, "blocks", {}).values():
+            for schema in attached:
+                stamp.append((id(conn), schema, conn.execute(
+                    f"PRAGMA {schema}.data_version").fetchone()[0]))
+        return tuple(stamp)
+
+    def store(self, day: Union[str, date, int]) -> PfimData:
+        year = _year(day)
+        path, archived = self.years().get(year, (None, False))
+        if archived:
+            stale = self._stores.pop(year, None)
+            if stale is not None:
+                stale.close()
+            self._logger.error(f"{year} is archived, its entries are read-only")
+            sys.exit(1)
+        data = self._stores.get(year)
+        if data is None:
+            with self._lock:
+                data = self._stores.get(year)
+                if data is None:
+                    data = PfimData(path or os.path.join(self._root,
+                        _PARTITION_FILE.format(year=year)))
+                    # statements of the partitions reach our hooks
+                    data._hooks = self._hooks
+                    data.slow_query = self.slow_query
+                    self._stores[year] = data
+        return data
+
+    def stores(self, first: str = None, last: str = None) -> List[PfimData]:
+        partitions = self.years()
+        archived = self.archived(first, last)
+        if archived:
+            self._logger.warning("Archived years are read-only, left "
+                f"untouched: {', '.join(map(str, archived))}")
+        return [self.store(year) for year in self._span(first, last)
+            if not partitions[year][1]]
+
+    def archived(self, first: str = None, last: str = None) -> List[int]:
+        partitions = self.years()
+        return [year for year in self._span(first, last)
+            if partitions[year][1]]
+
+    def has_search(self) -> bool:
+        # every partition is created by the same migrations
+        if self._search is None:
+            self._search = _has_fts5()
+        return self._search
+
+    def add_entry(self, query: str, *args) -> None:
+        # the first value of an entry is its date
+        self.store(args[0]).add_entry(query, *args)
+
+    def add_entries(self, query: str, rows: Iterable,
+        chunksize: int = _CHUNK_SIZE) -> int:
+        """Insert rows into the partitions of their year.
+
+        The first value of a row is its date. Rows are buffered per year
+        and written once chunksize of them are pending, so memory stays
+        bounded whatever the order of the rows. Returns the number of
+        inserted rows.
+        """
+        pending: Dict[int, List] = {}
+        count = npending = 0
+        for row in rows:
+            pending.setdefault(_year(row[0]), []).append(row)
+            npending += 1
+            if npending >= chunksize:
+                count += self._flush(query, pending, chunksize)
+                npending = 0
+        return count + self._flush(query, pending, chunksize)
+
+    def _flush(self, query: str, pending: Dict[int, List],
+        chunksize: int) -> int:
+        count = sum(self.store(year).add_entries(query, rows, chunksize)
+            for year, rows in sorted(pending.items()))
+        pending.clear()
+        return count
+
+    def update(self, query: str, *args) -> int:
+        """Run an update on every writable partition."""
+        return sum(data.update(query, *args) for data in self.stores())
+
+    def delete(self, query: str, *args) -> int:
+        """Run a delete on every writable partition."""
+        return sum(data.delete(query, *args) for data in self.stores())
+
+    def rebuild_rollups(self) -> int:
+        return sum(data.rebuild_rollups() for data in self.stores())
+
+    def check_rollups(self, tolerance: float = 1e-6) -> List[Tuple]:
+        return [key for data in self.stores()
+            for key in data.check_rollups(tolerance)]
+
+    def rebuild_balances(self) -> int:
+        return sum(data.rebuild_balances() for data in self.stores())
+
+    def check_balances(self, tolerance: float = 1e-6) -> List[str]:
+        return [day for data in self.stores()
+            for day in data.check_balances(tolerance)]
+
+    def rebuild_search(self) -> int:
+        return sum(data.rebuild_search() for data in self.stores())
+
+    def check_search(self) -> bool:
+        return all(data.check_search() for data in self.stores())
+
+    def analyze(self) -> None:
+        # archives are analyzed when they are made
+        for year, (_, archived) in sorted(self.years().items()):
+            if not archived:
+                self.store(year).analyze()
+
+    def count(self, year: int) -> int:
+        """Return the number of entries of a year."""
+        return next(self.fetch(
+            f"SELECT count(*) FROM {_schema(year)}.pfim"))[0]
+
+    def archive(self, year: int) -> str:
+        """Compact a closed year into a read-only archive and return its path.
+
+        The archive is a VACUUM INTO copy of the partition, after its
+        full-text index has been merged into one segment and its tables
+        analyzed: defragmented, with every index, in rollback journal mode
+        so that it opens read-only. The live file is removed once the
+        archive has passed an integrity check.
+        """
+        path, archived = self.years().get(year, (None, False))
+        if archived:
+            return path
+        if path is None:
+            self._logger.error(f"No entries in {year}, nothing to archive")
+            sys.exit(1)
+        if year >= date.today().year:
+            self._logger.error(f"Only closed years can be archived, {year} "
+                "is not over")
+            sys.exit(1)
+        target = os.path.join(self._root, _ARCHIVE_FILE.format(year=year))
+        partial = target + ".partial"
+        data = self.store(year)
+        conn = data._connect()
+        lock = sqlite3.connect(path, isolation_level=None)
+        try:
+            lock.execute("BEGIN IMMEDIATE")
+            if data.has_search():
+                lock.execute(
+                    "INSERT INTO pfim_fts(pfim_fts) VALUES ('optimize')")
+            lock.execute("ANALYZE")
+            lock.execute("COMMIT")
+            # keep the write lock while copying, so that no entry is added
+            # to the year behind the archive's back
+            lock.execute("BEGIN IMMEDIATE")
+            if os.path.exists(partial):
+                os.remove(partial)
+            conn.execute("VACUUM INTO ?", (partial,))
+            copy = sqlite3.connect(partial, isolation_level=None)
+            try:
+                copy.execute("PRAGMA journal_mode=DELETE")
+                status = copy.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                copy.close()
+            if status != "ok":
+                raise sqlite3.DatabaseError(f"integrity check: {status}")
+            os.chmod(partial, 0o444)
+            os.replace(partial, target)
+        except (sqlite3.Error, OSError) as err:
+            self._logger.error(f"Failed to archive {year}. {err}")
+            sys.exit(1)
+        finally:
+            lock.close()
+        # the archive now shadows the live file
+        self._stores.pop(year).close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        self._logger.debug(f"Archived {year} into {target}")
+        return target
+
+    def close(self) -> None:
+        with self._lock:
+            stores, self._stores = list(self._stores.values()), {}
+        for data in stores:
+            data.close()
+        super().close()
+
+
+def partition_ledger(source: PfimData, root: str,
+    chunksize: int = _CHUNK_SIZE) -> Dict[int, int]:
+    """Stream the entries of a single-file ledger into yearly databases.
+
+    The partitions are written to root.partial, which becomes root once
+    every entry has been copied, so an interrupted migration leaves the
+    ledger as it was. Returns the number of entries per year.
+    """
+    logger = source._logger
+    if os.path.exists(root):
+        logger.error(f"{root} already exists")
+        sys.exit(1)
+    partial = root + ".partial"
+    # left over by an interrupted migration
+    if os.path.isdir(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+    expected = next(source.fetch("SELECT count(*) FROM pfim"))[0]
+    target = PartitionedPfimData(partial)
+    try:
+        count = target.add_entries(_INSERT_SQL, source.fetch(
+            "SELECT opdate, tag, description, amount FROM pfim "
+            "LEFT JOIN tags USING (tag_id) ORDER BY id"),
+            chunksize)
+        counts = {year: target.count(year) for year in target.years()}
+    finally:
+        target.close()
+    if count != expected or sum(counts.values()) != expected:
+        logger.error(f"Copied {count} of {expected} entries, "
+            f"the partitions are left in {partial}")
+        sys.exit(1)
+    os.rename(partial, root)
+    logger.debug(f"Partitioned {count} entries into {root}")
+    return counts
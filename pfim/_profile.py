@@ -0,0 +1,69 @@
+"""Per-statement timing breakdown for --profile."""
+
+import threading
+from typing import Dict, List, TextIO
+
+from .pfim import QueryStats
+
+_TEXT_WIDTH = 60
+
+
+def _oneline(query: str) -> str:
+    return " ".join(query.split())
+
+
+class QueryProfile:
+    """Collect the QueryStats of a PfimData into a timing breakdown.
+
+    An instance is a hook: data.add_hook(profile). Statements are grouped
+    by their text, so the same statement run with different arguments
+    adds up in one line.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # statement -> [calls, seconds, rows, slowest call]
+        self.statements: Dict[str, List] = {}
+        self.slow: List[QueryStats] = []
+
+    def __call__(self, stats: QueryStats) -> None:
+        with self._lock:
+            entry = self.statements.setdefault(stats.query, [0, 0.0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += stats.seconds
+            entry[2] += max(stats.rows, 0)
+            entry[3] = max(entry[3], stats.seconds)
+            if stats.plan is not None:
+                self.slow.append(stats)
+
+    @property
+    def seconds(self) -> float:
+        return sum(entry[1] for entry in self.statements.values())
+
+    def write(self, file: TextIO, elapsed: float = None,
+        slow_query: float = None) -> None:
+        """Print the breakdown, most expensive statements first."""
+        total = self.seconds
+        calls = sum(entry[0] for entry in self.statements.values())
+        line = f"PROFILE: {calls} statements, {total:.3f}s in SQLite"
+        if elapsed is not None:
+            line += f" of {elapsed:.3f}s"
+        print(line, file=file)
+        print(f"{'calls':>8} {'total':>10} {'max':>10} {'rows':>10}  statement",
+            file=file)
+        for query, (count, seconds, rows, slowest) in sorted(
+            self.statements.items(), key=lambda item: -item[1][1]):
+            text = _oneline(query)
+            if len(text) > _TEXT_WIDTH:
+                text = text[:_TEXT_WIDTH - 3] + "..."
+            print(f"{count:8d} {seconds:9.3f}s {slowest:9.3f}s {rows:10d}  "
+                f"{text}", file=file)
+        if self.slow:
+            limit = f" (>= {slow_query:.3f}s)" if slow_query is not None else ""
+            print(f"SLOW STATEMENTS{limit}", file=file)
+            for stats in sorted(self.slow, key=lambda s: -s.seconds):
+                print(f"  {stats.seconds:.3f}s {stats.rows} rows  "
+                    f"{_oneline(stats.query)}", file=file)
+                print(f"    args: {stats.args!r}", file=file)
+                for detail in stats.plan:
+                    print(f"    {detail}", file=file)
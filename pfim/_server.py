@@ -0,0 +1,202 @@
+"""`pfim serve`: a long-running pfim reachable over a Unix socket.
+
+The server keeps a warm PfimData (open connections, page cache, compiled
+statements) and runs the commands that `pfim` invocations forward to it.
+Writes from concurrent clients go through a GroupCommitWriter.
+
+Protocol: the client sends one JSON line ``{"argv": [...], "tty": bool}``
+and the server answers with frames made of a one byte type, a four byte
+big-endian length and a payload: ``o`` for standard output, ``e`` for
+standard error and ``x`` for the exit status, which ends the exchange.
+"""
+
+import os
+import socket
+import struct
+import sys
+from typing import List, Optional
+
+_HEADER = struct.Struct(">cI")
+_OUT, _ERR, _EXIT = b"o", b"e", b"x"
+# requests run on this many long-lived threads, each keeping its PfimCore
+# and its connections from one request to the next
+_WORKERS = 16
+
+
+def _socket_path() -> str:
+    return os.environ.get("PFIM_SOCKET") or os.path.join(
+        os.environ["HOME"], ".pfim.sock")
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("pfim server closed the connection")
+        data += chunk
+    return data
+
+
+def forward(argv: List[str], path: Optional[str] = None) -> Optional[int]:
+    """Run argv on a running pfim server.
+
+    Returns the exit status of the command, or None when no server is
+    listening, in which case the caller runs the command itself.
+    """
+    import json
+    path = path or _socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        request = {"argv": argv, "tty": sys.stdout.isatty()}
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        while True:
+            kind, size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+            payload = _recv_exactly(sock, size)
+            if kind == _EXIT:
+                return int(payload)
+            stream = sys.stdout if kind == _OUT else sys.stderr
+            stream.write(payload.decode())
+            stream.flush()
+
+
+class _FrameWriter:
+    """File-like object sending what is written as frames of one kind."""
+
+    def __init__(self, sock: socket.socket, kind: bytes, tty: bool = False):
+        self._sock = sock
+        self._kind = kind
+        self._tty = tty
+
+    def write(self, text: str) -> int:
+        data = text.encode()
+        if data:
+            self._sock.sendall(_HEADER.pack(self._kind, len(data)) + data)
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def isatty(self) -> bool:
+        return self._tty
+
+
+def serve(path: Optional[str] = None, dbname: Optional[str] = None) -> None:
+    """Run a pfim server on the Unix socket path until interrupted."""
+    import json
+    import logging
+    import signal
+    import socketserver
+    import threading
+    from queue import SimpleQueue
+    from datetime import date
+    from functools import lru_cache
+    from ._cmd_parser import _cmd_parser
+    from .pfim import _DBNAME, GroupCommitWriter, PfimCore, _open_data
+
+    # the parser is rebuilt when the day changes, so that the default
+    # record date stays current
+    _parser = lru_cache(maxsize=1)(lambda day: _cmd_parser())
+
+    path = path or _socket_path()
+    logger = logging.getLogger("pfim.PfimServer")
+    data = _open_data(dbname or _DBNAME)
+    writer = GroupCommitWriter(data)
+    local = threading.local()
+
+    class _ClientLogHandler(logging.Handler):
+        # errors logged while a request runs go back to its client
+        def emit(self, record):
+            stderr = getattr(local, "stderr", None)
+            if stderr is not None:
+                stderr.write(self.format(record) + "\n")
+
+    errhandler = _ClientLogHandler(logging.ERROR)
+    logging.getLogger("pfim").addHandler(errhandler)
+
+    class _Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                # forward_probe() connects and sends nothing
+                return
+            request = json.loads(line)
+            stdout = _FrameWriter(self.connection, _OUT, request.get("tty"))
+            local.stderr = _FrameWriter(self.connection, _ERR)
+            if not hasattr(local, "core"):
+                local.core = PfimCore(data=data, writer=writer)
+            try:
+                args = _parser(date.today()).parse_args(request["argv"])
+                status = local.core.execute(vars(args), stdout,
+                    local.stderr)
+            except SystemExit as exc:
+                status = exc.code if isinstance(exc.code, int) else 1
+            except Exception as exc:
+                logger.exception(f"Request failed. {exc}")
+                status = 1
+            finally:
+                local.stderr = None
+            payload = str(status).encode()
+            self.connection.sendall(
+                _HEADER.pack(_EXIT, len(payload)) + payload)
+
+    pending = SimpleQueue()
+
+    class _Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        # requests queue up for the workers instead of getting a thread,
+        # and a connection to the database, each
+        def process_request(self, request, client_address):
+            pending.put((request, client_address))
+
+    def work():
+        while True:
+            server.process_request_thread(*pending.get())
+
+    if os.path.exists(path):
+        if forward_probe(path):
+            logger.error(f"A pfim server is already listening on {path}")
+            sys.exit(1)
+        os.unlink(path)
+    # the socket is created private: a chmod after bind() would leave
+    # other users a moment to connect
+    mask = os.umask(0o177)
+    try:
+        server = _Server(path, _Handler)
+    finally:
+        os.umask(mask)
+    for i in range(_WORKERS):
+        threading.Thread(target=work, name=f"pfim-server-{i}",
+            daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.debug(f"Serving on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        writer.close()
+        data.close()
+        logging.getLogger("pfim").removeHandler(errhandler)
+
+
+def forward_probe(path: str) -> bool:
+    """Return True if a server accepts connections on path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
@@ -0,0 +1,213 @@
+"""Single-pass, mergeable summary statistics."""
+
+import math
+from typing import Dict, Iterable, List, Optional
+
+# number of values kept for exact quantiles before switching to the sketch
+_EXACT_LIMIT = 100000
+_SKETCH_ACCURACY = 0.005
+_ZERO = 1e-12
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch with relative accuracy guarantees.
+
+    Values are counted in logarithmically sized buckets (as in DDSketch),
+    so any quantile is returned within ``relative_accuracy`` of the true
+    value and two sketches merge by adding their bucket counts.
+    """
+
+    def __init__(self, relative_accuracy: float = _SKETCH_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._lngamma = math.log(self._gamma)
+        self._pos: Dict[int, int] = {}
+        self._neg: Dict[int, int] = {}
+        self._zero = 0
+        self.count = 0
+
+    def _key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._lngamma)
+
+    def _value(self, key: int) -> float:
+        return 2 * self._gamma ** key / (self._gamma + 1)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value > _ZERO:
+            key = self._key(value)
+            self._pos[key] = self._pos.get(key, 0) + 1
+        elif value < -_ZERO:
+            key = self._key(-value)
+            self._neg[key] = self._neg.get(key, 0) + 1
+        else:
+            self._zero += 1
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches of different accuracy")
+        for mine, theirs in ((self._pos, other._pos), (self._neg, other._neg)):
+            for key, count in theirs.items():
+                mine[key] = mine.get(key, 0) + count
+        self._zero += other._zero
+        self.count += other.count
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self._neg, reverse=True):
+            seen += self._neg[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self._zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self._pos):
+            seen += self._pos[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self._pos)) if self._pos else 0.0
+
+
+class StreamingStats:
+    """Count, extrema, mean, variance and quantiles in one pass.
+
+    Mean and variance use Welford's update and Chan's formula to merge two
+    accumulators, so partial results computed separately (for example for
+    different date ranges) combine exactly. Quantiles are exact while at
+    most ``exact_limit`` values have been seen, and come from a
+    QuantileSketch beyond that.
+    """
+
+    def __init__(self, exact_limit: int = _EXACT_LIMIT):
+        self.exact_limit = exact_limit
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self._m2 = 0.0
+        self._values: Optional[List[float]] = []
+        self._sorted = True
+        self._sketch: Optional[QuantileSketch] = None
+
+    @classmethod
+    def from_moments(cls, count: int, total: float, minimum: float,
+        maximum: float, m2: float) -> "StreamingStats":
+        """Build an accumulator from precomputed moments.
+
+        m2 is the sum of squared deviations from the mean.
+
+        It has no quantile data: quantile() returns None, and so does the
+        result of merging it with any other accumulator.
+        """
+        stats = cls()
+        stats.count = count
+        stats.total = total
+        stats.min = minimum
+        stats.max = maximum
+        stats.mean = total / count if count else 0.0
+        stats._m2 = max(m2, 0.0)
+        stats._values = None
+        return stats
+
+    @property
+    def has_quantiles(self) -> bool:
+        return self._values is not None or self._sketch is not None
+
+    def _to_sketch(self) -> None:
+        self._sketch = QuantileSketch()
+        for value in self._values:
+            self._sketch.add(value)
+        self._values = None
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self._values is not None:
+            self._values.append(value)
+            self._sorted = False
+            if self.count > self.exact_limit:
+                self._to_sketch()
+        elif self._sketch is not None:
+            self._sketch.add(value)
+
+    def update(self, values: Iterable[float]) -> "StreamingStats":
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other: "StreamingStats") -> "StreamingStats":
+        if not other.count:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.total += other.total
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if not (self.has_quantiles and other.has_quantiles):
+            self._values = self._sketch = None
+            return self
+        if self._values is not None and other._values is not None \
+            and count <= self.exact_limit:
+            self._values.extend(other._values)
+            self._sorted = False
+            return self
+        if self._values is not None:
+            self._to_sketch()
+        if other._values is not None:
+            for value in other._values:
+                self._sketch.add(value)
+        else:
+            self._sketch.merge(other._sketch)
+        return self
+
+    @property
+    def exact(self) -> bool:
+        return self._values is not None
+
+    @property
+    def variance(self) -> Optional[float]:
+        """Sample variance, 0.0 for a single value."""
+        if not self.count:
+            return None
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def stdev(self) -> Optional[float]:
+        variance = self.variance
+        return None if variance is None else math.sqrt(variance)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the q-quantile (0 <= q <= 1) of the values seen so far."""
+        if not 0 <= q <= 1:
+            raise ValueError("q must be between 0 and 1")
+        if not self.count or not self.has_quantiles:
+            return None
+        if self._values is None:
+            return self._sketch.quantile(q)
+        if not self._sorted:
+            self._values.sort()
+            self._sorted = True
+        pos = q * (self.count - 1)
+        lo = math.floor(pos)
+        hi = min(lo + 1, self.count - 1)
+        frac = pos - lo
+        return self._values[lo] + (self._values[hi] - self._values[lo]) * frac
+
+    @property
+    def median(self) -> Optional[float]:
+        return self.quantile(0.5)
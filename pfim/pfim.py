@@ -1,41 +1,472 @@
 """PFIM: Personal Finance Manager"""
 
 import os
-from queue import Queue
+from queue import Queue, SimpleQueue
 import sys
 import sqlite3
 import logging
-import statistics
 import functools
+import heapq
+import itertools
+import threading
+import time
+from array import array
 from datetime import date, timedelta
+from urllib.parse import quote
 from enum import Enum, auto
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
-from typing import List, Dict, Callable, Generator, Mapping, Union
+from ._stats import StreamingStats
+
+from typing import (List, Dict, Callable, Generator, Iterable, Mapping,
+    Sequence, Tuple, Union)
 
 ## -- set up a logger for the application
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-_filehandler = logging.FileHandler(
-    os.path.join(os.environ["HOME"], ".pfim.log"))
-_filehandler.setLevel(logging.DEBUG)
-_consolehandler = logging.StreamHandler()
-_consolehandler.setLevel(logging.ERROR)
-_formatter = logging.Formatter(
-    "[%(asctime)s]::%(name)s::%(message)s")
-_filehandler.setFormatter(_formatter)
-_consolehandler.setFormatter(_formatter)
+_logging_ready = False
+_LOG_INTERVAL = 0.05
+
+
+class _QueueHandler(logging.Handler):
+    """Hand log records over to a _LogWriter thread."""
+
+    def __init__(self, queue: SimpleQueue):
+        super().__init__()
+        self._queue = queue
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # render the message now, its arguments may change afterwards
+        record.msg = record.getMessage()
+        record.args = None
+        self._queue.put(record)
+
+
+class _LogWriter(threading.Thread):
+    """Pass queued log records to the handlers from a background thread.
+
+    This is logging.handlers.QueueListener without the cost of importing
+    logging.handlers, and it picks records up in bursts: once the queue is
+    drained it waits _LOG_INTERVAL seconds, or until it is stopped, before
+    blocking again. Waking up for every record would cost the logging
+    thread about as much as writing the record itself.
+    """
+
+    def __init__(self, queue: SimpleQueue, *handlers: logging.Handler):
+        super().__init__(name="pfim-log", daemon=True)
+        self._queue = queue
+        self._handlers = handlers
+        self._stopping = threading.Event()
+
+    def run(self) -> None:
+        while True:
+            if self._queue.empty():
+                self._stopping.wait(_LOG_INTERVAL)
+            record = self._queue.get()
+            if record is None:
+                break
+            for handler in self._handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._queue.put(None)
+        self.join()
+
+
+def _setup_logging() -> None:
+    """Attach the log file and console handlers to the pfim loggers.
+
+    This runs when the database is first opened rather than at import,
+    so that commands which never touch the database do not pay for it.
+    """
+    global _logging_ready
+    if _logging_ready:
+        return
+    _logging_ready = True
+    _filehandler = logging.FileHandler(
+        os.path.join(os.environ["HOME"], ".pfim.log"), delay=True)
+    _filehandler.setLevel(logging.DEBUG)
+    _consolehandler = logging.StreamHandler()
+    _consolehandler.setLevel(logging.ERROR)
+    _formatter = logging.Formatter(
+        "[%(asctime)s]::%(name)s::%(message)s")
+    _filehandler.setFormatter(_formatter)
+    _consolehandler.setFormatter(_formatter)
+    # the handlers run on a listener thread: logging a statement costs a
+    # queue put, not a file write
+    import atexit
+    queue = SimpleQueue()
+    writer = _LogWriter(queue, _filehandler, _consolehandler)
+    pfimlogger = logging.getLogger("pfim")
+    pfimlogger.setLevel(logging.DEBUG)
+    pfimlogger.addHandler(_QueueHandler(queue))
+    writer.start()
+    atexit.register(writer.stop)
 
 
 # Global Constants and Structures
 PfimEntry = namedtuple("PfimEntry", "date tag description amount")
 PfimOutput = namedtuple("PfimOutput", "report summary")
 PfimQuery = namedtuple("PfimQuery", "query args")
+QueryStats = namedtuple("QueryStats", "query args seconds rows plan")
 
 _DBNAME = os.path.join(os.environ["HOME"], ".pfimdata.db")
+# once it exists, the ledger is kept there as one database per year; or
+# in the directory named by _PARTITION_LINK, when 'pfim partition --dir'
+# has put it elsewhere
+_PARTITION_DIR = os.path.join(os.environ["HOME"], ".pfimdata.d")
+_PARTITION_LINK = os.path.join(os.environ["HOME"], ".pfimdata.dir")
+_ARCHIVES_READ_ONLY = ("Archives are read-only, rename one to its partition "
+    "file and make it writable to change it")
 _EARN_KIND = "E"
 _SPENT_KIND = "S"
 
+# ---- CONNECTION SETTINGS ----
+_STMT_CACHE_SIZE = 256
+_CHUNK_SIZE = 10000
+# rows sampled per index by ANALYZE
+_ANALYSIS_LIMIT = 1000
+_GROUP_COMMIT_MAX = 1000
+# seconds a statement waits for another connection's lock; a write still
+# locked out after that is tried again up to _WRITE_RETRIES times, after a
+# random delay of up to _RETRY_BACKOFF seconds doubling with each attempt
+# up to _RETRY_BACKOFF_MAX
+_BUSY_TIMEOUT = 5.0
+_WRITE_RETRIES = 5
+_RETRY_BACKOFF = 0.05
+_RETRY_BACKOFF_MAX = 2.0
+# primary result codes of a lock held by another connection
+_SQLITE_BUSY = 5
+_SQLITE_LOCKED = 6
+
+# ---- PROFILING ----
+_SLOW_QUERY = 0.1
+_PROFILE_BATCH = 256
+
+# ---- RESULT CACHE ----
+_CACHE_SIZE = 64
+_CACHE_BYTES = 32 << 20
+# rough size of a cached summary, and of an entry of a cached
+# PfimEntryBatch besides its description
+_CACHE_ROW_BYTES = 256
+_BATCH_ROW_BYTES = 24
+
+# ---- REPORT RENDERING ----
+_REPORT_SAMPLE = 1000
+_REPORT_CHUNK = 4096
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16384",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Amounts are signed: expenses are stored negative and incomes positive,
+# and the kind column mirrors the sign. The tag is given by its id in the
+# tags dictionary, see PfimData.tag_ids().
+_INSERT_SQL = ("INSERT INTO pfim(opdate, tag_id, description, amount, kind) "
+    f"VALUES (?1, ?2, ?3, ?4, CASE WHEN ?4 < 0 THEN '{_SPENT_KIND}' "
+    f"ELSE '{_EARN_KIND}' END)")
+
+# update options: the column they change and how their old and new values
+# are stored. kind follows from the sign, which an update keeps.
+_UPDATE_OPTIONS = (
+    ("upExpense", "amount", lambda value: -abs(float(value))),
+    ("upIncome", "amount", lambda value: abs(float(value))),
+    ("upTag", "tag_id", str),
+    ("upDescr", "description", str),
+)
+_UPDATE_SQL = "UPDATE pfim SET {column} = ? WHERE opdate = ? AND {column} = ?"
+# delete options that are plain comparisons: option, column, operator
+_DELETE_FILTERS = (
+    ("rmDate", "opdate", "="),
+    ("rmTag", "tag_id", "="),
+    ("rmBDate", "opdate", "<"),
+    ("rmADate", "opdate", ">"),
+)
+_DELETE_DATES = ("rmDate", "rmBDate", "rmADate")
+
+# ---- MONTHLY ROLLUP ----
+# pfim_rollup keeps count/sum/sum of squares/min/max of amount per
+# (month, tag, kind). Triggers on pfim keep it current; min and max are
+# recomputed from the month's rows when the removed amount was an extreme.
+# The statements are templates of the tag column, {key}, and of its value
+# for entries without a tag, {blank}: the rollup was keyed by the tag
+# itself until the tag dictionary came in, and is now keyed by its id.
+_ROLLUP_TAG = {"key": "tag", "keytype": "TEXT", "blank": "''"}
+_ROLLUP_KEY = {"key": "tag_id", "keytype": "INTEGER", "blank": "0"}
+_ROLLUP_ADD = """INSERT INTO pfim_rollup(month, {key}, kind, cnt, total,
+        sumsq, minval, maxval)
+    VALUES (substr({row}.opdate, 1, 7), coalesce({row}.{key}, {blank}),
+        {row}.kind, 1, {row}.amount, {row}.amount * {row}.amount,
+        {row}.amount, {row}.amount)
+    ON CONFLICT(month, {key}, kind) DO UPDATE SET
+        cnt = cnt + 1,
+        total = total + excluded.total,
+        sumsq = sumsq + excluded.sumsq,
+        minval = min(minval, excluded.minval),
+        maxval = max(maxval, excluded.maxval);"""
+_ROLLUP_MONTH_ROWS = """FROM pfim WHERE {key} IS {row}.{key}
+            AND kind = {row}.kind
+            AND opdate >= substr({row}.opdate, 1, 7) || '-01'
+            AND opdate <= substr({row}.opdate, 1, 7) || '-31'"""
+_ROLLUP_REMOVE = f"""UPDATE pfim_rollup SET
+        cnt = cnt - 1,
+        total = total - {{row}}.amount,
+        sumsq = sumsq - {{row}}.amount * {{row}}.amount,
+        minval = CASE WHEN {{row}}.amount <= minval
+            THEN (SELECT min(amount) {_ROLLUP_MONTH_ROWS}) ELSE minval END,
+        maxval = CASE WHEN {{row}}.amount >= maxval
+            THEN (SELECT max(amount) {_ROLLUP_MONTH_ROWS}) ELSE maxval END
+    WHERE month = substr({{row}}.opdate, 1, 7)
+        AND {{key}} = coalesce({{row}}.{{key}}, {{blank}})
+        AND kind = {{row}}.kind;
+    DELETE FROM pfim_rollup WHERE month = substr({{row}}.opdate, 1, 7)
+        AND {{key}} = coalesce({{row}}.{{key}}, {{blank}})
+        AND kind = {{row}}.kind AND cnt <= 0;"""
+_ROLLUP_SELECT = """SELECT substr(opdate, 1, 7), coalesce({key}, {blank}),
+        kind, count(*), sum(amount), sum(amount * amount), min(amount),
+        max(amount)
+    FROM pfim GROUP BY 1, 2, 3"""
+_ROLLUP_COLUMNS = "month, {key}, kind, cnt, total, sumsq, minval, maxval"
+
+
+def _rollup_schema(names: Dict[str, str]) -> Tuple[str, ...]:
+    # the rollup table, filled from pfim, and its triggers
+    columns = _ROLLUP_COLUMNS.format(**names)
+    return (
+        """CREATE TABLE pfim_rollup(
+            month TEXT NOT NULL,
+            {key} {keytype} NOT NULL,
+            kind TEXT NOT NULL,
+            cnt INTEGER NOT NULL,
+            total REAL NOT NULL,
+            sumsq REAL NOT NULL,
+            minval REAL,
+            maxval REAL,
+            PRIMARY KEY (month, {key}, kind)
+        ) WITHOUT ROWID""".format(**names),
+        f"INSERT INTO pfim_rollup({columns}) "
+        + _ROLLUP_SELECT.format(**names),
+        f"""CREATE TRIGGER pfim_rollup_insert AFTER INSERT ON pfim BEGIN
+            {_ROLLUP_ADD.format(row="NEW", **names)}
+        END""",
+        f"""CREATE TRIGGER pfim_rollup_delete AFTER DELETE ON pfim BEGIN
+            {_ROLLUP_REMOVE.format(row="OLD", **names)}
+        END""",
+        f"""CREATE TRIGGER pfim_rollup_update
+            AFTER UPDATE OF opdate, {names["key"]}, kind, amount ON pfim BEGIN
+            {_ROLLUP_REMOVE.format(row="OLD", **names)}
+            {_ROLLUP_ADD.format(row="NEW", **names)}
+        END""")
+
+
+# ---- TAG DICTIONARY ----
+# A tag is a path such as home/utilities/power, and every prefix of a
+# path is a tag too: its parent. SQL and _parent_tag() cut the last part
+# of a path the same way. A tag matches a filter on itself or on any of
+# its ancestors.
+_PARENT_TAG = "rtrim(rtrim({tag}, replace({tag}, '/', '')), '/')"
+_TAG_SUBTREE = "instr(tag || '/', ? || '/') = 1"
+
+
+def _parent_tag(tag: str) -> Union[str, None]:
+    """Return the parent of a tag path, None for a top-level tag."""
+    return tag.rpartition("/")[0].rstrip("/") or None
+
+# ---- FULL-TEXT SEARCH ----
+# pfim_fts indexes the descriptions, with pfim as its external content.
+# It needs SQLite's FTS5 extension: without it the index is not created
+# and report --search falls back to LIKE. Indexing row by row from the
+# insert trigger is several times slower than one INSERT ... SELECT, so
+# bulk inserts set pfim_fts_state.deferred and index their rows at once
+# in the same transaction.
+_SEARCH_SCHEMA = (
+    """CREATE VIRTUAL TABLE pfim_fts USING fts5(description,
+        content='pfim', content_rowid='id', prefix='2 3')""",
+    "CREATE TABLE pfim_fts_state(deferred INTEGER NOT NULL)",
+    "INSERT INTO pfim_fts_state VALUES (0)",
+    """CREATE TRIGGER pfim_fts_insert AFTER INSERT ON pfim
+        WHEN (SELECT deferred FROM pfim_fts_state) = 0
+    BEGIN
+        INSERT INTO pfim_fts(rowid, description)
+            VALUES (NEW.id, NEW.description);
+    END""",
+    """CREATE TRIGGER pfim_fts_delete AFTER DELETE ON pfim BEGIN
+        INSERT INTO pfim_fts(pfim_fts, rowid, description)
+            VALUES ('delete', OLD.id, OLD.description);
+    END""",
+    """CREATE TRIGGER pfim_fts_update AFTER UPDATE OF description ON pfim
+    BEGIN
+        INSERT INTO pfim_fts(pfim_fts, rowid, description)
+            VALUES ('delete', OLD.id, OLD.description);
+        INSERT INTO pfim_fts(rowid, description)
+            VALUES (NEW.id, NEW.description);
+    END""",
+    "INSERT INTO pfim_fts(pfim_fts) VALUES ('rebuild')",
+)
+_SEARCH_TRIGGERS = _SEARCH_SCHEMA[3:6]
+_SEARCH_DEFER = "UPDATE pfim_fts_state SET deferred = ?"
+_SEARCH_INDEX = """INSERT INTO pfim_fts(rowid, description)
+    SELECT id, description FROM pfim WHERE id > ?"""
+
+# ---- BALANCE INDEX ----
+# pfim_balance is a Fenwick tree of the net amount of each day: node n
+# holds the amounts of the days after n - (n & -n) up to n, days being
+# date ordinals. The balance as of a day is the sum of at most
+# _BALANCE_LEVELS nodes, and a new amount dated any day changes as many,
+# so neither depends on the size of the ledger or on where the day falls.
+# Triggers only add the amounts a statement writes to the net of their
+# day in pfim_balance_delta, and a writer folds the deltas into the tree
+# at commit once they span more than _BALANCE_PENDING days: a bulk insert
+# updates the nodes of each day it touches once, whatever the order of
+# its rows, and a record of the day costs a single row. Readers add the
+# deltas not folded yet, a scan of at most _BALANCE_PENDING rows.
+_BALANCE_LEVELS = 22
+_BALANCE_PENDING = 64
+_BALANCE_DAY = "CAST(julianday({row}.opdate) - 1721424.5 AS INTEGER)"
+_BALANCE_ADD = f"""INSERT INTO pfim_balance_delta(day, delta)
+        VALUES ({_BALANCE_DAY}, {{sign}}{{row}}.amount)
+        ON CONFLICT(day) DO UPDATE SET delta = delta + excluded.delta;"""
+# add the deltas to the nodes covering their day: at each level b, the
+# first multiple of 1 << b from the day on, if its quotient is odd. The
+# levels are the rows of a table: generating them with a recursive CTE
+# costs as much as the rest of a lookup.
+_BALANCE_FOLD = """INSERT INTO pfim_balance(node, total)
+    SELECT ((day + (1 << b) - 1) >> b) << b AS node, total(delta)
+    FROM pfim_balance_delta, pfim_balance_levels
+    WHERE ((day + (1 << b) - 1) >> b) & 1 GROUP BY node
+    ON CONFLICT(node) DO UPDATE SET total = total + excluded.total"""
+# the index of the entries of pfim, built into empty tables
+_BALANCE_FILL = (
+    f"""INSERT INTO pfim_balance_delta(day, delta)
+        SELECT {_BALANCE_DAY.format(row="pfim")}, sum(amount) FROM pfim
+        GROUP BY opdate""",
+    _BALANCE_FOLD,
+    "DELETE FROM pfim_balance_delta",
+)
+_BALANCE_SCHEMA = (
+    """CREATE TABLE pfim_balance(
+        node INTEGER PRIMARY KEY,
+        total REAL NOT NULL
+    )""",
+    """CREATE TABLE pfim_balance_delta(
+        day INTEGER PRIMARY KEY,
+        delta REAL NOT NULL
+    )""",
+    "CREATE TABLE pfim_balance_levels(b INTEGER PRIMARY KEY)",
+    f"""INSERT INTO pfim_balance_levels
+        WITH RECURSIVE levels(b) AS (SELECT 0 UNION ALL
+            SELECT b + 1 FROM levels WHERE b < {_BALANCE_LEVELS - 1})
+        SELECT b FROM levels""") + _BALANCE_FILL + (
+    f"""CREATE TRIGGER pfim_balance_insert AFTER INSERT ON pfim BEGIN
+        {_BALANCE_ADD.format(row="NEW", sign="")}
+    END""",
+    f"""CREATE TRIGGER pfim_balance_delete AFTER DELETE ON pfim BEGIN
+        {_BALANCE_ADD.format(row="OLD", sign="-")}
+    END""",
+    f"""CREATE TRIGGER pfim_balance_update
+        AFTER UPDATE OF opdate, amount ON pfim BEGIN
+        {_BALANCE_ADD.format(row="OLD", sign="-")}
+        {_BALANCE_ADD.format(row="NEW", sign="")}
+    END""",
+)
+# the balance as of the day ordinal ?1 in the tree of {prefix}: the nodes
+# of the prefix ending on ?1, each clearing the lowest bit left, and the
+# deltas not folded yet
+_BALANCE_AS_OF = """SELECT (SELECT total(total)
+        FROM {prefix}pfim_balance WHERE node IN (SELECT (?1 >> b) << b
+            FROM {prefix}pfim_balance_levels WHERE (?1 >> b) & 1))
+    + (SELECT total(delta) FROM {prefix}pfim_balance_delta WHERE day <= ?1)"""
+
+# the tag column replaced by tag_id. ALTER TABLE DROP COLUMN needs SQLite
+# 3.35: the table is rebuilt instead, which drops its indexes and
+# triggers, and the sequence of its ids is carried over. _upgrade puts
+# back the triggers of the full-text index.
+_TAG_REBUILD = (
+    """CREATE TABLE pfim_rebuild(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            opdate DATE,
+            description TEXT,
+            amount REAL,
+            kind TEXT,
+            tag_id INTEGER REFERENCES tags(tag_id)
+        )""",
+    """INSERT INTO pfim_rebuild(id, opdate, description, amount, kind, tag_id)
+        SELECT id, opdate, description, amount, kind,
+            (SELECT tag_id FROM tags WHERE tags.tag = pfim.tag)
+        FROM pfim ORDER BY id""",
+    """UPDATE sqlite_sequence SET seq = coalesce((SELECT seq
+            FROM sqlite_sequence WHERE name = 'pfim'), seq)
+        WHERE name = 'pfim_rebuild'""",
+    "DROP TABLE pfim",
+    "ALTER TABLE pfim_rebuild RENAME TO pfim",
+    "CREATE INDEX pfim_opdate ON pfim(opdate, amount)",
+    "CREATE INDEX pfim_kind_opdate ON pfim(kind, opdate, amount)",
+)
+
+# ---- DATABASE SCHEMA ----
+# _SCHEMA[n] upgrades a database from version n to version n + 1; the
+# current version is kept in PRAGMA user_version.
+_SCHEMA = (
+    # 1: the ledger table
+    ("""CREATE TABLE IF NOT EXISTS pfim(
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            opdate DATE,
+            tag TEXT,
+            description TEXT,
+            amount REAL
+        )""",),
+    # 2: income/expense kind and the indexes behind the report filters
+    ("ALTER TABLE pfim ADD COLUMN kind TEXT",
+     f"""UPDATE pfim SET kind = CASE WHEN amount < 0 THEN '{_SPENT_KIND}'
+            ELSE '{_EARN_KIND}' END""",
+     "CREATE INDEX IF NOT EXISTS pfim_opdate ON pfim(opdate)",
+     "CREATE INDEX IF NOT EXISTS pfim_tag_opdate ON pfim(tag, opdate)",
+     "CREATE INDEX IF NOT EXISTS pfim_kind_opdate ON pfim(kind, opdate)"),
+    # 3: the indexes also cover amount, so that summaries are computed
+    # from the indexes alone
+    ("DROP INDEX IF EXISTS pfim_opdate",
+     "DROP INDEX IF EXISTS pfim_tag_opdate",
+     "DROP INDEX IF EXISTS pfim_kind_opdate",
+     "CREATE INDEX pfim_opdate ON pfim(opdate, amount)",
+     "CREATE INDEX pfim_tag_opdate ON pfim(tag, opdate, amount)",
+     "CREATE INDEX pfim_kind_opdate ON pfim(kind, opdate, amount)"),
+    # 4: monthly rollup, maintained by triggers
+    _rollup_schema(_ROLLUP_TAG),
+    # 5: full-text index of the descriptions, skipped without FTS5
+    _SEARCH_SCHEMA,
+    # 6: the tag dictionary. Entries and the rollup refer to their tag by
+    # id, and the ancestors of every tag are created along with it.
+    ("""CREATE TABLE tags(
+            tag_id INTEGER PRIMARY KEY,
+            tag TEXT NOT NULL UNIQUE,
+            parent_id INTEGER REFERENCES tags(tag_id)
+        )""",
+     f"""INSERT INTO tags(tag)
+        WITH RECURSIVE paths(tag) AS (
+            SELECT tag FROM pfim WHERE tag IS NOT NULL
+            UNION
+            SELECT {_PARENT_TAG.format(tag="tag")} FROM paths
+            WHERE instr(tag, '/') AND {_PARENT_TAG.format(tag="tag")} != ''
+        ) SELECT tag FROM paths ORDER BY tag""",
+     f"""UPDATE tags SET parent_id = (SELECT p.tag_id FROM tags AS p
+            WHERE p.tag = {_PARENT_TAG.format(tag="tags.tag")})
+        WHERE instr(tag, '/')""",
+     "DROP TRIGGER pfim_rollup_insert",
+     "DROP TRIGGER pfim_rollup_delete",
+     "DROP TRIGGER pfim_rollup_update",
+     "DROP TABLE pfim_rollup",
+     "DROP INDEX pfim_tag_opdate")
+    + _TAG_REBUILD
+    + ("CREATE INDEX pfim_tag_opdate ON pfim(tag_id, opdate, amount)",)
+    + _rollup_schema(_ROLLUP_KEY),
+    # 7: the balance index, see _BALANCE_FOLD
+    _BALANCE_SCHEMA,
+)
+
 # ---- DATABASE OPERATION CONSTANT ----
 RECORD = 1
 FETCH = 2
@@ -187,6 +618,27 @@ def _delete_rcv():
 # --- PFIM utility class --
 
 
+_COLORS = {
+    "black": 30, "red": 31, "green": 32, "yellow": 33,
+    "blue": 34, "magenta": 35, "cyan": 36, "white": 37,
+}
+_STYLES = {"normal": 0, "bold": 1, "italic": 3, "underline": 4}
+_RESET = "\x1b[m"
+
+
+@functools.lru_cache(maxsize=64)
+def _style_prefix(color: str, slant: str, underline: bool, bold: bool) -> str:
+    codes = []
+    if slant.lower() == "italic":
+        codes.append(_STYLES["italic"])
+    if underline:
+        codes.append(_STYLES["underline"])
+    if bold:
+        codes.append(_STYLES["bold"])
+    codes.append(_COLORS.get(color.lower(), _COLORS["black"]))
+    return "\x1b[" + ";".join(map(str, codes)) + "m"
+
+
 class OutputBeautify:
 
     def __init__(self, textstr: str):
@@ -195,45 +647,35 @@ class OutputBeautify:
 
     def decorate(self, color="green", slant="normal", underline=False,
         bold=False):
-        mapping = {
-            "black": 30, "red": 31, "green": 32, "yellow": 33,
-            "blue": 34, "magenta": 35, "cyan": 36, "white": 37,
-        }
-        stylemap = {"noraml": 0, "bold": 1, "italic": 3, "underline": 4}
-        base = 38
-        if color.lower() in mapping.keys():
-            cval = mapping[color.lower()]
-        else:
-            cval = mapping["black"]
-        txt = self._textstr
-        if slant.lower() in ("italic", "normal"):
-            sval = stylemap[slant.lower()]
-        else:
-            sval = stylemap["normal"]
-        uval = stylemap["underline"] if underline else None
-        bval = stylemap["bold"] if bold else None
-
-        deco = f"\x1b[{base};" #"\x1b[m"
-        if sval:
-            deco = deco + f"{sval};"
-        if uval:
-            deco = deco + f"{uval};"
-        if bval:
-            deco = deco + f"{bval};"
-
-        deco = deco + f"{cval}m;{txt}\x1b[m"
-        return deco
+        # the escape sequence of each style is built once and cached
+        return (_style_prefix(color, slant, underline, bold) + self._textstr
+            + _RESET)
 
 
 def _adapter(dateObj: date):
     return dateObj.isoformat()
 
 
-def _converter(datestr: str):
-    return date.fromisoformat(datestr)
+def _converter(datestr: bytes):
+    return date.fromisoformat(datestr.decode())
+
+
+@functools.lru_cache(maxsize=None)
+def _register_sqlite_types() -> None:
+    sqlite3.register_adapter(date, _adapter)
+    sqlite3.register_converter("date", _converter)
 
-sqlite3.register_adapter(date, _adapter)
-sqlite3.register_converter("date", _converter)
+
+@functools.lru_cache(maxsize=None)
+def _has_fts5() -> bool:
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
 
 class PfimQueryCmdEnum(Enum):
     RECORD_RCV = auto()
@@ -250,6 +692,18 @@ class PfimQueryCmdEnum(Enum):
     DELETE_XPX = auto()
 
 
+def _is_busy(err: sqlite3.Error) -> bool:
+    # whether err is a lock held by another connection, which goes away
+    code = getattr(err, "sqlite_errorcode", None)
+    if code is None:
+        return "locked" in str(err) or "busy" in str(err)
+    return code & 0xff in (_SQLITE_BUSY, _SQLITE_LOCKED)
+
+
+def _mb(size: float) -> str:
+    return f"{size / (1 << 20):.1f} MB"
+
+
 def _validate_datestr(datestr: str) -> bool:
     result = None
     try:
@@ -262,35 +716,556 @@ def _validate_datestr(datestr: str) -> bool:
 
 
 class PfimData:
-    """PFIM database interface."""
+    """PFIM database interface.
 
-    def __init__(self):
+    Every thread that touches the database gets its own long-lived
+    connection, opened on first use and kept until close() is called. The
+    connections run in WAL mode and keep a cache of prepared statements, so
+    repeated queries are neither reconnected nor re-parsed.
+
+    A readonly PfimData opens the database with mode=ro and leaves its
+    schema alone; the database must exist and be up to date.
+
+    Several processes may write to the same database. A statement waits up
+    to busy_timeout seconds for the lock of another writer, and a write
+    still locked out is rolled back and tried again, up to retries times
+    with a growing random backoff, before it fails.
+    """
+
+    # a single file holds the whole ledger, see PartitionedPfimData for one
+    # file per year
+    partitioned = False
+
+    def __init__(self, dbname: str = _DBNAME, readonly: bool = False):
+        _setup_logging()
+        _register_sqlite_types()
         self._logger = logging.getLogger("pfim.PfimData")
+        self._dbname = dbname
+        self.readonly = readonly
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._hooks: List[Callable[[QueryStats], None]] = []
+        self._search = None
+        # statements slower than this many seconds are reported to the
+        # hooks with their query plan
+        self.slow_query = _SLOW_QUERY
+        self.busy_timeout = _BUSY_TIMEOUT
+        self.retries = _WRITE_RETRIES
         # start the db: create a new if it doesn't exists
-        sql = """CREATE TABLE IF NOT EXISTS pfim(
-            id INTEGER PRIMARY KEY AUTOINCREMENT NON NULL,
-            opdate DATE,
-            tag TEXT,
-            description TEXT,
-            amount REAL
-        )"""
-        with sqlite3.connect(_DBNAME,
-            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
-            ) as conn:
-            conn.cursor().execute(sql).commit()
-
-    def _run_query(self, query, *args, out=False) ->Union[sqlite3.Cursor, None]:
-        retval = None
-        with sqlite3.connect(_DBNAME) as conn:
-            if args:
-                retval = conn.cursor().execute(query, args)
-            else:
-                retval = conn.cursor().execute(query)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        conn = self._connect()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(_SCHEMA):
+            return
+        if self.readonly:
+            self._logger.error(f"{self._dbname} has an outdated schema, "
+                "open it read-write once to upgrade it")
+            sys.exit(1)
+        try:
+            version = self._retrying(conn, self._upgrade, conn)
+            self._logger.debug(
+                f"Database schema upgraded from version {version}")
+        except sqlite3.Error as err:
+            self._logger.error(f"Failed to upgrade database schema. {err}")
+            sys.exit(1)
 
-            conn.commit()
+    def _upgrade(self, conn: sqlite3.Connection) -> int:
+        # re-read the version once we hold the write lock, another process
+        # may have migrated in the meantime
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for step in _SCHEMA[version:]:
+            if step is _SEARCH_SCHEMA and not _has_fts5():
+                self._logger.debug(
+                    "SQLite has no FTS5, report --search uses LIKE")
+                continue
+            for sql in step:
+                conn.execute(sql)
+            if _TAG_REBUILD[0] in step and conn.execute("SELECT 1 FROM "
+                "sqlite_master WHERE name = 'pfim_fts'").fetchone():
+                for sql in _SEARCH_TRIGGERS:
+                    conn.execute(sql)
+        conn.execute(f"PRAGMA user_version = {len(_SCHEMA)}")
+        conn.commit()
+        return version
+
+    def _retrying(self, conn: sqlite3.Connection, run: Callable, *args):
+        """Return run(*args), a transaction on conn, trying it again while
+        another connection holds the lock.
+
+        A failed attempt is rolled back. Attempts are spaced by a random
+        delay that doubles each time, so that writers locked out together
+        do not come back together.
+        """
+        backoff = _RETRY_BACKOFF
+        for attempt in range(self.retries + 1):
+            try:
+                return run(*args)
+            except sqlite3.Error as err:
+                if conn.in_transaction:
+                    conn.rollback()
+                if attempt == self.retries or not _is_busy(err):
+                    raise
+                import random
+                self._logger.debug(f"{self._dbname} is locked, attempt "
+                    f"{attempt + 2} of {self.retries + 1}")
+                time.sleep(random.uniform(0, backoff))
+                backoff = min(backoff * 2, _RETRY_BACKOFF_MAX)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open(self._dbname)
+            self._local.conn = conn
+        return conn
+
+    def _open(self, dbname: str, uri: bool = False) -> sqlite3.Connection:
+        if self.readonly and not uri and dbname != ":memory:":
+            dbname, uri = "file:" + quote(dbname) + "?mode=ro", True
+        conn = sqlite3.connect(dbname,
+            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+            cached_statements=_STMT_CACHE_SIZE, timeout=self.busy_timeout,
+            check_same_thread=False, uri=uri)
+        conn.create_aggregate("pfim_m2", 1, _Deviations)
+        for pragma in _PRAGMAS:
+            # the journal mode is the writers' business
+            if not (self.readonly and "journal_mode" in pragma):
+                conn.execute(pragma)
+        with self._lock:
+            self._conns.append(conn)
+        return conn
+
+    def _connect_for(self, query: str) -> sqlite3.Connection:
+        """Return this thread's connection to run query on."""
+        return self._connect()
+
+    def sources(self, first: str = None, last: str = None
+        ) -> List[Tuple[str, ...]]:
+        """Return the schemas holding the entries dated first to last.
+
+        Each tuple is read by one statement, () standing for the tables of
+        the main schema. The bounds are YYYY-MM-DD dates, None for no bound.
+        """
+        return [()]
+
+    def stores(self, first: str = None, last: str = None) -> List["PfimData"]:
+        """Return the writable databases of the entries dated first to last."""
+        return [self]
+
+    def archived(self, first: str = None, last: str = None) -> List[int]:
+        """Return the read-only archived years of the entries dated first
+        to last."""
+        return []
+
+    def store(self, day: str) -> "PfimData":
+        """Return the database a new entry dated day is written to."""
+        return self
+
+    @property
+    def path(self) -> str:
+        """The file or directory the ledger is read from."""
+        return self._dbname
+
+    def files(self) -> List[Tuple[str, bool]]:
+        """Return the (path, immutable) database files of the ledger.
+
+        Immutable files are never written to again, see
+        PartitionedPfimData.archive().
+        """
+        return [(self._dbname, False)]
+
+    def date_span(self) -> Tuple[Union[str, None], Union[str, None]]:
+        """Return the dates of the first and last entries, None if empty."""
+        # one min() or max() per SELECT is an index lookup, both a scan
+        return next(self.fetch("SELECT (SELECT min(opdate) FROM pfim), "
+            "(SELECT max(opdate) FROM pfim)"))
+
+    def _run_query(self, query, args=(), out=False
+        ) -> Union[sqlite3.Cursor, None]:
+        conn = self._connect_for(query)
+        start = time.perf_counter() if self._hooks else None
+        retval = self._retrying(conn, self._commit_query, conn, query, args)
+        # statements returning rows are reported by fetch(), once read
+        if start is not None and retval.description is None:
+            self._emit(query, args, time.perf_counter() - start,
+                retval.rowcount)
         if out:
             return retval
 
+    def _commit_query(self, conn: sqlite3.Connection, query: str, args
+        ) -> sqlite3.Cursor:
+        retval = conn.execute(query, args)
+        if conn.in_transaction:
+            self._settle_balances(conn)
+            conn.commit()
+        return retval
+
+    def add_hook(self, hook: Callable[[QueryStats], None]) -> None:
+        """Call hook with the QueryStats of every statement run from now on.
+
+        Hooks run in the thread that ran the statement. The plan of a
+        statement is only looked up when it took slow_query seconds or more,
+        otherwise it is None.
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[QueryStats], None]) -> None:
+        self._hooks.remove(hook)
+
+    def _emit(self, query: str, args, seconds: float, rows: int) -> None:
+        plan = None
+        if seconds >= self.slow_query:
+            try:
+                plan = self.query_plan(query, *args)
+            except sqlite3.Error:
+                pass
+        stats = QueryStats(query, tuple(args), seconds, rows, plan)
+        for hook in self._hooks:
+            hook(stats)
+
+    def rebuild_rollups(self) -> int:
+        """Recompute the monthly rollup from the ledger.
+
+        Returns the number of rollup rows.
+        """
+        conn = self._connect()
+
+        def rebuild():
+            with conn:
+                conn.execute("DELETE FROM pfim_rollup")
+                return conn.execute(
+                    f"INSERT INTO pfim_rollup({_ROLLUP_COLUMNS}) "
+                    f"{_ROLLUP_SELECT}".format(**_ROLLUP_KEY)).rowcount
+        try:
+            count = self._retrying(conn, rebuild)
+            self._logger.debug("Rebuilt monthly rollup")
+        except sqlite3.Error as err:
+            self._logger.error(f"Failed to rebuild monthly rollup. {err}")
+            sys.exit(1)
+        return count
+
+    def check_rollups(self, tolerance: float = 1e-6) -> List[Tuple]:
+        """Compare the monthly rollup with the ledger.
+
+        Returns the (month, tag, kind) keys whose rollup row is missing,
+        stale or has no ledger rows behind it.
+        """
+        diff = lambda col: (f"abs(r.{col} - l.{col}) > "
+            f"{tolerance} * max(1.0, abs(l.{col}))")
+        query = f"""WITH l({_ROLLUP_COLUMNS}) AS ({_ROLLUP_SELECT}),
+            stale(month, tag_id, kind) AS (
+                SELECT l.month, l.tag_id, l.kind FROM l LEFT JOIN pfim_rollup r
+                    USING (month, tag_id, kind)
+                WHERE r.cnt IS NULL OR r.cnt != l.cnt OR {diff("total")}
+                    OR {diff("sumsq")} OR r.minval != l.minval
+                    OR r.maxval != l.maxval
+                UNION ALL
+                SELECT r.month, r.tag_id, r.kind FROM pfim_rollup r
+                    LEFT JOIN l USING (month, tag_id, kind)
+                WHERE l.cnt IS NULL)
+            SELECT month, coalesce(tag, ''), kind
+            FROM stale LEFT JOIN tags USING (tag_id)"""
+        return list(self.fetch(query.format(**_ROLLUP_KEY)))
+
+    def _settle_balances(self, conn: sqlite3.Connection,
+        pending: int = _BALANCE_PENDING) -> None:
+        # fold the amounts written so far into the balance index, in the
+        # transaction under way on conn, once they span more than pending
+        # days; see _BALANCE_FOLD
+        if conn.execute("SELECT 1 FROM pfim_balance_delta LIMIT 1 OFFSET ?",
+            (pending,)).fetchone() is None:
+            return
+        conn.execute(_BALANCE_FOLD)
+        conn.execute("DELETE FROM pfim_balance_delta")
+
+    def balance(self, day: str) -> float:
+        """Return the balance as of day, the sum of the amounts of the
+        entries dated up to and including it.
+
+        Each database holding entries up to day answers from its balance
+        index with at most _BALANCE_LEVELS primary key lookups.
+        """
+        ordinal = date.fromisoformat(day).toordinal()
+        total = 0.0
+        for schemas in self.sources(None, day):
+            for schema in schemas or ("",):
+                prefix = f"{schema}." if schema else ""
+                total += next(self.fetch(
+                    _BALANCE_AS_OF.format(prefix=prefix), ordinal))[0]
+        return total
+
+    def rebuild_balances(self) -> int:
+        """Recompute the balance index from the ledger.
+
+        Returns the number of nodes of the index.
+        """
+        conn = self._connect()
+
+        def rebuild():
+            with conn:
+                conn.execute("DELETE FROM pfim_balance")
+                conn.execute("DELETE FROM pfim_balance_delta")
+                for sql in _BALANCE_FILL:
+                    conn.execute(sql)
+        try:
+            self._retrying(conn, rebuild)
+            self._logger.debug("Rebuilt balance index")
+        except sqlite3.Error as err:
+            self._logger.error(f"Failed to rebuild balance index. {err}")
+            sys.exit(1)
+        return conn.execute("SELECT count(*) FROM pfim_balance").fetchone()[0]
+
+    def check_balances(self, tolerance: float = 1e-6) -> List[str]:
+        """Compare the balance index with the ledger.
+
+        Returns the days with entries whose balance, as read from the
+        index, is not the sum of the amounts up to them.
+        """
+        query = f"""WITH l(opdate, day, balance) AS (
+                SELECT opdate, {_BALANCE_DAY.format(row="pfim")},
+                    sum(sum(amount)) OVER (ORDER BY opdate)
+                FROM pfim GROUP BY opdate)
+            SELECT opdate FROM l WHERE abs((SELECT total(total)
+                FROM pfim_balance WHERE node IN (SELECT (l.day >> b) << b
+                    FROM pfim_balance_levels WHERE (l.day >> b) & 1))
+                + (SELECT total(delta) FROM pfim_balance_delta
+                    WHERE pfim_balance_delta.day <= l.day)
+                - l.balance) > {tolerance} * max(1.0, abs(l.balance))"""
+        return [str(row[0]) for row in self.fetch(query)]
+
+    def has_search(self) -> bool:
+        """Tell whether the full-text index of descriptions exists."""
+        if self._search is None:
+            self._search = _has_fts5() and self._connect().execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'pfim_fts'"
+                ).fetchone() is not None
+        return self._search
+
+    def rebuild_search(self) -> int:
+        """Create the full-text index if needed and rebuild it from pfim.
+
+        Returns the number of indexed entries.
+        """
+        if not _has_fts5():
+            self._logger.error("SQLite was built without FTS5, "
+                "report --search falls back to LIKE")
+            sys.exit(1)
+        conn = self._connect()
+        search = self.has_search()
+
+        def rebuild():
+            with conn:
+                for sql in _SEARCH_SCHEMA[-1:] if search else _SEARCH_SCHEMA:
+                    conn.execute(sql)
+        try:
+            self._retrying(conn, rebuild)
+            self._search = True
+            self._logger.debug("Rebuilt full-text index")
+        except sqlite3.Error as err:
+            self._logger.error(f"Failed to rebuild full-text index. {err}")
+            sys.exit(1)
+        return conn.execute("SELECT count(*) FROM pfim").fetchone()[0]
+
+    def check_search(self) -> bool:
+        """Tell whether the full-text index matches the descriptions."""
+        if not self.has_search():
+            return False
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT INTO pfim_fts(pfim_fts, rank) "
+                    "VALUES ('integrity-check', 1)")
+        except sqlite3.DatabaseError:
+            return False
+        return True
+
+    def analyze(self) -> None:
+        """Collect planner statistics, once, if the database has none.
+
+        Without them a statement bounded to a date range reads it through
+        pfim_opdate and looks each row's tag up in the table. Sampled
+        statistics are enough for the planner to skip-scan the covering
+        (tag_id, opdate) index instead. Statistics collected before the
+        tag dictionary came in do not count.
+        """
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM sqlite_master "
+            "WHERE name = 'sqlite_stat1'").fetchone() and conn.execute(
+            "SELECT 1 FROM sqlite_stat1 WHERE tbl = 'tags'").fetchone():
+            return
+        try:
+            conn.execute(f"PRAGMA analysis_limit={_ANALYSIS_LIMIT}")
+            conn.execute("ANALYZE")
+            conn.commit()
+        except sqlite3.Error as err:
+            # statistics only help, a busy database can go without
+            conn.rollback()
+            self._logger.debug(f"Failed to analyze {self._dbname}. {err}")
+
+    def tag_ids(self, tags: Iterable[str],
+        create: bool = True) -> Dict[str, int]:
+        """Return {tag: id} for tags, None standing for no tag.
+
+        Missing tags are created along with their ancestors, or map to None
+        when create is False. Ids come from a per-thread copy of the tag
+        dictionary, read again once another connection has written to the
+        database, so the tags of a bulk insert cost a dict lookup each.
+        """
+        conn = self._connect()
+        cache = self._tag_cache(conn)
+        ids = {None: None}
+        missing = []
+        for tag in set(tags):
+            if tag in cache:
+                ids[tag] = cache[tag]
+            elif tag is not None:
+                missing.append(tag)
+        if not missing:
+            return ids
+        if not create:
+            ids.update(dict.fromkeys(missing))
+            return ids
+        try:
+            ids.update(self._retrying(conn, self._create_tags, conn, missing))
+        except sqlite3.Error as err:
+            self.forget_tags()
+            self._logger.error(f"Failed to add tags to database. {err}")
+            sys.exit(1)
+        return ids
+
+    def _tag_cache(self, conn: sqlite3.Connection) -> Dict[str, int]:
+        # this thread's copy of the tag dictionary, {tag: id}, valid for
+        # the data_version of conn, its connection, it was read at
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        cached = getattr(self._local, "tags", None)
+        if cached is None or cached[0] != version:
+            cached = self._local.tags = (version,
+                dict(conn.execute("SELECT tag, tag_id FROM tags")))
+        return cached[1]
+
+    def forget_tags(self) -> None:
+        """Drop this thread's copy of the tag dictionary, after a rollback
+        of tags it had created."""
+        self._local.tags = None
+
+    def _create_tags(self, conn: sqlite3.Connection, tags: List[str]
+        ) -> Dict[str, int]:
+        if conn.in_transaction:
+            # a transaction of the caller's, such as a batch, which
+            # commits the tags with the rest or rolls them back
+            return {tag: self._create_tag(conn, tag) for tag in tags}
+        try:
+            with conn:
+                return {tag: self._create_tag(conn, tag) for tag in tags}
+        except sqlite3.Error:
+            # the ids of the tags rolled back
+            self.forget_tags()
+            raise
+
+    def _create_tag(self, conn: sqlite3.Connection, tag: str) -> int:
+        # the id of tag, created with its missing ancestors; another
+        # process may have created it in the meantime
+        parent = _parent_tag(tag)
+        cache = self._tag_cache(conn)
+        parent_id = None
+        if parent is not None:
+            parent_id = cache.get(parent)
+            if parent_id is None:
+                parent_id = self._create_tag(conn, parent)
+        conn.execute("INSERT OR IGNORE INTO tags(tag, parent_id) "
+            "VALUES (?, ?)", (tag, parent_id))
+        tag_id = conn.execute("SELECT tag_id FROM tags WHERE tag = ?",
+            (tag,)).fetchone()[0]
+        cache[tag] = tag_id
+        return tag_id
+
+    def rename_tag(self, old: str, new: str) -> int:
+        """Rename the tag old to new, and the tags under it along with it.
+
+        Entries and the rollup refer to their tag by id, so only the rows
+        of the tag dictionary change. Returns the number of renamed tags,
+        0 when old does not exist.
+        """
+        if new == old:
+            return 0
+        if new.startswith(old + "/"):
+            self._logger.error(f"Can not move {old} under itself")
+            sys.exit(1)
+        conn = self._connect()
+        try:
+            self._retrying(conn, conn.execute, "BEGIN IMMEDIATE")
+            subtree = conn.execute(
+                f"SELECT tag_id, tag FROM tags WHERE {_TAG_SUBTREE}",
+                (old,)).fetchall()
+            if not subtree:
+                conn.rollback()
+                return 0
+            renamed = [(new + tag[len(old):], tag_id)
+                for tag_id, tag in subtree]
+            for tag, _ in renamed:
+                if conn.execute("SELECT 1 FROM tags WHERE tag = ?",
+                    (tag,)).fetchone():
+                    conn.rollback()
+                    self._logger.error(f"Tag {tag} already exists")
+                    sys.exit(1)
+            parent = _parent_tag(new)
+            parent_id = None
+            if parent is not None:
+                parent_id = (self._tag_cache(conn).get(parent)
+                    or self._create_tag(conn, parent))
+            conn.executemany("UPDATE tags SET tag = ? WHERE tag_id = ?",
+                renamed)
+            for tag_id, tag in subtree:
+                if tag == old:
+                    conn.execute("UPDATE tags SET parent_id = ? "
+                        "WHERE tag_id = ?", (parent_id, tag_id))
+            conn.commit()
+        except sqlite3.Error as err:
+            conn.rollback()
+            self.forget_tags()
+            self._logger.error(f"Failed to rename tag {old}. {err}")
+            sys.exit(1)
+        cache = self._tag_cache(conn)
+        for _, tag in subtree:
+            cache.pop(tag, None)
+        cache.update(renamed)
+        self._logger.debug(f"Renamed {len(subtree)} tags under {old} to {new}")
+        return len(subtree)
+
+    def data_version(self) -> Tuple[int, int, int]:
+        """Return a stamp that changes whenever the ledger may have changed.
+
+        PRAGMA data_version moves when another connection commits, and the
+        connection's total_changes when it writes itself. Both are per
+        connection, so the stamp includes the connection.
+        """
+        conn = self._connect()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        return id(conn), version, conn.total_changes
+
+    def query_plan(self, query: str, *args) -> List[str]:
+        """Return the EXPLAIN QUERY PLAN details of query."""
+        cursor = self._connect_for(query).execute(
+            f"EXPLAIN QUERY PLAN {query}", args)
+        return [row[-1] for row in cursor]
+
+    def close(self) -> None:
+        """Close every connection opened by this instance."""
+        with self._lock:
+            conns, self._conns = self._conns, []
+            self._local = threading.local()
+        for conn in conns:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def add_entry(self, query: str, *args) -> None:
         try:
             self._run_query(query, args)
@@ -299,53 +1274,299 @@ class PfimData:
             self._logger.error(f"Failed to add a new entry to database. {err}")
             sys.exit(1)
 
+    def add_entries(self, query: str, rows: Iterable,
+        chunksize: int = _CHUNK_SIZE) -> int:
+        """Insert rows with executemany, committing every chunksize rows.
+
+        rows are (date, tag, description, amount) entries; their tags are
+        replaced by their ids, see tag_ids(). rows is consumed lazily, so an
+        arbitrarily large iterable is inserted in constant memory. Returns
+        the number of inserted rows.
+        """
+        conn = self._connect()
+        rows = iter(rows)
+        count = 0
+        search = self.has_search()
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = list(itertools.islice(rows, chunksize))
+                ids = self.tag_ids({row[1] for row in chunk})
+                chunk = [(opdate, ids[tag], description, amount)
+                    for opdate, tag, description, amount in chunk]
+                added = self._retrying(conn, self._insert_chunk, conn, query,
+                    chunk, search)
+                if self._hooks:
+                    self._emit(query, (), time.perf_counter() - start, added)
+                count += added
+                if added < chunksize:
+                    break
+            self._logger.debug(f"{count} new entries added")
+        except sqlite3.Error as err:
+            self._logger.error(f"Failed to add new entries to database. {err}")
+            sys.exit(1)
+        return count
+
+    def _insert_chunk(self, conn: sqlite3.Connection, query: str,
+        chunk: List[Tuple], search: bool) -> int:
+        # one transaction of add_entries()
+        if search:
+            conn.execute(_SEARCH_DEFER, (1,))
+            last = conn.execute(
+                "SELECT coalesce(max(id), 0) FROM pfim").fetchone()[0]
+        added = conn.executemany(query, chunk).rowcount
+        if search:
+            conn.execute(_SEARCH_INDEX, (last,))
+            conn.execute(_SEARCH_DEFER, (0,))
+        self._settle_balances(conn)
+        conn.commit()
+        return added
+
     def fetch(self, query: str, *args) -> Generator:
+        start = time.perf_counter() if self._hooks else None
         try:
-            retval = self._run_query(query, args)
+            retval = self._run_query(query, args, out=True)
             self._logger.debug("Fetched data from database")
         except sqlite3.Error as err:
             self._logger.error(f"Failed to fetch data from database. {err}")
             sys.exit(1)
 
-        for row in retval:
-            yield row
-
-    def update(self, query: str, *args) -> None:
+        if start is None:
+            for row in retval:
+                yield row
+            return
+        # only the time spent reading rows counts, not the consumer's
+        seconds = time.perf_counter() - start
+        rows = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = retval.fetchmany(_PROFILE_BATCH)
+                seconds += time.perf_counter() - start
+                if not batch:
+                    break
+                rows += len(batch)
+                yield from batch
+        finally:
+            self._emit(query, args, seconds, rows)
+
+    def fetch_chunks(self, query: str, *args,
+        size: int = _REPORT_CHUNK) -> Generator:
+        """Like fetch(), but yield the rows in lists of up to size rows."""
+        start = time.perf_counter() if self._hooks else None
         try:
-            retval = self._run_query(query, args)
+            retval = self._run_query(query, args, out=True)
+            self._logger.debug("Fetched data from database")
+        except sqlite3.Error as err:
+            self._logger.error(f"Failed to fetch data from database. {err}")
+            sys.exit(1)
+        fetchmany = retval.fetchmany
+        if start is None:
+            yield from iter(lambda: fetchmany(size), [])
+            return
+        # only the time spent reading rows counts, not the consumer's
+        seconds = time.perf_counter() - start
+        rows = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = fetchmany(size)
+                seconds += time.perf_counter() - start
+                if not chunk:
+                    break
+                rows += len(chunk)
+                yield chunk
+        finally:
+            self._emit(query, args, seconds, rows)
+
+    def update(self, query: str, *args) -> int:
+        try:
+            retval = self._run_query(query, args, out=True)
             self._logger.debug("Updated database content")
         except sqlite3.Error as err:
             self._logger.error(f"Failed to update database content. {err}")
             sys.exit(1)
 
-        for row in retval:
-            yield row
+        return retval.rowcount
 
-    def delete(self, query: str, *args) -> None:
+    def delete(self, query: str, *args) -> int:
         try:
-            retval = self._run_query(query, args)
+            retval = self._run_query(query, args, out=True)
             self._logger.debug("Deleted data from database")
         except sqlite3.Error as err:
             self._logger.error(f"Failed to delete data from database. {err}")
             sys.exit(1)
 
-        for row in retval:
-            yield row
+        return retval.rowcount
+
+
+def _open_data(dbname: str = _DBNAME, readonly: bool = False) -> PfimData:
+    """Open dbname, as a PartitionedPfimData when it is a directory.
+
+    The default database is the partition directory once 'pfim partition'
+    has created it.
+    """
+    if dbname == _DBNAME:
+        dbname = _partition_root() or dbname
+    if os.path.isdir(dbname):
+        from ._partition import PartitionedPfimData
+        return PartitionedPfimData(dbname, readonly)
+    return PfimData(dbname, readonly)
+
+
+def _partition_root() -> Union[str, None]:
+    # the partition directory of the default ledger, None while it is a
+    # single file
+    if os.path.isdir(_PARTITION_DIR):
+        return _PARTITION_DIR
+    try:
+        with open(_PARTITION_LINK, "r") as fd:
+            root = fd.read().strip()
+    except FileNotFoundError:
+        return None
+    if not os.path.isdir(root):
+        _setup_logging()
+        logging.getLogger("pfim.PfimData").error(
+            f"The ledger was partitioned into {root}, which is not a "
+            f"directory. Restore it, or remove {_PARTITION_LINK} to go "
+            f"back to {_DBNAME}")
+        sys.exit(1)
+    return root
+
+
+def _link_partitions(root: str) -> None:
+    # make root the ledger of the commands run without a database name
+    partial = _PARTITION_LINK + ".partial"
+    with open(partial, "w") as fd:
+        fd.write(os.path.abspath(root) + "\n")
+    os.replace(partial, _PARTITION_LINK)
+
+
+class GroupCommitWriter:
+    """Coalesce concurrent writes into group commits.
+
+    Statements submitted from any thread are queued and executed by a
+    single writer thread. Whatever queued up while one transaction was
+    being committed goes into the next one, so N concurrent writers cost
+    one commit instead of N. A statement that fails is retried on its own
+    so that it does not take the rest of its group down with it.
+
+    Each statement names the database it is written to, the partition of
+    its entry on a partitioned ledger, and a group commits once per
+    database. A group locked out by another process is tried again, see
+    PfimData.retries.
+    """
+
+    def __init__(self, data: PfimData, maxbatch: int = _GROUP_COMMIT_MAX):
+        import queue
+        self._logger = logging.getLogger("pfim.GroupCommitWriter")
+        self._data = data
+        self._maxbatch = maxbatch
+        self._queue = queue.SimpleQueue()
+        self.commits = 0
+        self.statements = 0
+        self._thread = threading.Thread(target=self._run,
+            name="pfim-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, query: str, args=(), data: PfimData = None):
+        """Queue a statement to run on data, by default the database of the
+        writer, and return a Future of its row count."""
+        from concurrent.futures import Future
+        future = Future()
+        self._queue.put((query, args,
+            self._data if data is None else data, future))
+        return future
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        import queue
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self._maxbatch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[2], []).append(item)
+            for data, group in groups.items():
+                self._commit(data, group)
+
+    def _commit(self, data: PfimData, batch: List[Tuple]) -> None:
+        conn = data._connect()
+        try:
+            counts = data._retrying(conn, self._execute, data, conn, batch)
+        except sqlite3.Error as err:
+            if _is_busy(err):
+                # the statements would be locked out one by one as well
+                for *_, future in batch:
+                    future.set_exception(err)
+                return
+            for item in batch:
+                try:
+                    count, = data._retrying(conn, self._execute, data, conn,
+                        [item])
+                    item[-1].set_result(count)
+                except sqlite3.Error as err:
+                    item[-1].set_exception(err)
+            return
+        self.commits += 1
+        self.statements += len(batch)
+        for (*_, future), count in zip(batch, counts):
+            future.set_result(count)
+
+    @staticmethod
+    def _execute(data: PfimData, conn: sqlite3.Connection,
+        batch: List[Tuple]) -> List[int]:
+        with conn:
+            counts = [conn.execute(query, args).rowcount
+                for query, args, *_ in batch]
+            data._settle_balances(conn)
+        return counts
 
 
 class InteractivePfim:
     # Use builtin module *Cmd* ?
     PROMPT = "pfim>> "
 
-    def __init__(self):
+    def __init__(self, dbname: str = _DBNAME):
         self._logger = logging.getLogger("pfim.InteractivePfim")
-        pass
+        self._dbname = dbname
+        self._core = None
+
+    def _pfim(self) -> "PfimCore":
+        if self._core is None:
+            self._core = PfimCore(self._dbname)
+        return self._core
 
     def record(self, kw: Dict) -> PfimQuery:
         pass
 
     def report(self, kw: Dict) -> PfimQuery:
-        pass
+        """Page through a report a screenful at a time, see _pager.
+
+        Summaries and analytics have no pages and are printed as they are.
+        """
+        core = self._pfim()
+        if kw.get("summaryOnly") or kw.get("groupBy") or kw.get("analytics"):
+            core.execute(dict(kw, cmd="report"))
+            return core._query
+        from ._pager import ReportPager
+        ReportPager(core, kw).run()
+        return core._query
 
     def delete(self, kw: Dict) -> PfimQuery:
         pass
@@ -361,73 +1582,1624 @@ class InteractivePfim:
         pass
 
 
-class Report:
+# ---- ENTRY BATCHES ----
+class TagTable:
+    """Interned tags: each distinct tag is kept once and referred to by id."""
+
+    __slots__ = ("names", "_ids")
+
     def __init__(self):
+        self.names: List[str] = []
+        self._ids: Dict[str, int] = {}
+
+    def ids(self, tags: Sequence[str]) -> array:
+        """Return the ids of tags, interning the tags seen for the first time."""
+        known = self._ids
+        for tag in set(tags).difference(known):
+            known[tag] = len(self.names)
+            self.names.append(tag)
+        return array("i", map(known.__getitem__, tags))
+
+
+class _DayNames(dict):
+    # day ordinal -> YYYY-MM-DD, filled on first use; 0 is no date
+    def __missing__(self, day: int) -> Union[str, None]:
+        name = self[day] = date.fromordinal(day).isoformat() if day else None
+        return name
+
+
+class PfimEntryBatch:
+    """Report entries held column by column.
+
+    Dates are day ordinals (date.toordinal(), 0 for no date) in an array of
+    ints, amounts are doubles and tags are ids into a TagTable shared by
+    the batches of a report, so only the descriptions are Python objects.
+    An entry takes about a third of the memory of a PfimEntry with its date.
+    Entries are made on demand: indexing and iterating a batch return
+    PfimEntry views, and rows() returns the rows with ISO dates that the
+    writers of Report format. The batches of a report with a running
+    balance also hold the balance after each entry.
+    """
+
+    __slots__ = ("tags", "days", "tag_ids", "descriptions", "amounts",
+        "balances")
+
+    def __init__(self, tags: TagTable, days: array = None,
+        tag_ids: array = None, descriptions: Sequence[str] = (),
+        amounts: array = None):
+        self.tags = tags
+        self.days = days if days is not None else array("i")
+        self.tag_ids = tag_ids if tag_ids is not None else array("i")
+        self.descriptions = descriptions
+        self.amounts = amounts if amounts is not None else array("d")
+        self.balances: Union[array, None] = None
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Tuple],
+        tags: TagTable) -> "PfimEntryBatch":
+        """Build a batch from (day ordinal, tag, description, amount) rows,
+        as read by the report statements; the id that ends the rows of a
+        keyset page is left out."""
+        if not rows:
+            return cls(tags)
+        days, tagcol, descriptions, amounts = list(zip(*rows))[:4]
+        try:
+            days = array("i", days)
+        except TypeError:
+            days = array("i", [day or 0 for day in days])
+        try:
+            amounts = array("d", amounts)
+        except TypeError:
+            amounts = array("d", [float("nan") if amount is None else amount
+                for amount in amounts])
+        return cls(tags, days, tags.ids(tagcol), descriptions, amounts)
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def __getitem__(self, index: int) -> PfimEntry:
+        day = self.days[index]
+        return PfimEntry(date.fromordinal(day) if day else None,
+            self.tags.names[self.tag_ids[index]], self.descriptions[index],
+            self.amounts[index])
+
+    def __iter__(self) -> Generator:
+        names, fromordinal = self.tags.names, date.fromordinal
+        for day, tag, description, amount in zip(self.days, self.tag_ids,
+            self.descriptions, self.amounts):
+            yield PfimEntry(fromordinal(day) if day else None, names[tag],
+                description, amount)
+
+    def rows(self, days: _DayNames) -> Iterable[Tuple]:
+        """Return the (date, tag, description, amount) rows of the batch,
+        dates as YYYY-MM-DD strings looked up in days. The balance after
+        each entry ends its row when the batch has balances."""
+        columns = [map(days.__getitem__, self.days),
+            map(self.tags.names.__getitem__, self.tag_ids),
+            self.descriptions, self.amounts]
+        if self.balances is not None:
+            columns.append(self.balances)
+        return zip(*columns)
+
+    @property
+    def nbytes(self) -> int:
+        """Rough size of the batch."""
+        balances = 0 if self.balances is None else self.balances.itemsize
+        return len(self) * (_BATCH_ROW_BYTES + balances) + sum(
+            map(sys.getsizeof, self.descriptions))
+
+
+def _row_chunks(rows: Iterable[Tuple], size: int = _REPORT_CHUNK
+    ) -> Generator:
+    # cut rows into lists of size rows
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _make_entry(row: Tuple) -> PfimEntry:
+    # the PfimEntry of a report row
+    day = row[0]
+    return PfimEntry(date.fromordinal(day) if day else None, *row[1:4])
+
+
+class _ListWriter:
+    def __init__(self, out: List[str]):
+        self.write = out.append
+
+
+class Report:
+    """Streaming report renderer.
+
+    Entries are formatted as they are pulled from the iterable, and written
+    in chunks of joined lines, so a report of any size is rendered in
+    constant memory. In the table format the column widths come from the
+    first entries; a later, longer value widens its own line only. With
+    balance, entries are followed by the running balance after them.
+    """
+
+    FORMATS = ("table", "csv", "jsonl")
+
+    def __init__(self, fmt: str = "table", color: bool = False,
+        sample: int = _REPORT_SAMPLE, chunksize: int = _REPORT_CHUNK,
+        balance: bool = False):
         self._logger = logging.getLogger("pfim.Report")
-        self._fmt = None
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unknown report format: {fmt}")
+        self._fmt = fmt
+        self._color = color
+        self._balance = balance
+        self._sample = sample
+        self._chunksize = chunksize
         self._head = None
         self._line = None
 
-    def create_entry(self, *args, **kw):
-        pass
+    def _make_table(self, sample: List[PfimEntry]) -> None:
+        wtag = max([len(str(e[1])) for e in sample] + [3])
+        wdescr = max([len(str(e[2])) for e in sample] + [11])
+        wamount = max([len(f"{e[3]:.2f}") for e in sample] + [6])
+        self._head = (f"{'DATE':<10}  {'TAG':<{wtag}}  "
+            f"{'DESCRIPTION':<{wdescr}}  {'AMOUNT':>{wamount}}")
+        line = (f"{{0!s:<10}}  {{1!s:<{wtag}}}  {{2!s:<{wdescr}}}  "
+            f"{{3:>{wamount}.2f}}")
+        if self._balance:
+            wbalance = max([len(f"{e[4]:.2f}") for e in sample] + [7])
+            self._head += f"  {'BALANCE':>{wbalance}}"
+            line += f"  {{4:>{wbalance}.2f}}"
+        line += "\n"
+        if self._color:
+            self._head = OutputBeautify(self._head).decorate(
+                "white", bold=True)
+            # only the amount is colored
+            amount = line.index("{3")
+            end = line.index("}", amount) + 1
+            spent = (line[:amount] + _style_prefix("red", "normal", False,
+                False) + line[amount:end] + _RESET + line[end:])
+            earned = (line[:amount] + _style_prefix("green", "normal", False,
+                False) + line[amount:end] + _RESET + line[end:])
+            spent, earned = spent.format, earned.format
+            self._line = lambda *e: (spent if e[3] < 0 else earned)(*e)
+        else:
+            self._line = line.format
+
+    def _lines(self, entries: Iterable[PfimEntry]) -> Generator:
+        if self._fmt == "table":
+            entries = iter(entries)
+            sample = list(itertools.islice(entries, self._sample))
+            self._make_table(sample)
+            yield self._head + "\n"
+            fmt = self._line
+            for entry in itertools.chain(sample, entries):
+                yield fmt(*entry)
+        elif self._fmt == "csv":
+            import csv
+            out = []
+            # the writer appends each formatted row to out
+            writer = csv.writer(_ListWriter(out), lineterminator="\n")
+            writerow, pop = writer.writerow, out.pop
+            fields = PfimEntry._fields + (("balance",) if self._balance
+                else ())
+            for entry in itertools.chain((fields,), entries):
+                writerow(entry)
+                yield pop()
+        elif self._balance:
+            import json
+            enc = json.JSONEncoder(ensure_ascii=False).encode
+            for d, tag, descr, amount, balance in entries:
+                yield (f'{{"date": "{d}", "tag": {enc(tag)}, '
+                    f'"description": {enc(descr)}, "amount": {amount!r}, '
+                    f'"balance": {balance!r}}}\n')
+        else:
+            import json
+            enc = json.JSONEncoder(ensure_ascii=False).encode
+            for d, tag, descr, amount in entries:
+                yield (f'{{"date": "{d}", "tag": {enc(tag)}, '
+                    f'"description": {enc(descr)}, "amount": {amount!r}}}\n')
+
+    def write(self, entries: Iterable[PfimEntry], file=sys.stdout) -> int:
+        """Render entries to file and return the number of entries.
+
+        The entries may be any (date, tag, description, amount) rows,
+        followed by the balance with balance.
+        """
+        # table and csv output start with a header line
+        header = 0 if self._fmt == "jsonl" else 1
+        count = 0
+        lines = self._lines(entries)
+        while True:
+            chunk = list(itertools.islice(lines, self._chunksize))
+            if not chunk:
+                break
+            count += len(chunk)
+            file.write("".join(chunk))
+        return max(count - header, 0)
+
+    def write_batches(self, batches: Iterable[PfimEntryBatch],
+        file=sys.stdout) -> int:
+        """Render batches of entries to file and return the number of
+        entries.
+
+        No PfimEntry is made: the rows are read from the columns, and each
+        date is formatted once.
+        """
+        days = _DayNames()
+        return self.write(itertools.chain.from_iterable(
+            batch.rows(days) for batch in batches), file)
+
+    def write_balance(self, day: str, balance: float,
+        file=sys.stdout) -> None:
+        """Render the balance as of day."""
+        if self._fmt == "table":
+            print(f"Balance as of {day}: {balance:.2f}", file=file)
+        elif self._fmt == "csv":
+            file.write(f"date,balance\n{day},{balance!r}\n")
+        else:
+            file.write(f'{{"date": "{day}", "balance": {balance!r}}}\n')
+
+    def write_summary(self, summary: Union["ReportSummary", Dict],
+        file=sys.stdout, group: str = "group") -> None:
+        """Render one summary, or a dict of summaries keyed by group."""
+        if self._fmt == "table":
+            if isinstance(summary, dict):
+                for key, value in summary.items():
+                    print(f"{group.upper()}: {key}{value}", file=file)
+            else:
+                print(summary, file=file)
+            return
+        groups = summary if isinstance(summary, dict) else {None: summary}
+        fields = ("count", "minimum", "maximum", "mean", "median", "stdev")
+        if self._fmt == "csv":
+            import csv
+            writer = csv.writer(file, lineterminator="\n")
+            writer.writerow((group,) + fields)
+            for key, value in groups.items():
+                writer.writerow((key,) + tuple(
+                    getattr(value, name) for name in fields))
+        else:
+            import json
+            for key, value in groups.items():
+                record = {group: key}
+                record.update((name, getattr(value, name)) for name in fields)
+                file.write(json.dumps(record) + "\n")
+
+
+class _Deviations:
+    """The SQLite aggregate pfim_m2(amount): the sum of squared deviations
+    of the amounts from their mean, by Welford's update."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, value: float) -> None:
+        if value is None:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self) -> float:
+        return self.m2
+
 
 class ReportSummary:
-    def __init__(self, data: List[float]):
+    """Summary statistics of report amounts.
+
+    The values are consumed in a single pass, so data can be a generator,
+    and two summaries can be merged into the summary of both data sets.
+    Quantiles are approximate once the data outgrows the exact buffer of
+    StreamingStats.
+    """
+
+    def __init__(self, data: Iterable[float] = ()):
         self._logger = logging.getLogger("pfim.ReportSummary")
-        self._data = data
-        self._compute()
+        self._stats = StreamingStats()
+        self._stats.update(data)
+
+    @classmethod
+    def from_aggregates(cls, count: int, total: float, minimum: float,
+        maximum: float, m2: float) -> "ReportSummary":
+        """Build a summary from count/sum/min/max aggregates and the sum of
+        squared deviations from the mean, see _summary_moments().
+
+        Such a summary has no quantiles, its median is None.
+        """
+        summary = cls()
+        summary._stats = StreamingStats.from_moments(
+            count, total, minimum, maximum, m2)
+        return summary
 
-    def _compute(self):
-        self._count = len(self._data)
-        self._min = min(self._data)
-        self._max = max(self._data)
-        self._median = statistics.median(self._data)
-        self._mean = statistics.fmean(self._data)
-        self._stdev = statistics.stdev(self._data)
+    def add(self, value: float) -> None:
+        self._stats.add(value)
+
+    def update(self, values: Iterable[float]) -> None:
+        self._stats.update(values)
+
+    def merge(self, other: "ReportSummary") -> "ReportSummary":
+        self._stats.merge(other._stats)
+        return self
+
+    def quantile(self, q: float) -> Union[float, None]:
+        return self._stats.quantile(q)
+
+    @property
+    def count(self) -> int:
+        return self._stats.count
+
+    @property
+    def minimum(self) -> Union[float, None]:
+        return self._stats.min
+
+    @property
+    def maximum(self) -> Union[float, None]:
+        return self._stats.max
+
+    @property
+    def mean(self) -> Union[float, None]:
+        return self._stats.mean if self._stats.count else None
+
+    @property
+    def median(self) -> Union[float, None]:
+        return self._stats.median
+
+    @property
+    def stdev(self) -> Union[float, None]:
+        return self._stats.stdev
 
     def __str__(self):
+        # summaries computed by the database or the rollup have no median
+        median = (f"\n            Median: {self.median}"
+            if self._stats.has_quantiles else "")
         summary = f"""
         SUMMARY
         -------
-            Count: {self._count}
-            Minimum: {self._min}
-            Maximum: {self._max}
-            Average: {self._mean}
-            Median: {self._median}
-            Stdev: {self._stdev}
+            Count: {self.count}
+            Minimum: {self.minimum}
+            Maximum: {self.maximum}
+            Average: {self.mean}{median}
+            Stdev: {self.stdev}
         """
         return summary
 
 
+# ---- REPORT QUERY COMPILER ----
+# dates are read as day ordinals, see PfimEntryBatch; julianday() of
+# 0001-01-01 is 1721425.5 and its ordinal 1
+_REPORT_COLUMNS = ("CAST(julianday(opdate) - 1721424.5 AS INTEGER), tag, "
+    "description, amount")
+# (option, predicate) pairs, in the order the predicates are emitted;
+# --for-tag also matches the tags under TAG
+_REPORT_FILTERS = (
+    ("tagQuery", _TAG_SUBTREE),
+    ("onQuery", "opdate = ?"),
+    ("afterQuery", "opdate > ?"),
+    ("beforeQuery", "opdate < ?"),
+)
+_REPORT_SORTS = (
+    ("sortDate", "opdate"),
+    ("sortTag", "tag"),
+    ("sortAmount", "amount"),
+)
+# the report column of each sort option
+_REPORT_SORT_INDEX = {"sortDate": 0, "sortTag": 1, "sortAmount": 3}
+# keyset pages (--limit, --after-cursor) are ordered on the sort options,
+# then on (opdate, id), which is unique even across partitions. A page
+# starts after the key of the last entry of the previous one, so it costs
+# the same however deep it is. NULL can not be compared, hence ifnull().
+_KEYSET_SORTS = (
+    ("sortDate", "opdate"),
+    ("sortTag", "ifnull(tag, '')"),
+    ("sortAmount", "amount"),
+)
+_KEYSET_TAIL = ("opdate", "id")
+_REPORT_DATES = ("onQuery", "afterQuery", "beforeQuery")
+# columns of a partition's ledger read through a union
+_PARTITION_COLUMNS = "pfim.id, opdate, tag, description, amount, kind"
+_SUMMARY_COLUMNS = ("count(amount), sum(amount), min(amount), max(amount), "
+    "sum(amount * amount)")
+# the same, with the sum of squared deviations from the mean in place of
+# the sum of squares: exact, but a Python call per entry
+_EXACT_SUMMARY_COLUMNS = ("count(amount), sum(amount), min(amount), "
+    "max(amount), pfim_m2(amount)")
+# a variance computed from sums of squares that are more than this many
+# times larger than it has lost more than 6 of its 16 digits: the summary
+# is computed again from the deviations
+_CANCELLATION = 1e6
+# --group-by keys; opdate is stored as YYYY-MM-DD text
+_SUMMARY_GROUPS = {
+    "tag": "tag",
+    "month": "substr(opdate, 1, 7)",
+    "year": "substr(opdate, 1, 4)",
+}
+# report --analytics: days since 1970-01-01, amount and tag, which the
+# (tag_id, opdate, amount) index covers but for the tag's path, looked up
+# in the small tags table; the kind follows from the amount
+_ANALYTICS_COLUMNS = ("CAST(julianday(opdate) - 2440587.5 AS INTEGER), "
+    "amount, tag")
+_ROLLUP_SUMMARY_COLUMNS = ("sum(cnt), sum(total), min(minval), max(maxval), "
+    "sum(sumsq)")
+_ROLLUP_GROUPS = {
+    "tag": "tag",
+    "month": "month",
+    "year": "substr(month, 1, 4)",
+}
+_ROLLUP_FILTERS = (
+    ("tagQuery", _TAG_SUBTREE),
+    ("afterQuery", "month > ?"),
+    ("beforeQuery", "month < ?"),
+)
+
+
+def _search_terms(text: str) -> List[Tuple[str, bool]]:
+    # the (word, prefix) pairs of a --search TEXT
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append((word, prefix))
+    return terms
+
+
+def _fts_query(terms: List[Tuple[str, bool]]) -> str:
+    # every word is quoted, so that no FTS5 query syntax gets through
+    return " ".join('"' + word.replace('"', '""') + '"' + ("*" if prefix
+        else "") for word, prefix in terms)
+
+
+def _like_patterns(terms: List[Tuple[str, bool]]) -> List[str]:
+    escape = lambda word: (word.replace("\\", "\\\\")
+        .replace("%", "\\%").replace("_", "\\_"))
+    return [f"%{escape(word)}%" for word, _ in terms]
+
+
+def _tag_join(schema: str = "", inner: bool = False) -> str:
+    # the join of a table having a tag_id with the tag dictionary. Entries
+    # without a tag are only left out when the tag is filtered on; a LEFT
+    # JOIN of unused tags is not run at all.
+    prefix = f"{schema}." if schema else ""
+    join = "JOIN" if inner else "LEFT JOIN"
+    return f"{join} {prefix}tags AS tags USING (tag_id)"
+
+
+def _tag_source(table: str, schema: str = "", inner: bool = False) -> str:
+    # table joined with the tag dictionary. When the tag is filtered on,
+    # CROSS JOIN makes the matching tags the outer loop, each looked up in
+    # the tag index of table: the subtree predicate can not use an index,
+    # and without statistics the planner would scan table instead.
+    prefix = f"{schema}." if schema else ""
+    if inner:
+        return (f"{prefix}tags AS tags CROSS JOIN {prefix}{table} "
+            f"AS {table} USING (tag_id)")
+    return f"{prefix}{table} AS {table} {_tag_join(schema)}"
+
+
+def _compile_source(search: Tuple, rank: bool = False,
+    schemas: Tuple[str, ...] = (), inner: bool = False) -> str:
+    # with the full-text index, the matches come first and are joined with
+    # the ledger; its MATCH placeholder is the first of the statement.
+    # CROSS JOIN keeps the matches as the outer loop: with a kind filter
+    # the planner would otherwise walk the kind index and run the MATCH
+    # once per entry. inner is set when the tag is filtered on.
+    fts = search[:1] == ("fts",)
+    columns = "rowid, rank" if rank else "rowid"
+    if not schemas:
+        if not fts:
+            return _tag_source("pfim", "", inner)
+        return (f"(SELECT {columns} FROM pfim_fts WHERE pfim_fts MATCH ?) "
+            f"AS s CROSS JOIN pfim ON pfim.id = s.rowid "
+            + _tag_join("", inner))
+    # partitions: the union of the ledger of every schema, pruned by the
+    # filters pushed into each branch. The branches share the MATCH value
+    # as ?1.
+    if not fts:
+        return _compile_tables("pfim", _PARTITION_COLUMNS, schemas, inner)
+    selected = _PARTITION_COLUMNS + (", s.rank" if rank else "")
+    return "(" + " UNION ALL ".join(
+        f"SELECT {selected} FROM (SELECT {columns} FROM {schema}.pfim_fts "
+        f"WHERE pfim_fts MATCH ?1) AS s CROSS JOIN {schema}.pfim AS pfim "
+        f"ON pfim.id = s.rowid {_tag_join(schema, inner)}"
+        for schema in schemas) + ") AS s"
+
+
+def _compile_tables(table: str, columns: str,
+    schemas: Tuple[str, ...], inner: bool = False) -> str:
+    # table joined with the tag dictionary, as it is or the union of its
+    # copies in schemas
+    if not schemas:
+        return _tag_source(table, "", inner)
+    return "(" + " UNION ALL ".join(
+        f"SELECT {columns} FROM {_tag_source(table, schema, inner)}"
+        for schema in schemas) + f") AS {table}"
+
+
+def _compile_where(filters: Tuple[str, ...], kind: bool,
+    search: Tuple = ()) -> str:
+    where = [pred for opt, pred in _REPORT_FILTERS if opt in filters]
+    if kind:
+        where.insert(0, "kind = ?")
+    if search[:1] == ("like",):
+        # one pattern per word, after the other placeholders
+        where.extend(["description LIKE ? ESCAPE '\\'"] * search[1])
+    return " WHERE " + " AND ".join(where) if where else ""
+
+
+def _keyset_columns(sorts: Tuple[str, ...]) -> List[str]:
+    # the key a keyset page is ordered on
+    columns = [col for opt, col in _KEYSET_SORTS if opt in sorts]
+    return columns + [col for col in _KEYSET_TAIL if col not in columns]
+
+
+def _keyset_key(sorts: Tuple[str, ...]) -> Callable[[Tuple], List]:
+    # the key of a keyset page row, ordered as _keyset_columns(sorts);
+    # the day ordinal stands for opdate
+    index = {"opdate": 0, "amount": 3, "id": 4}
+    columns = _keyset_columns(sorts)
+    if "ifnull(tag, '')" not in columns:
+        return lambda row: [row[index[col]] for col in columns]
+    return lambda row: [row[1] or "" if col == "ifnull(tag, '')"
+        else row[index[col]] for col in columns]
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_report(filters: Tuple[str, ...], kind: bool,
+    sorts: Tuple[str, ...], limit: bool, search: Tuple = (),
+    schemas: Tuple[str, ...] = (), keyset: bool = False,
+    after: bool = False) -> str:
+    """Build the report statement for one shape of report options.
+
+    The shape is the set of filter and sort options in use, and the
+    statement only has placeholders for their values, so it can be cached
+    and reused whatever the values are. search is () without --search,
+    ("fts",) with the full-text index and ("like", words) without it.
+    schemas are the partitions to read, () for a single-file ledger.
+    A keyset page also reads the id of its entries, and with after only
+    has the entries following the key given by the last placeholders
+    before the limit.
+    """
+    columns = _REPORT_COLUMNS + (", id" if keyset else "")
+    where, order = _compile_where(filters, kind, search), ""
+    if keyset:
+        keys = _keyset_columns(sorts)
+        if after:
+            where += " AND " if where else " WHERE "
+            where += (f"({', '.join(keys)}) > "
+                f"({', '.join('?' * len(keys))})")
+        order = " ORDER BY " + ", ".join(keys)
+    elif sorts:
+        keys = [col for opt, col in _REPORT_SORTS if opt in sorts]
+        order = " ORDER BY " + ", ".join(keys + ["id"])
+    elif search[:1] == ("fts",):
+        # best matches first, bm25 ranks lower is better
+        order = " ORDER BY s.rank, id"
+    if (limit and len(schemas) <= 1 and search[:1] != ("fts",)
+        and "tagQuery" not in filters and "sortTag" not in sorts):
+        # the entries of a page are picked and sorted on their own, and
+        # only they are joined with their tags
+        schema = schemas[0] if schemas else ""
+        prefix = f"{schema}." if schema else ""
+        return (f"SELECT {columns} FROM (SELECT opdate, tag_id, "
+            f"description, amount, id FROM {prefix}pfim AS pfim{where}{order}"
+            f" LIMIT ?) AS pfim {_tag_join(schema)}{order}")
+    sql = (f"SELECT {columns} FROM "
+        + _compile_source(search, True, schemas, "tagQuery" in filters))
+    sql += where + order
+    if limit:
+        sql += " LIMIT ?"
+    return sql
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_summary(filters: Tuple[str, ...], kind: bool,
+    group: Union[str, None], search: Tuple = (),
+    schemas: Tuple[str, ...] = (), exact: bool = False) -> str:
+    """Build the aggregate statement of a summary, one row per group.
+
+    The last column is the sum of squares of the amounts, or with exact
+    the sum of their squared deviations from the mean.
+    """
+    groupexpr = _SUMMARY_GROUPS[group] if group else "NULL"
+    columns = _EXACT_SUMMARY_COLUMNS if exact else _SUMMARY_COLUMNS
+    sql = (f"SELECT {groupexpr} AS grp, {columns} FROM "
+        + _compile_source(search, False, schemas, "tagQuery" in filters)
+        + _compile_where(filters, kind, search))
+    if group:
+        sql += " GROUP BY grp ORDER BY grp"
+    return sql
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_analytics(filters: Tuple[str, ...], kind: bool,
+    search: Tuple = (), schemas: Tuple[str, ...] = ()) -> str:
+    """Build the statement reading the columns of report --analytics."""
+    return (f"SELECT {_ANALYTICS_COLUMNS} FROM "
+        + _compile_source(search, False, schemas, "tagQuery" in filters)
+        + _compile_where(filters, kind, search))
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_opening(filters: Tuple[str, ...], kind: bool,
+    search: Tuple = (), schemas: Tuple[str, ...] = ()) -> str:
+    """Build the statement summing the amounts a running balance starts
+    from: those of the entries selected by the filters that come before
+    the (opdate, id) key given by the last two placeholders."""
+    where = _compile_where(filters, kind, search)
+    where += " AND " if where else " WHERE "
+    return ("SELECT total(amount) FROM "
+        + _compile_source(search, False, schemas, "tagQuery" in filters)
+        + where + "(opdate, id) < (?, ?)")
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_rollup_summary(filters: Tuple[str, ...], kind: bool,
+    group: Union[str, None], schemas: Tuple[str, ...] = ()) -> str:
+    """Build the summary statement answered from the monthly rollup.
+
+    filters may only hold tagQuery, afterQuery and beforeQuery, the date
+    bounds being given as YYYY-MM months.
+    """
+    groupexpr = _ROLLUP_GROUPS[group] if group else "NULL"
+    where = [pred for opt, pred in _ROLLUP_FILTERS if opt in filters]
+    if kind:
+        where.insert(0, "kind = ?")
+    # the rollup is read with the path of its tags
+    columns = _ROLLUP_COLUMNS.format(key="tag")
+    sql = (f"SELECT {groupexpr} AS grp, {_ROLLUP_SUMMARY_COLUMNS} FROM "
+        + _compile_tables("pfim_rollup", columns, schemas,
+            "tagQuery" in filters))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if group:
+        sql += " GROUP BY grp ORDER BY grp"
+    return sql
+
+
+def _rollup_months(kw: Dict) -> Union[Dict[str, str], None]:
+    # Map the date filters of a summary onto months, or return None when
+    # they do not fall on month boundaries.
+    if kw.get("onQuery") is not None:
+        return None
+    months = {}
+    if kw.get("beforeQuery") is not None:
+        before = date.fromisoformat(kw["beforeQuery"])
+        if before.day != 1:
+            return None
+        months["beforeQuery"] = before.isoformat()[:7]
+    if kw.get("afterQuery") is not None:
+        after = date.fromisoformat(kw["afterQuery"])
+        if (after + timedelta(days=1)).day != 1:
+            return None
+        months["afterQuery"] = after.isoformat()[:7]
+    return months
+
+
+def _report_range(kw: Dict) -> Tuple[Union[str, None], Union[str, None]]:
+    # the first and last dates a report may read, None for no bound;
+    # --after and --before exclude their date
+    if kw.get("allQuery"):
+        return None, None
+    if kw.get("onQuery") is not None:
+        return kw["onQuery"], kw["onQuery"]
+    first, last = kw.get("afterQuery"), kw.get("beforeQuery")
+    if first is not None:
+        first = (date.fromisoformat(first) + timedelta(days=1)).isoformat()
+    if last is not None:
+        last = (date.fromisoformat(last) - timedelta(days=1)).isoformat()
+    return first, last
+
+
+def _encode_cursor(sorts: Tuple[str, ...], row: Tuple) -> str:
+    # the --after-cursor token of the key of a keyset page row, which
+    # ends with the id of the entry. The sort options it is made for are
+    # part of it, so that it is not used with another order.
+    import base64
+    import json
+    day = date.fromordinal(row[0]).isoformat()
+    values = {"opdate": day, "ifnull(tag, '')": row[1] or "",
+        "amount": row[3], "id": row[4]}
+    key = [values[col] for col in _keyset_columns(sorts)]
+    token = json.dumps([list(sorts), key], separators=(",", ":"))
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(token: str, sorts: Tuple[str, ...]
+    ) -> Union[List, None]:
+    # the key of a token made by _encode_cursor for sorts, None if it is
+    # not one
+    import base64
+    import binascii
+    import json
+    try:
+        shape, key = json.loads(base64.urlsafe_b64decode(
+            token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if shape != list(sorts) or not isinstance(key, list) or (
+        len(key) != len(_keyset_columns(sorts))):
+        return None
+    # the values of a row, which JSON may have turned into anything else
+    if any(value is not None and (isinstance(value, bool)
+        or not isinstance(value, (str, int, float))) for value in key):
+        return None
+    return key
+
+
+def _delete_range(filters: Iterable[Tuple[str, str, object]]
+    ) -> Tuple[Union[str, None], Union[str, None]]:
+    # the first and last dates a delete may touch, None for no bound
+    first = last = None
+    for column, op, value in filters:
+        if column == "opdate" and op in ("=", ">"):
+            first = value
+        if column == "opdate" and op in ("=", "<"):
+            last = value
+    return first, last
+
+
+def _merge_summaries(parts: Iterable[Iterable[Tuple]],
+    exact: bool = False) -> List[Tuple]:
+    # combine summary rows (group, count, sum, min, max, sum of squares)
+    # of the same group; with exact, the last column is the sum of squared
+    # deviations from the mean, combined with Chan's formula
+    groups = {}
+    for row in itertools.chain.from_iterable(parts):
+        if not row[1]:
+            continue
+        prev = groups.get(row[0])
+        if prev is not None:
+            last = prev[5] + row[5]
+            if exact:
+                delta = row[2] / row[1] - prev[2] / prev[1]
+                last += delta * delta * prev[1] * row[1] / (prev[1] + row[1])
+            row = (row[0], prev[1] + row[1], prev[2] + row[2],
+                min(prev[3], row[3]), max(prev[4], row[4]), last)
+        groups[row[0]] = row
+    return [groups[grp] for grp in sorted(groups,
+        key=lambda grp: (grp is not None, grp))]
+
+
+def _summary_moments(rows: Iterable[Tuple]) -> Union[List[Tuple], None]:
+    """Turn summary rows ending with the sum of squares of the amounts
+    into rows ending with the sum of their squared deviations from the
+    mean.
+
+    Returns None when that difference cancels out most of the digits of
+    a group, as with large amounts that vary little: the rows must then
+    be read again with _compile_summary(exact=True).
+    """
+    moments = []
+    for grp, count, total, minimum, maximum, sumsq in rows:
+        if not count:
+            continue
+        m2 = 0.0
+        if minimum != maximum:
+            m2 = sumsq - total * total / count
+            if m2 * _CANCELLATION <= sumsq:
+                return None
+        moments.append((grp, count, total, minimum, maximum, m2))
+    return moments
+
+
+class _ResultCache:
+    """LRU cache of query results stamped with PfimData.data_version().
+
+    An entry is only returned for the stamp it was stored with, so a
+    result is never served after the ledger has changed. Entries are
+    evicted, least recently used first, when there are more than maxsize
+    of them or when their estimated size exceeds maxbytes.
+    """
+
+    def __init__(self, maxsize: int = _CACHE_SIZE,
+        maxbytes: int = _CACHE_BYTES):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, stamp):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != stamp:
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, stamp, value, nbytes: int) -> None:
+        if not self.maxsize or nbytes > self.maxbytes:
+            return
+        self._discard(key)
+        self._entries[key] = (stamp, value, nbytes)
+        self.nbytes += nbytes
+        while (len(self._entries) > self.maxsize
+            or self.nbytes > self.maxbytes):
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self.nbytes -= size
+
+    def _discard(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+
+
+def _compile_delete(filters: Iterable[Tuple[str, str, object]]) -> PfimQuery:
+    preds, args = [], []
+    for column, op, value in filters:
+        if op == "IN":
+            preds.append(f"{column} IN ({', '.join('?' * len(value))})")
+            args.extend(value)
+        else:
+            preds.append(f"{column} {op} ?")
+            args.append(value)
+    where = f" WHERE {' AND '.join(preds)}" if preds else ""
+    return PfimQuery(f"DELETE FROM pfim{where}", tuple(args))
+
+
 class PfimCore:
     """PFIM Core class."""
     
     prolog = ""
     epilog = ""
 
-    def __init__(self):
+    def __init__(self, dbname: str = _DBNAME, data: PfimData = None,
+        writer: GroupCommitWriter = None, cache_size: int = _CACHE_SIZE,
+        cache_bytes: int = _CACHE_BYTES):
         self._logger = logging.getLogger("pfim.PfimCore")
         self._mode = None
         self._output = None
         self._query_history = Queue(maxsize=128)
+        # results of repeated reports, 0 disables it
+        self._cache = _ResultCache(cache_size, cache_bytes)
+        self._query = None
+        # one query per statement of the last report, several when it
+        # spans partitions that one connection can not attach together
+        self._parts: Tuple[PfimQuery, ...] = ()
+        # a summary's statements summing the squared deviations instead
+        self._exact: Tuple[PfimQuery, ...] = ()
+        self._sorts: Tuple[str, ...] = ()
+        # --jobs: the statements of the last summary, one per date range,
+        # and the number of processes running them
+        self._chunks: Tuple[PfimQuery, ...] = ()
+        self._jobs = 1
+        self._limit = None
+        # keyset pages: whether the last report is one, and the token of
+        # the page after it once it has been read, see cursor
+        self._keyset = False
+        self._cursor = None
+        # --running-balance: whether the last report has one, and the
+        # (filters, kind, search, args) its opening balance is summed
+        # with, None when it is read from the balance index
+        self._running = False
+        self._scope = None
+        self._group = None
+        self._format = "table"
+        self._db = data if data is not None else _open_data(dbname)
+        # writes go through the group commit writer when there is one
+        self._writer = writer
+
+    def _remember(self, query: PfimQuery) -> None:
+        if self._query_history.full():
+            self._query_history.get_nowait()
+        self._query_history.put_nowait(query)
 
     def record(self, kw: Dict) -> PfimQuery:
-        pass
-
-    def update(self, kw: Dict) -> PfimQuery:
-        pass
+        query = self._record_query(kw)
+        if self._writer is not None:
+            try:
+                self._writer.submit(query.query, query.args,
+                    self._db.store(kw["recdate"])).result()
+            except sqlite3.Error as err:
+                self._logger.error(
+                    f"Failed to add a new entry to database. {err}")
+                sys.exit(1)
+        else:
+            self._db.store(kw["recdate"]).add_entry(query.query, *query.args)
+        self._remember(query)
+        return query
+
+    def _record_query(self, kw: Dict) -> PfimQuery:
+        if kw.get("expense") is not None:
+            amount = -abs(kw["expense"])
+        elif kw.get("income") is not None:
+            amount = abs(kw["income"])
+        else:
+            self._logger.error("Either --exp or --inc is required")
+            sys.exit(1)
+        if not _validate_datestr(kw["recdate"]):
+            self._logger.error(f"Invalid date: {kw['recdate']}")
+            sys.exit(1)
+        tag = kw["rectag"]
+        tag_id = self._db.store(kw["recdate"]).tag_ids([tag])[tag]
+        return PfimQuery(_INSERT_SQL,
+            (kw["recdate"], tag_id, kw["descr"], amount))
+
+    def _write(self, query: PfimQuery, data: PfimData, run: Callable) -> int:
+        # run is the method of data used without a group commit writer
+        if self._writer is not None:
+            try:
+                return self._writer.submit(query.query, query.args,
+                    data).result()
+            except sqlite3.Error as err:
+                self._logger.error(f"Failed to write to database. {err}")
+                sys.exit(1)
+        return run(query.query, *query.args)
+
+    def update(self, kw: Dict) -> int:
+        """Apply an update command and return the number of changed entries."""
+        column, opdate, old, new = self._update_target(kw)
+        self._writable(opdate, opdate, "updated")
+        count = 0
+        for data in self._db.stores(opdate, opdate):
+            query = self._update_query(data, column, opdate, old, new)
+            count += self._write(query, data, data.update)
+            self._remember(query)
+        return count
+
+    def _update_query(self, data: PfimData, column: str, opdate: str,
+        old: object, new: object) -> PfimQuery:
+        # tags are given by their ids in the dictionary of data; the new
+        # tag is created if needed
+        if column == "tag_id":
+            old = data.tag_ids([old], create=False)[old]
+            new = data.tag_ids([new])[new]
+        return PfimQuery(_UPDATE_SQL.format(column=column), (new, opdate, old))
+
+    def rename_tag(self, kw: Dict) -> int:
+        """Rename a tag and the tags under it, see PfimData.rename_tag().
+
+        Returns the number of renamed tags. Every partition has a tag
+        dictionary of its own, renamed in turn.
+        """
+        old, new = kw["upRename"]
+        self._writable(None, None, "renamed", "Tags", _ARCHIVES_READ_ONLY)
+        return max([data.rename_tag(old, new) for data in self._db.stores()],
+            default=0)
+
+    def _update_target(self, kw: Dict) -> Tuple[str, str, object, object]:
+        """Return the column, date, old and new value of an update."""
+        for opt, column, convert in _UPDATE_OPTIONS:
+            if not kw.get(opt):
+                continue
+            opdate, old, new = kw[opt]
+            if not _validate_datestr(opdate):
+                self._logger.error(f"Invalid date: {opdate}")
+                sys.exit(1)
+            try:
+                return column, opdate, convert(old), convert(new)
+            except ValueError:
+                self._logger.error(f"Invalid amount: {old} or {new}")
+                sys.exit(1)
+        self._logger.error("One of --expense, --income, --tag, --descr or "
+            "--rename-tag is required")
+        sys.exit(1)
+
+    def delete(self, kw: Dict) -> int:
+        """Apply a delete command and return the number of deleted entries."""
+        filters = self._delete_filters(kw)
+        self._writable(*_delete_range(filters), "deleted")
+        count = 0
+        for data in self._db.stores(*_delete_range(filters)):
+            query = _compile_delete(self._store_filters(data, filters))
+            count += self._write(query, data, data.delete)
+            self._remember(query)
+        return count
+
+    def _writable(self, first: str, last: str, done: str,
+        what: str = "Entries",
+        hint: str = "Restrict the dates to other years") -> None:
+        # a write that would skip the archived years is refused rather
+        # than applied to the others
+        archived = self._db.archived(first, last)
+        if archived:
+            self._logger.error(f"{what} of archived years can not be {done}: "
+                f"{', '.join(map(str, archived))}. {hint}")
+            sys.exit(1)
 
-    def delete(self, kw: Dict) -> PfimQuery:
-        pass
+    def _store_filters(self, data: PfimData,
+        filters: List[Tuple[str, str, object]]
+        ) -> List[Tuple[str, str, object]]:
+        # tags are matched by their ids in the dictionary of data
+        tags = [value for column, _, value in filters if column == "tag_id"]
+        if not tags:
+            return filters
+        ids = data.tag_ids(tags, create=False)
+        return [(column, op, ids[value] if column == "tag_id" else value)
+            for column, op, value in filters]
+
+    def _delete_filters(self, kw: Dict) -> List[Tuple[str, str, object]]:
+        """Return the (column, operator, value) filters of a delete.
+
+        --all ignores the other options, and without it a delete needs at
+        least one filter.
+        """
+        if kw.get("rmAll"):
+            return []
+        for opt in _DELETE_DATES:
+            if kw.get(opt) is not None and not _validate_datestr(kw[opt]):
+                self._logger.error(f"Invalid date: {kw[opt]}")
+                sys.exit(1)
+        amounts = []
+        if kw.get("rmExpense") is not None:
+            amounts.append(-abs(kw["rmExpense"]))
+        if kw.get("rmIncome") is not None:
+            amounts.append(abs(kw["rmIncome"]))
+        filters = []
+        if len(amounts) == 1:
+            filters.append(("amount", "=", amounts[0]))
+        elif amounts:
+            filters.append(("amount", "IN", tuple(amounts)))
+        for opt, column, op in _DELETE_FILTERS:
+            if kw.get(opt) is not None:
+                filters.append((column, op, kw[opt]))
+        if not filters:
+            self._logger.error("Refusing to delete every entry without --all")
+            sys.exit(1)
+        return filters
 
     def report(self, kw: Dict) -> PfimQuery:
-        pass
+        """Compile the report options in kw into a single query."""
+        for opt in _REPORT_DATES:
+            if kw.get(opt) is not None and not _validate_datestr(kw[opt]):
+                self._logger.error(f"Invalid date: {kw[opt]}")
+                sys.exit(1)
+        filters, args = [], []
+        search, terms = (), []
+        if kw.get("searchQuery") and not kw.get("allQuery"):
+            terms = _search_terms(kw["searchQuery"])
+        if terms and self._db.has_search():
+            search = ("fts",)
+            args.append(_fts_query(terms))
+        elif terms:
+            search = ("like", len(terms))
+        # --for-exp and --for-inc together select everything
+        kind = bool(kw.get("expQuery")) != bool(kw.get("incQuery"))
+        if kind:
+            args.append(_SPENT_KIND if kw.get("expQuery") else _EARN_KIND)
+        if not kw.get("allQuery"):
+            for opt, _ in _REPORT_FILTERS:
+                if kw.get(opt) is not None:
+                    filters.append(opt)
+                    args.append(kw[opt])
+        if search[:1] == ("like",):
+            args.extend(_like_patterns(terms))
+        self._group = kw.get("groupBy")
+        self._format = kw.get("outFormat") or "table"
+        first, last = _report_range(kw)
+        self._chunks = ()
+        exact = None
+        self._keyset, self._cursor = False, None
+        self._running = False
+        if kw.get("analytics"):
+            # the entries are read as columns, see _analytics
+            self._mode = "analytics"
+            compiler = functools.partial(_compile_analytics, tuple(filters),
+                kind, search)
+        elif kw.get("summaryOnly") or self._group:
+            # the database computes the summary, no row is fetched
+            self._mode = "summary"
+            # the entries themselves, when the sums of squares cancel out
+            exact = (functools.partial(_compile_summary, tuple(filters), kind,
+                self._group, search, exact=True), tuple(args))
+            months = {} if kw.get("allQuery") else _rollup_months(kw)
+            if search:
+                months = None
+            if months is not None:
+                # whole months only: answer from the monthly rollup
+                opts = (["kind"] if kind else []) + filters
+                args = [months.get(opt, arg) for opt, arg in zip(opts, args)]
+                compiler = functools.partial(_compile_rollup_summary,
+                    tuple(filters), kind, self._group)
+            else:
+                compiler = functools.partial(_compile_summary,
+                    tuple(filters), kind, self._group, search)
+                self._jobs = kw.get("jobs") or 1
+                if self._jobs == 0:
+                    self._jobs = os.cpu_count() or 1
+                if self._jobs > 1 and kw.get("onQuery") is None:
+                    self._chunks = self._chunk_parts(kw, filters, args,
+                        kind, search)
+        else:
+            self._mode = "report"
+            self._sorts = tuple(opt for opt, _ in _REPORT_SORTS
+                if kw.get(opt))
+            self._limit = kw.get("limitQuery")
+            token = kw.get("cursorQuery")
+            # pages of a report ranked by relevance have no key
+            ranked = search[:1] == ("fts",) and not self._sorts
+            if kw.get("runningBalance"):
+                self._running_scope(filters, args, kind, search, ranked)
+            if token is not None and ranked:
+                self._logger.error("A --search report can only be paged "
+                    "with a --sort option")
+                sys.exit(1)
+            # a running balance is read in (opdate, id) order, the order
+            # of keyset pages without a sort option
+            self._keyset = not ranked and (self._limit is not None
+                or token is not None or self._running)
+            if token is not None:
+                key = _decode_cursor(token, self._sorts)
+                if key is None:
+                    self._logger.error(f"Invalid cursor for these sort "
+                        f"options: {token}")
+                    sys.exit(1)
+                args.extend(key)
+                if _keyset_columns(self._sorts)[0] == "opdate":
+                    # the partitions before the cursor are not read
+                    first = max(first or key[0], key[0])
+            if self._limit is not None:
+                args.append(self._limit)
+            compiler = functools.partial(_compile_report, tuple(filters),
+                kind, self._sorts, self._limit is not None, search,
+                keyset=self._keyset, after=token is not None)
+        # only the partitions overlapping the dates are read
+        sources = self._db.sources(first, last)
+        if self._keyset:
+            # a statement per partition walks its indexes in key order,
+            # where one over the union of several would sort it whole
+            sources = [(schema,) for schemas in sources
+                for schema in schemas] or sources
+        self._parts = tuple(PfimQuery(compiler(schemas=schemas), tuple(args))
+            for schemas in sources)
+        self._exact = () if exact is None else tuple(PfimQuery(
+            exact[0](schemas=schemas), exact[1]) for schemas in sources)
+        # no partition overlaps the dates: nothing to read
+        query = self._parts[0] if self._parts else PfimQuery(None, ())
+        self._remember(query)
+        self._query = query
+        return query
+
+    def _running_scope(self, filters: List[str], args: List, kind: bool,
+        search: Tuple, ranked: bool) -> None:
+        """Set up the running balance of a report.
+
+        The balance runs over the entries the report lists, in date order,
+        and starts from the amounts of the entries before the first one
+        that the kind, tag and search filters select: the date filters
+        only choose which part of the balance is shown. Without those
+        filters it starts from the balance index, and without
+        --search from the monthly rollup.
+        """
+        if ranked or self._sorts not in ((), ("sortDate",)):
+            self._logger.error("A --running-balance report is in date "
+                "order, it can not be sorted on another column")
+            sys.exit(1)
+        self._running = True
+        # the arguments of the filters follow those of --search and of
+        # the kind, and are followed by the LIKE patterns
+        head = int(search[:1] == ("fts",)) + int(kind)
+        values = dict(zip(filters, args[head:head + len(filters)]))
+        scope = [opt for opt in filters if opt not in _REPORT_DATES]
+        self._scope = None
+        if scope or kind or search:
+            self._scope = (tuple(scope), kind, search, tuple(args[:head]
+                + [values[opt] for opt in scope]
+                + args[head + len(filters):]))
+
+    def _opening(self, row: Tuple) -> float:
+        """Return the running balance before the entry of a report row."""
+        day = date.fromordinal(row[0])
+        if self._scope is None:
+            # the balance of the day before, and the entries of the
+            # day that come before the row
+            balance = self._db.balance((day - timedelta(days=1)).isoformat())
+            day = day.isoformat()
+            filters, kind, search, args = ("onQuery",), False, (), (day,)
+            first = day
+        else:
+            balance, first = 0.0, None
+            filters, kind, search, args = self._scope
+            day = day.isoformat()
+            if not search:
+                # the monthly rollup up to the month of the row, and the
+                # entries of the month that come before the row
+                first = day[:7] + "-01"
+                rollup = _compile_rollup_summary
+                for schemas in self._db.sources(None, day):
+                    balance += next(self._db.fetch(rollup(
+                        filters + ("beforeQuery",), kind, None, schemas),
+                        *args, day[:7]))[2] or 0.0
+                filters += ("afterQuery",)
+                args += ((date.fromisoformat(first)
+                    - timedelta(days=1)).isoformat(),)
+        for schemas in self._db.sources(first, day):
+            balance += next(self._db.fetch(_compile_opening(filters, kind,
+                search, schemas), *args, day, row[4]))[0]
+        return balance
+
+    def _chunk_parts(self, kw: Dict, filters: List[str], args: List,
+        kind: bool, search: Tuple) -> Tuple[PfimQuery, ...]:
+        """Split a summary into statements over consecutive date ranges.
+
+        Each range takes the place of the --after/--before bounds of the
+        report, the other arguments are kept around it.
+        """
+        from ._parallel import _CHUNKS_PER_JOB, date_chunks
+        first, last = _report_range(kw)
+        low, high = self._db.date_span()
+        if low is None:
+            return ()
+        first, last = max(first or low, low), min(last or high, high)
+        if first > last:
+            return ()
+        # the arguments of the filters follow those of --search and of
+        # the kind, and --after and --before are the last filters
+        head = int(search[:1] == ("fts",)) + int(kind)
+        values = dict(zip(filters, args[head:head + len(filters)]))
+        tail = args[head + len(filters):]
+        kept = [opt for opt in filters if opt not in _REPORT_DATES]
+        chunked = tuple(kept + ["afterQuery", "beforeQuery"])
+        parts = []
+        for start, stop in date_chunks(first, last,
+            self._jobs * _CHUNKS_PER_JOB):
+            bounds = [
+                (date.fromisoformat(start) - timedelta(days=1)).isoformat(),
+                (date.fromisoformat(stop) + timedelta(days=1)).isoformat()]
+            chunkargs = (args[:head] + [values[opt] for opt in kept]
+                + bounds + tail)
+            for schemas in self._db.sources(start, stop):
+                parts.append(PfimQuery(_compile_summary(chunked, kind,
+                    self._group, search, schemas), tuple(chunkargs)))
+        # a single statement is not worth starting processes for
+        return tuple(parts) if len(parts) > 1 else ()
+
+    def import_entries(self, kw: Dict) -> Tuple[int, int]:
+        """Stream a statement file into the database.
+
+        Returns the number of imported and of rejected entries.
+        """
+        from ._importer import guess_format, make_reader
+        filename = kw["impFile"]
+        fmt = kw.get("impFormat") or guess_format(filename)
+        fields = dict(item.split("=", 1) for item in kw.get("impMap") or [])
+        newline = "" if fmt == "csv" else None
+        try:
+            fd = (sys.stdin if filename == "-" else
+                open(filename, "r", encoding="utf-8-sig", newline=newline))
+        except OSError as err:
+            self._logger.error(f"Can not open {filename}. {err.strerror}")
+            sys.exit(1)
+        try:
+            reader = make_reader(fd, fmt, fields=fields,
+                delimiter=kw.get("impDelim") or ",",
+                tag=kw.get("impTag") or "N/A",
+                date_format=kw.get("impDateFmt"))
+            count = self._db.add_entries(_INSERT_SQL, reader,
+                kw.get("impChunk") or _CHUNK_SIZE)
+        except (OSError, ValueError) as err:
+            # a missing column, or a file that can not be read or decoded
+            self._logger.error(f"Failed to import {filename}. {err}")
+            sys.exit(1)
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+        if reader.rejected:
+            self._logger.warning(
+                f"{reader.rejected} entries rejected while importing {filename}")
+        return count, reader.rejected
+
+    def execute(self, kw: Dict, file=sys.stdout, err=sys.stderr) -> int:
+        """Run the sub-command named by kw["cmd"].
+
+        Output goes to file, and notes that are not part of it, such as the
+        cursor of the next page of a CSV report, to err. The return value
+        is the exit status. With
+        kw["profile"], a breakdown of the time spent in each statement is
+        printed to stderr.
+        """
+        if not kw.get("profile"):
+            return self._execute(kw, file, err)
+        from ._profile import QueryProfile
+        profile = QueryProfile()
+        self._db.add_hook(profile)
+        start = time.perf_counter()
+        try:
+            return self._execute(kw, file, err)
+        finally:
+            self._db.remove_hook(profile)
+            profile.write(sys.stderr, time.perf_counter() - start,
+                self._db.slow_query)
+
+    def _execute(self, kw: Dict, file, err=sys.stderr) -> int:
+        cmd = kw.get("cmd")
+        if cmd == "record":
+            self.record(kw)
+        elif cmd == "update" and kw.get("upRename"):
+            print(f"Renamed {self.rename_tag(kw)} tags", file=file)
+        elif cmd == "update":
+            print(f"Updated {self.update(kw)} entries", file=file)
+        elif cmd == "delete":
+            print(f"Deleted {self.delete(kw)} entries", file=file)
+        elif cmd == "batch":
+            from ._batch import run_batch
+            return run_batch(self, kw, file)
+        elif cmd == "report":
+            if kw.get("analytics"):
+                return self._analytics(kw, file)
+            if kw.get("balanceQuery") is not None:
+                return self._balance(kw, file)
+            self.report(kw)
+            self.write_output(file, err)
+        elif cmd == "rebuild-rollups":
+            self._writable(None, None,
+                "checked" if kw.get("rollCheck") else "rebuilt",
+                "Rollups and balances", _ARCHIVES_READ_ONLY)
+            if kw.get("rollCheck"):
+                stale = self._db.check_rollups()
+                for month, tag, kind in stale:
+                    print(f"Stale rollup: {month} {tag} {kind}", file=file)
+                print(f"{len(stale)} stale rollup rows", file=file)
+                days = self._db.check_balances()
+                for day in days:
+                    print(f"Stale balance: {day}", file=file)
+                print(f"{len(days)} days with a stale balance", file=file)
+                return 1 if stale or days else 0
+            print(f"Rebuilt {self._db.rebuild_rollups()} rollup rows",
+                file=file)
+            print(f"Rebuilt the balance index, {self._db.rebuild_balances()} "
+                "nodes", file=file)
+        elif cmd == "rebuild-search":
+            self._writable(None, None,
+                "checked" if kw.get("searchCheck") else "rebuilt",
+                "Full-text indexes", _ARCHIVES_READ_ONLY)
+            if kw.get("searchCheck"):
+                ok = self._db.check_search()
+                print("Full-text index is " + ("up to date" if ok else
+                    "missing or out of date"), file=file)
+                return 0 if ok else 1
+            print(f"Rebuilt full-text index of {self._db.rebuild_search()} "
+                "entries", file=file)
+        elif cmd == "partition":
+            return self._partition(kw, file)
+        elif cmd == "archive":
+            if not self._db.partitioned:
+                self._logger.error(
+                    "Only a partitioned ledger can be archived, see "
+                    "'pfim partition'")
+                return 1
+            through = kw.get("arcYear") or date.today().year - 1
+            for year, (_, archived) in sorted(self._db.years().items()):
+                if year <= through and not archived:
+                    print(f"Archived {year} into {self._db.archive(year)}",
+                        file=file)
+        elif cmd in ("backup", "snapshot", "compact"):
+            return self._copy(cmd, kw, file)
+        elif cmd == "import":
+            start = time.perf_counter()
+            count, rejected = self.import_entries(kw)
+            elapsed = time.perf_counter() - start
+            print(f"Imported {count} entries ({rejected} rejected) "
+                f"in {elapsed:.2f}s", file=file)
+        return 0
+
+    def _copy(self, cmd: str, kw: Dict, file) -> int:
+        # backup, snapshot and compact, see _backup
+        from . import _backup
+        if cmd == "backup":
+            dest = kw["bakDest"]
+            stats = _backup.backup(self._db, dest, kw.get("bakIncremental"),
+                kw.get("bakPages") or _backup._BACKUP_PAGES)
+            done = (f"Backed up {stats.files} files, {_mb(stats.size)}, to "
+                f"{dest}, writing {_mb(stats.written)}")
+            if stats.restarts:
+                done += f", restarted {stats.restarts} times by writers"
+        elif cmd == "snapshot":
+            dest = kw["snapDest"]
+            stats = _backup.snapshot(self._db, dest)
+            done = (f"Snapshotted {stats.files} files, {_mb(stats.size)}, "
+                f"into {_mb(stats.written)} in {dest}")
+        else:
+            stats = _backup.compact(self._db)
+            done = (f"Compacted {stats.files} files from {_mb(stats.size)} "
+                f"to {_mb(stats.written)}")
+        # a backup goes as fast as it writes, the others as they read
+        moved = stats.written if cmd == "backup" else stats.size
+        rate = moved / stats.seconds if stats.seconds else 0
+        print(f"{done} in {stats.seconds:.2f}s, {_mb(rate)}/s", file=file)
+        return 0
+
+    def _balance(self, kw: Dict, file) -> int:
+        day = kw["balanceQuery"]
+        if not _validate_datestr(day):
+            self._logger.error(f"Invalid date: {day}")
+            return 1
+        Report(kw.get("outFormat") or "table").write_balance(day,
+            self._db.balance(day), file)
+        return 0
+
+    def _analytics(self, kw: Dict, file) -> int:
+        from . import _analytics
+        if not _analytics.available():
+            self._logger.error("report --analytics needs NumPy, install it "
+                "with 'pip install pfim[analytics]'")
+            return 1
+        self.report(kw)
+        columns = _analytics.LedgerColumns.load(self._db, self._parts)
+        window = kw.get("window") or _analytics._ROLLING_WINDOW
+        # each analysis once, in the order given
+        names = list(dict.fromkeys(kw["analytics"]))
+        _analytics.write_tables(columns.run(names, window),
+            kw.get("outFormat") or "table", file)
+        return 0
+
+    def _partition(self, kw: Dict, file) -> int:
+        from ._partition import partition_ledger
+        if self._db.partitioned:
+            self._logger.error("The ledger is already partitioned")
+            return 1
+        root = kw.get("partDir") or _PARTITION_DIR
+        start = time.perf_counter()
+        counts = partition_ledger(self._db, root,
+            kw.get("partChunk") or _CHUNK_SIZE)
+        if self._db._dbname == _DBNAME and (os.path.abspath(root)
+            != os.path.abspath(_PARTITION_DIR)):
+            _link_partitions(root)
+        elapsed = time.perf_counter() - start
+        for year, count in sorted(counts.items()):
+            print(f"    {year}: {count} entries", file=file)
+        print(f"Partitioned {sum(counts.values())} entries into "
+            f"{len(counts)} yearly databases in {root} in {elapsed:.2f}s",
+            file=file)
+        print(f"{self._db._dbname} is left as it was; restart 'pfim serve' "
+            "if it is running", file=file)
+        return 0
 
     def make_output(self) -> PfimOutput:
-        pass
+        """Run the last compiled report query.
 
-    def write_output(self, file=sys.stdout):
-        pass
+        The report is an iterator of PfimEntryBatch, and the summary is
+        filled as it is consumed. In summary mode the report is None and
+        the summary is computed by the database: a single ReportSummary,
+        or a dict of them keyed by group when --group-by is used.
+        """
+        key, stamp, cached = (self._parts, self._running), None, None
+        if self._cache.maxsize:
+            stamp = self._db.data_version()
+            cached = self._cache.get(key, stamp)
+        if cached is not None:
+            batches, summary, self._cursor = cached
+            self._output = PfimOutput(
+                None if batches is None else iter(batches), summary)
+            return self._output
+        if self._mode == "summary":
+            rows = _summary_moments(self._fetch())
+            if rows is None:
+                rows = _merge_summaries([self._db.fetch(query.query,
+                    *query.args) for query in self._exact], exact=True)
+            self._output = self._summaries(rows, self._group)
+            if stamp is not None:
+                summary = self._output.summary
+                groups = len(summary) if isinstance(summary, dict) else 1
+                self._cache.put(key, stamp, (None, summary, None),
+                    groups * _CACHE_ROW_BYTES)
+            return self._output
+        summary = ReportSummary()
+        if stamp is None:
+            key = None
+        if len(self._parts) == 1:
+            chunks = self._db.fetch_chunks(self._query.query,
+                *self._query.args)
+        else:
+            chunks = _row_chunks(self._fetch())
+        self._output = PfimOutput(
+            self._batches(chunks, summary, key, stamp), summary)
+        return self._output
+
+    def _fetch(self) -> Iterable:
+        if self._chunks:
+            from ._parallel import parallel_summary
+            return parallel_summary(self._db, self._chunks, self._jobs)
+        if len(self._parts) == 1:
+            return self._db.fetch(self._query.query, *self._query.args)
+        return self._merge([self._db.fetch(query.query, *query.args)
+            for query in self._parts])
+
+    def _merge(self, parts: List[Iterable]) -> Iterable:
+        """Merge the rows of the statements of a report into one.
+
+        Summary rows are combined per group. Report rows are chained, or
+        merged on the sort options, or on the key of a keyset page; each
+        statement applies the limit, which is applied again to the merged
+        rows.
+        """
+        if self._mode == "summary":
+            return _merge_summaries(parts)
+        if self._keyset and _keyset_columns(self._sorts)[0] == "opdate":
+            # the statements read consecutive dates: a page is read from
+            # the first ones only
+            rows = itertools.chain.from_iterable(parts)
+        elif self._keyset:
+            rows = heapq.merge(*parts, key=_keyset_key(self._sorts))
+        elif self._sorts:
+            index = [_REPORT_SORT_INDEX[opt] for opt, _ in _REPORT_SORTS
+                if opt in self._sorts]
+            # SQLite sorts NULL first
+            key = lambda row: [(row[i] is not None, row[i]) for i in index]
+            rows = heapq.merge(*parts, key=key)
+        else:
+            rows = itertools.chain.from_iterable(parts)
+        if self._limit is not None:
+            rows = itertools.islice(rows, self._limit)
+        return rows
+
+    @staticmethod
+    def _summaries(rows: Iterable, group: str = None) -> PfimOutput:
+        # rows end with the sum of squared deviations from the mean
+        summaries = {row[0]: ReportSummary.from_aggregates(*row[1:])
+            for row in rows if row[1]}
+        if group:
+            return PfimOutput(None, summaries)
+        return PfimOutput(None, summaries.get(None, ReportSummary()))
+
+    def _batches(self, chunks: Iterable[List[Tuple]],
+        summary: ReportSummary, key: PfimQuery = None,
+        stamp: Tuple = None) -> Generator:
+        # turn the chunks of rows into batches, fill the summary while the
+        # report is being consumed, and cache the report once it has been
+        # read to the end
+        tags = TagTable()
+        batches = [] if key is not None else None
+        nbytes = count = 0
+        last = balance = None
+        for chunk in chunks:
+            count += len(chunk)
+            last = chunk[-1]
+            batch = PfimEntryBatch.from_rows(chunk, tags)
+            summary.update(batch.amounts)
+            if self._running:
+                if balance is None:
+                    balance = self._opening(chunk[0])
+                batch.balances = array("d", itertools.accumulate(
+                    batch.amounts, initial=balance))[1:]
+                balance = batch.balances[-1]
+            if batches is not None:
+                batches.append(batch)
+                nbytes += batch.nbytes
+                if nbytes > self._cache.maxbytes:
+                    batches = None
+            yield batch
+        # a full keyset page may be followed by another
+        if self._keyset and self._limit is not None and (
+            count >= self._limit and last is not None):
+            self._cursor = _encode_cursor(self._sorts, last)
+        if key is not None and batches is not None:
+            self._cache.put(key, stamp, (batches, summary, self._cursor),
+                nbytes)
+
+    def write_output(self, file=sys.stdout, err=sys.stderr):
+        output = self._output or self.make_output()
+        self._output = None
+        color = self._format == "table" and file.isatty()
+        report = Report(self._format, color=color, balance=self._running)
+        if output.report is None:
+            report.write_summary(output.summary, file, self._group or "group")
+            return
+        report.write_batches(output.report, file)
+        if self._format == "table" and output.summary.count:
+            report.write_summary(output.summary, file)
+        if self._cursor is not None:
+            # CSV and JSON lines stay machine readable
+            print(f"Next page: --after-cursor {self._cursor}",
+                file=file if self._format == "table" else err)
+
+    @property
+    def cursor(self) -> Union[str, None]:
+        """The --after-cursor token of the page following the last keyset
+        page (a report with --limit or --after-cursor) read to the end,
+        None when there is none."""
+        return self._cursor
 
     def process_fetch_result(self, *args) -> None:
         pass
@@ -484,5 +3256,3 @@ class PfimCore:
             # TODO: make query then return it immediatly
             return query
  """
-
-del _filehandler, _consolehandler, _formatter
@@ -33,6 +33,8 @@ setup(
         "Topic :: Finance",],
     keywords=["Personal finance manager", "command-line application"],
     tests_require=["pytest"],
+    extras_require={"analytics": ["numpy"]},
     package_dir={"pfim": "pfim"},
     packages=["pfim"],
+    entry_points={"console_scripts": ["pfim = pfim.__main__:main"]},
     )
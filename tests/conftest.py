@@ -0,0 +1,87 @@
+"""Fixtures shared by the pfim tests.
+
+HOME is pointed at a scratch directory before pfim is imported, so that
+the default ledger, its partitions and the log file of the tests never
+touch the user's.
+"""
+
+import os
+import random
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import pytest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ["HOME"] = tempfile.mkdtemp(prefix="pfim-tests-")
+sys.path.insert(0, _ROOT)
+
+from pfim.pfim import (_INSERT_SQL, PfimCore, PfimData,  # noqa: E402
+    _setup_logging)
+
+
+class _Stderr:
+    # whatever sys.stderr is when written to: pytest swaps it around every
+    # test, and the console handler keeps the stream it is made with
+    def write(self, text):
+        return sys.stderr.write(text)
+
+    def flush(self):
+        sys.stderr.flush()
+
+
+_stderr, sys.stderr = sys.stderr, _Stderr()
+try:
+    _setup_logging()
+finally:
+    sys.stderr = _stderr
+
+START = date(2020, 1, 1)
+DAYS = 3 * 365
+SIZE = 5000
+TAGS = ("food", "groceries", "transport", "rent", "salary", "refund")
+
+
+def generate(size: int = SIZE, seed: int = 1):
+    """Yield size entries as (ISO date, tag, description, amount), in date
+    order, spread over DAYS days from START."""
+    rng = random.Random(seed)
+    for i in range(size):
+        day = (START + timedelta(i * DAYS // size)).isoformat()
+        tag = rng.choice(TAGS)
+        amount = round(rng.lognormvariate(3, 1), 2)
+        if tag not in ("salary", "refund"):
+            amount = -amount
+        yield day, tag, f"Entry {i} at {tag}", amount
+
+
+def day(fraction: float) -> str:
+    """The day at fraction of the span of the ledger."""
+    return (START + timedelta(int(DAYS * fraction))).isoformat()
+
+
+@pytest.fixture
+def dbname(tmp_path):
+    """An empty ledger."""
+    name = str(tmp_path / "ledger.db")
+    PfimData(name).close()
+    return name
+
+
+@pytest.fixture
+def filled(tmp_path):
+    """A ledger of SIZE entries."""
+    name = str(tmp_path / "ledger.db")
+    data = PfimData(name)
+    data.add_entries(_INSERT_SQL, generate())
+    data.close()
+    return name
+
+
+@pytest.fixture
+def core(filled):
+    """A PfimCore on the ledger of SIZE entries, without a result cache."""
+    core = PfimCore(filled, cache_size=0)
+    yield core
+    core._db.close()
@@ -0,0 +1,138 @@
+"""The asyncio facade runs database work off the event loop."""
+
+import asyncio
+import threading
+
+import pytest
+
+from conftest import day
+from pfim._aio import AsyncPfimCore
+from pfim.pfim import PfimCore, PfimData, PfimEntry
+
+KW = {"afterQuery": day(0.4), "beforeQuery": day(0.6), "expQuery": True}
+
+
+@pytest.fixture
+def partitioned(tmp_path):
+    """An empty ledger partitioned by year."""
+    from pfim._partition import PartitionedPfimData
+    path = tmp_path / "ledger.d"
+    path.mkdir()
+    PartitionedPfimData(str(path)).close()
+    return str(path)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_report_matches_core(core, filled):
+    core.report(KW)
+    expected = [entry for batch in core.make_output().report
+        for entry in batch]
+
+    async def report():
+        async with AsyncPfimCore(filled) as acore:
+            return [entry async for entry in acore.report(KW)]
+    assert _run(report()) == expected
+
+
+def test_summary_matches_core(core, filled):
+    core.report(dict(KW, groupBy="tag"))
+    expected = core.make_output().summary
+
+    async def summary():
+        async with AsyncPfimCore(filled) as acore:
+            return (await acore.summary(dict(KW, groupBy="tag"))).summary
+    result = _run(summary())
+    assert result.keys() == expected.keys()
+    for tag, value in result.items():
+        assert (value.count, value.mean) == (expected[tag].count,
+            expected[tag].mean)
+
+
+def test_compile_runs_off_the_loop(filled, monkeypatch):
+    threads = []
+    has_search = PfimData.has_search
+
+    def spy(self):
+        threads.append(threading.current_thread())
+        return has_search(self)
+    monkeypatch.setattr(PfimData, "has_search", spy)
+
+    async def compile():
+        async with AsyncPfimCore(filled) as acore:
+            return (await acore.compile({"searchQuery": "food"}),
+                threading.current_thread())
+    query, loop_thread = _run(compile())
+    assert "MATCH" in query.query or "LIKE" in query.query
+    assert threads and loop_thread not in threads
+
+
+def test_concurrent_reports_do_not_share_state(filled):
+    async def both():
+        async with AsyncPfimCore(filled) as acore:
+            entries, summary = await asyncio.gather(
+                _collect(acore.report({"onQuery": day(0.5)})),
+                acore.summary({}))
+            return entries, summary.summary
+    entries, summary = _run(both())
+    assert entries and all(entry.date.isoformat() == day(0.5)
+        for entry in entries)
+    assert summary.count > len(entries)
+
+
+async def _collect(rows):
+    return [row async for row in rows]
+
+
+def test_running_balance(core, filled):
+    kw = dict(KW, runningBalance=True)
+    core.report(kw)
+    expected = [(entry, balance) for batch in core.make_output().report
+        for entry, balance in zip(batch, batch.balances)]
+
+    async def report():
+        async with AsyncPfimCore(filled) as acore:
+            return [entry async for entry in acore.report(kw)]
+    entries = _run(report())
+    assert [(PfimEntry(*entry[:4]), entry.balance)
+        for entry in entries] == expected
+
+
+def test_writes_go_to_partitions(partitioned):
+    async def write():
+        async with AsyncPfimCore(partitioned) as acore:
+            await acore.record({"expense": 5.0, "recdate": "2021-06-01",
+                "rectag": "food", "descr": "Lunch"})
+            updated = await acore.update(
+                {"upExpense": ["2021-06-01", "5", "7"]})
+            query = acore._core._record_query({"expense": 1.0,
+                "recdate": "2022-01-02", "rectag": "food", "descr": "Raw"})
+            await acore.data.add_entry(query.query, *query.args)
+            deleted = await acore.delete({"rmDate": "2022-01-02"})
+            entries = [entry async for entry in acore.report(
+                {"afterQuery": "2021-01-01"})]
+            return updated, deleted, entries
+    updated, deleted, entries = _run(write())
+    assert (updated, deleted) == (1, 1)
+    assert [(entry.date.isoformat(), entry.amount) for entry in entries] == [
+        ("2021-06-01", -7.0)]
+
+
+# the abandoned generator can only be finalized on the closed loop
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_fetch_gives_up_when_the_loop_closes(filled):
+    # the consumer reads one row and the loop goes away under the reader,
+    # which must not wait forever for room in the queue
+    loop = asyncio.new_event_loop()
+    acore = AsyncPfimCore(filled, readers=1)
+    rows = acore.data.fetch("SELECT * FROM pfim", batch=1, prefetch=1)
+    assert loop.run_until_complete(rows.__anext__())
+    # the reader fills the queue and waits for room
+    loop.run_until_complete(asyncio.sleep(0.2))
+    loop.close()
+    # the reader thread is free again
+    future = acore.data._readers.submit(lambda: "free")
+    assert future.result(timeout=5) == "free"
+    acore.data._shutdown()
@@ -0,0 +1,131 @@
+"""report --analytics against the same figures computed row by row."""
+
+import io
+import json
+from collections import defaultdict
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import generate
+
+np = pytest.importorskip("numpy")
+
+from pfim import _analytics  # noqa: E402
+
+WINDOW = 7
+
+
+def _analytics_rows(core, names, kw=None):
+    out = io.StringIO()
+    assert core.execute(dict(kw or {}, cmd="report", analytics=names,
+        outFormat="jsonl", window=WINDOW), file=out) == 0
+    tables = defaultdict(list)
+    for line in out.getvalue().splitlines():
+        record = json.loads(line)
+        tables[record.pop("analytics")].append(record)
+    return tables
+
+
+def _percentile(values, percent):
+    # linear interpolation between the closest ranks, as NumPy's default
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def test_percentiles(core):
+    rows = {row["series"]: row for row in
+        _analytics_rows(core, ["percentiles"])["percentiles"]}
+    amounts = [row[3] for row in generate()]
+    for series, values in (("expenses", [-a for a in amounts if a < 0]),
+        ("incomes", [a for a in amounts if a >= 0])):
+        assert rows[series]["count"] == len(values)
+        for percent in _analytics._PERCENTILES:
+            assert rows[series][f"p{percent}"] == pytest.approx(
+                _percentile(values, percent), rel=1e-12)
+
+
+def test_rolling(core):
+    rows = _analytics_rows(core, ["rolling"])["rolling"]
+    spend = defaultdict(float)
+    for opdate, _, _, amount in generate():
+        if amount < 0:
+            spend[date.fromisoformat(opdate)] -= amount
+    first, last = min(spend), max(spend)
+    assert [row["date"] for row in rows] == [
+        (first + timedelta(i)).isoformat()
+        for i in range((last - first).days + 1)]
+    for row in rows:
+        day = date.fromisoformat(row["date"])
+        expected = sum(spend.get(day - timedelta(i), 0.0)
+            for i in range(WINDOW))
+        assert row[f"spend_{WINDOW}d"] == pytest.approx(expected, abs=1e-6)
+
+
+def test_tags(core):
+    rows = _analytics_rows(core, ["tags"])["tags"]
+    totals = defaultdict(float)
+    for opdate, tag, _, amount in generate():
+        totals[opdate[:7], tag] += amount
+    months = sorted({month for month, _ in totals})
+    tags = sorted({tag for _, tag in totals})
+    expected, running = [], defaultdict(float)
+    for month in months:
+        for tag in tags:
+            if (month, tag) in totals or tag in running:
+                running[tag] += totals.get((month, tag), 0.0)
+                expected.append((month, tag, running[tag]))
+    assert [(row["month"], row["tag"]) for row in rows] == [
+        row[:2] for row in expected]
+    for row, (_, _, value) in zip(rows, expected):
+        assert row["cumulative"] == pytest.approx(value, abs=1e-6)
+
+
+def test_months(core):
+    rows = _analytics_rows(core, ["months"])["months"]
+    income, spend = defaultdict(float), defaultdict(float)
+    for opdate, _, _, amount in generate():
+        if amount < 0:
+            spend[opdate[:7]] -= amount
+        else:
+            income[opdate[:7]] += amount
+    months = sorted(set(income) | set(spend))
+    assert [row["month"] for row in rows] == months
+    previous = None
+    for row, month in zip(rows, months):
+        net = income[month] - spend[month]
+        assert (row["income"], row["spend"], row["net"]) == pytest.approx(
+            (income[month], spend[month], net), abs=1e-6)
+        if previous is None:
+            assert (row["delta_spend"], row["delta_net"],
+                row["pct_spend"]) == (None, None, None)
+        else:
+            assert row["delta_spend"] == pytest.approx(
+                spend[month] - spend[previous], abs=1e-6)
+            assert row["delta_net"] == pytest.approx(
+                net - income[previous] + spend[previous], abs=1e-6)
+            assert row["pct_spend"] == pytest.approx(
+                (spend[month] - spend[previous]) / spend[previous] * 100)
+        previous = month
+
+
+def test_chunked_load(core):
+    # columns read a few rows at a time are those read at once
+    core.report({"tagQuery": "food", "analytics": ["months"]})
+    whole = _analytics.LedgerColumns.load(core._db, core._parts)
+    chunked = _analytics.LedgerColumns.load(core._db, core._parts,
+        chunksize=7)
+    assert len(whole) == len([row for row in generate() if row[1] == "food"])
+    for name in ("days", "amounts", "codes"):
+        assert np.array_equal(getattr(whole, name), getattr(chunked, name))
+    assert whole.names == chunked.names == ["food"]
+
+
+def test_empty_report(core):
+    tables = _analytics_rows(core, ["percentiles", "rolling", "tags",
+        "months"], {"tagQuery": "nothing"})
+    assert [row["count"] for row in tables["percentiles"]] == [0, 0]
+    assert set(tables) == {"percentiles"}
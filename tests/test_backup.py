@@ -0,0 +1,73 @@
+"""Incremental backups write the pages that changed, and nothing else."""
+
+import io
+import os
+import sqlite3
+
+import pytest
+
+from pfim import _backup
+from pfim.pfim import _INSERT_SQL, PfimCore, PfimData
+
+
+def _rows(dbname):
+    conn = sqlite3.connect(dbname)
+    try:
+        assert conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+        return conn.execute("SELECT * FROM pfim ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+
+def _backup_cmd(dbname, dest):
+    core = PfimCore(dbname, cache_size=0)
+    out = io.StringIO()
+    try:
+        assert core.execute({"cmd": "backup", "bakDest": dest,
+            "bakIncremental": True}, file=out) == 0
+    finally:
+        core._db.close()
+    return out.getvalue()
+
+
+@pytest.fixture(params=["memory", "file"])
+def stage(request, monkeypatch):
+    """Where incremental backups are staged."""
+    if request.param == "file":
+        monkeypatch.setattr(_backup, "_MEMORY_STAGE", 0)
+    elif not _backup._SERIALIZE:
+        pytest.skip("Connection.serialize() needs Python 3.11")
+    return request.param
+
+
+def test_incremental_backup(filled, tmp_path, stage, monkeypatch):
+    dest = str(tmp_path / "backup.db")
+    data = PfimData(filled)
+    try:
+        first = _backup.backup(data, dest, incremental=True)
+        assert first.written == first.size
+        assert _rows(dest) == _rows(filled)
+        # nothing changed: nothing is staged or written
+        staged = []
+        monkeypatch.setattr(_backup, "_online_copy",
+            lambda *args: staged.append(args))
+        again = _backup.backup(data, dest, incremental=True)
+        assert (again.size, again.written, staged) == (first.size, 0, [])
+        monkeypatch.undo()
+        if stage == "file":
+            monkeypatch.setattr(_backup, "_MEMORY_STAGE", 0)
+        data.add_entries(_INSERT_SQL, [("2024-06-01", "food", "Late", -1.0)])
+        changed = _backup.backup(data, dest, incremental=True)
+        assert 0 < changed.written < changed.size / 4
+        assert _rows(dest) == _rows(filled)
+    finally:
+        data.close()
+    assert not os.path.exists(filled + _backup._STAGE_SUFFIX)
+
+
+def test_backup_reports_bytes_written(filled, tmp_path):
+    dest = str(tmp_path / "backup.db")
+    _backup_cmd(filled, dest)
+    line = _backup_cmd(filled, dest)
+    assert "writing 0.0 MB" in line, line
+    assert line.rstrip().endswith(", 0.0 MB/s"), line
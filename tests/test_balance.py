@@ -0,0 +1,116 @@
+"""The balance index against a plain running sum of the ledger."""
+
+import io
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import START, DAYS, day
+from pfim.pfim import _BALANCE_PENDING, _INSERT_SQL, PfimCore, PfimData
+
+# the days the balance is looked up on, ledger bounds and the day before
+# the first entry included
+DAYS_CHECKED = [(START + timedelta(offset)).isoformat()
+    for offset in range(-1, DAYS + 2, 37)] + [day(1.0)]
+
+
+def _running_sum(dbname, opdate):
+    conn = sqlite3.connect(dbname)
+    try:
+        return conn.execute("SELECT total(amount) FROM pfim WHERE opdate <= ?",
+            (opdate,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _check(data, dbname):
+    for opdate in DAYS_CHECKED:
+        assert data.balance(opdate) == pytest.approx(
+            _running_sum(dbname, opdate), abs=1e-6), opdate
+    assert data.check_balances() == []
+
+
+@pytest.fixture
+def data(filled):
+    data = PfimData(filled)
+    yield data
+    data.close()
+
+
+def test_balance_of_the_ledger(data, filled):
+    _check(data, filled)
+
+
+@pytest.mark.parametrize("days", [1, 3 * _BALANCE_PENDING])
+def test_back_dated_inserts(data, filled, days):
+    # entries dated anywhere in the past, pending in the delta table or
+    # folded into the tree once they span more than _BALANCE_PENDING days
+    data.add_entries(_INSERT_SQL, [(
+        (START + timedelta(i * DAYS // days)).isoformat(), "late",
+        f"Late {i}", -1.5 - i) for i in range(days)])
+    _check(data, filled)
+
+
+def test_updated_amounts(data, filled):
+    conn = data._connect()
+    opdate, amount = conn.execute("SELECT opdate, amount FROM pfim "
+        "WHERE amount < 0 AND opdate > ? LIMIT 1", (day(0.3),)).fetchone()
+    assert data.update("UPDATE pfim SET amount = ? WHERE opdate = ? AND "
+        "amount = ?", amount - 100, opdate, amount) == 1
+    # a bulk change over every day of the ledger
+    data.update("UPDATE pfim SET amount = amount * 2 WHERE kind = "
+        "(SELECT kind FROM pfim WHERE amount > 0 LIMIT 1)")
+    _check(data, filled)
+
+
+def test_updated_dates(data, filled):
+    # entries moved back and forth, one of them past the last day
+    moved = data.update("UPDATE pfim SET opdate = date(opdate, '-200 days') "
+        "WHERE id % 7 = 0")
+    assert moved > _BALANCE_PENDING
+    data.update("UPDATE pfim SET opdate = date(opdate, '+30 days') "
+        "WHERE id % 11 = 0")
+    _check(data, filled)
+
+
+def test_deleted_entries(data, filled):
+    assert data.delete("DELETE FROM pfim WHERE opdate = ?", day(0.5)) > 0
+    assert data.delete("DELETE FROM pfim WHERE id % 5 = 0") > 0
+    _check(data, filled)
+
+
+def test_check_reports_no_stale_balance(filled):
+    conn = sqlite3.connect(filled)
+    amount, = conn.execute("SELECT amount FROM pfim WHERE opdate = ? AND "
+        "amount < 0", (day(0.5),)).fetchone()
+    conn.close()
+    core = PfimCore(filled, cache_size=0)
+    try:
+        assert core.update({"upExpense": [day(0.5), str(-amount), "1"]}) >= 1
+        core.delete({"rmADate": day(0.9)})
+        out = io.StringIO()
+        assert core.execute({"cmd": "rebuild-rollups", "rollCheck": True},
+            file=out) == 0
+    finally:
+        core._db.close()
+    assert "0 days with a stale balance" in out.getvalue()
+
+
+def test_check_reports_stale_balances(filled):
+    conn = sqlite3.connect(filled)
+    with conn:
+        conn.execute("INSERT INTO pfim_balance_delta(day, delta) "
+            "VALUES (?, 1) ON CONFLICT(day) DO UPDATE SET delta = delta + 1",
+            (date.fromisoformat(day(0.5)).toordinal(),))
+    conn.close()
+    core = PfimCore(filled, cache_size=0)
+    try:
+        out = io.StringIO()
+        assert core.execute({"cmd": "rebuild-rollups", "rollCheck": True},
+            file=out) == 1
+        assert "0 days with a stale balance" not in out.getvalue()
+        core.execute({"cmd": "rebuild-rollups"}, file=io.StringIO())
+        assert core._db.check_balances() == []
+    finally:
+        core._db.close()
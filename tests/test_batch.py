@@ -0,0 +1,93 @@
+"""pfim batch applies a whole script or nothing of it."""
+
+import sqlite3
+
+from pfim import _batch as _batch_module
+from pfim.pfim import PfimCore
+
+
+def _tags(dbname):
+    conn = sqlite3.connect(dbname)
+    try:
+        return {row[0] for row in conn.execute("SELECT tag FROM tags")}
+    finally:
+        conn.close()
+
+
+def _count(dbname):
+    conn = sqlite3.connect(dbname)
+    try:
+        return conn.execute("SELECT count(*) FROM pfim").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _batch(dbname, tmp_path, script):
+    path = tmp_path / "script.txt"
+    path.write_text(script)
+    core = PfimCore(dbname, cache_size=0)
+    try:
+        return core.execute({"cmd": "batch", "batFile": str(path)})
+    finally:
+        core._db.close()
+
+
+def test_batch_applies_every_command(dbname, tmp_path):
+    status = _batch(dbname, tmp_path,
+        "record --exp 10 --date 2024-01-02 --tag home/rent --descr Rent\n"
+        "record --inc 20 --date 2024-01-03 --tag pay --descr Pay\n"
+        "update --tag 2024-01-03 pay salary\n")
+    assert status == 0
+    assert _count(dbname) == 2
+    assert {"home", "home/rent", "salary"} <= _tags(dbname)
+
+
+def test_failed_batch_leaves_no_tags(dbname, tmp_path):
+    before = _tags(dbname)
+    status = _batch(dbname, tmp_path,
+        "record --exp 10 --date 2024-01-02 --tag new/tag --descr One\n"
+        "update --tag 2024-01-02 new/tag other/tag\n"
+        "record --exp 10 --date 2024-13-40 --tag late --descr 'Bad date'\n")
+    assert status == 1
+    assert _count(dbname) == 0
+    assert _tags(dbname) == before
+    # the ids of the tags rolled back are not reused from the cache
+    assert _batch(dbname, tmp_path,
+        "record --exp 5 --date 2024-01-02 --tag new/tag --descr Again\n") == 0
+    assert "new/tag" in _tags(dbname)
+
+
+def test_missing_script(dbname, tmp_path):
+    core = PfimCore(dbname, cache_size=0)
+    assert core.execute({"cmd": "batch",
+        "batFile": str(tmp_path / "missing.txt")}) == 1
+    core._db.close()
+
+
+def test_updates_without_update_from(dbname, tmp_path, monkeypatch):
+    # SQLite before 3.33: updates are applied one by one, in order
+    monkeypatch.setattr(_batch_module, "_UPDATE_FROM", False)
+    status = _batch(dbname, tmp_path,
+        "record --exp 10 --date 2024-01-02 --tag one --descr First\n"
+        "record --exp 20 --date 2024-01-02 --tag two --descr Second\n"
+        "update --tag 2024-01-02 one two\n"
+        "update --tag 2024-01-02 two three\n")
+    assert status == 0
+    conn = sqlite3.connect(dbname)
+    try:
+        assert conn.execute("SELECT tags.tag FROM pfim JOIN tags "
+            "USING (tag_id)").fetchall() == [("three",), ("three",)]
+    finally:
+        conn.close()
+
+
+def test_batch_refuses_a_partitioned_ledger(tmp_path, caplog):
+    from pfim._partition import PartitionedPfimData
+    path = tmp_path / "ledger.d"
+    path.mkdir()
+    PartitionedPfimData(str(path)).close()
+    status = _batch(str(path), tmp_path,
+        "record --exp 10 --date 2024-01-02 --tag rent --descr Rent\n")
+    assert status == 1
+    assert "not supported on a partitioned ledger" in caplog.text
+    assert list(path.iterdir()) == []
@@ -0,0 +1,93 @@
+"""The result cache is never served once the ledger has changed."""
+
+import sqlite3
+
+import pytest
+
+from conftest import day
+from pfim.pfim import PfimCore
+
+SUMMARY = {"summaryOnly": True}
+REPORT = {"afterQuery": day(0.5)}
+
+
+def _count(core, kw):
+    core.report(kw)
+    output = core.make_output()
+    if output.report is None:
+        return output.summary.count
+    return sum(len(batch) for batch in output.report)
+
+
+def _insert(dbname, opdate):
+    # a write made outside of PfimCore, on a connection of its own
+    conn = sqlite3.connect(dbname)
+    with conn:
+        conn.execute("INSERT INTO pfim(opdate, tag_id, description, amount, "
+            "kind) SELECT ?, tag_id, 'Elsewhere', -1.0, kind FROM pfim "
+            "WHERE amount < 0 LIMIT 1", (opdate,))
+    conn.close()
+
+
+@pytest.fixture
+def cached(filled):
+    """A PfimCore with its result cache on the ledger of SIZE entries."""
+    core = PfimCore(filled)
+    yield core
+    core._db.close()
+
+
+@pytest.mark.parametrize("kw", [SUMMARY, REPORT])
+def test_repeated_report_is_cached(cached, kw):
+    count = _count(cached, kw)
+    assert _count(cached, kw) == count
+    assert cached._cache.hits == 1
+
+
+@pytest.mark.parametrize("kw", [SUMMARY, REPORT])
+def test_write_through_the_same_data(cached, kw):
+    count = _count(cached, kw)
+    cached.record({"expense": 1.0, "recdate": day(0.8), "rectag": "food",
+        "descr": "Lunch"})
+    assert _count(cached, kw) == count + 1
+    cached.delete({"rmDate": day(0.8)})
+    assert _count(cached, kw) < count
+
+
+@pytest.mark.parametrize("kw", [SUMMARY, REPORT])
+def test_write_from_another_connection(cached, filled, kw):
+    count = _count(cached, kw)
+    _insert(filled, day(0.8))
+    assert _count(cached, kw) == count + 1
+
+
+@pytest.fixture
+def partitioned(tmp_path):
+    """A PfimCore with its result cache on a ledger partitioned by year,
+    with entries in 2020 and 2021."""
+    from pfim._partition import PartitionedPfimData
+    path = tmp_path / "ledger.d"
+    path.mkdir()
+    PartitionedPfimData(str(path)).close()
+    core = PfimCore(str(path))
+    for opdate in ("2020-05-01", "2021-05-01"):
+        core.record({"expense": 1.0, "recdate": opdate, "rectag": "food",
+            "descr": "Lunch"})
+    yield core
+    core._db.close()
+
+
+@pytest.mark.parametrize("kw", [SUMMARY, {"afterQuery": "2019-12-31"}])
+def test_partitioned_ledger(partitioned, kw):
+    assert _count(partitioned, kw) == 2
+    # a write to a partition other than the first one the stamp reads
+    path, _ = partitioned._db.years()[2021]
+    _insert(path, "2021-06-01")
+    assert _count(partitioned, kw) == 3
+    # a new year, written by another PfimCore
+    other = PfimCore(partitioned._db.path, cache_size=0)
+    other.record({"expense": 1.0, "recdate": "2022-05-01", "rectag": "food",
+        "descr": "Lunch"})
+    other._db.close()
+    assert _count(partitioned, kw) == 4
+    assert partitioned._cache.hits == 0
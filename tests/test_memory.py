@@ -0,0 +1,125 @@
+"""Reports are streamed: their memory does not grow with the ledger."""
+
+import gc
+import io
+import itertools
+import tracemalloc
+
+import pytest
+
+from conftest import generate
+from pfim.pfim import (_INSERT_SQL, PfimCore, PfimData, PfimEntry,
+    PfimEntryBatch, Report, TagTable, _make_entry, _row_chunks)
+from pfim._stats import StreamingStats
+
+SMALL, LARGE = 10_000, 40_000
+REPORTS = {"all": {}, "sorted": {"sortAmount": True},
+    "filtered": {"tagQuery": "food", "expQuery": True},
+    "balance": {"runningBalance": True}}
+
+
+class _Sink(io.TextIOBase):
+    # counts what is written to it, and keeps none of it
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+        return len(text)
+
+
+def _peak(func):
+    # the peak of traced memory while func runs
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture(scope="module")
+def ledgers(tmp_path_factory):
+    """{size: ledger} of SMALL and LARGE entries."""
+    names = {}
+    for size in (SMALL, LARGE):
+        name = str(tmp_path_factory.mktemp("memory") / f"{size}.db")
+        data = PfimData(name)
+        data.add_entries(_INSERT_SQL, generate(size))
+        data.close()
+        names[size] = name
+    return names
+
+
+def _entries(size):
+    return (PfimEntry(*row) for row in generate(size))
+
+
+@pytest.mark.parametrize("fmt", Report.FORMATS)
+def test_render_memory_is_bounded(fmt):
+    peaks = {size: _peak(lambda: Report(fmt).write(_entries(size), _Sink()))
+        for size in (SMALL, LARGE)}
+    # four times the entries, about the same memory: one chunk of lines
+    assert peaks[LARGE] < 1.5 * peaks[SMALL], peaks
+
+
+@pytest.mark.parametrize("fmt", Report.FORMATS)
+def test_report_memory_is_bounded(ledgers, fmt, monkeypatch):
+    # the summary keeps the amounts for exact quantiles up to a limit,
+    # above both ledgers
+    monkeypatch.setattr(StreamingStats.__init__, "__defaults__", (1000,))
+    peaks, sizes = {}, {}
+    for size, name in ledgers.items():
+        core = PfimCore(name, cache_size=0)
+        sink = _Sink()
+
+        def run():
+            core.report({"outFormat": fmt})
+            core.write_output(sink)
+        peaks[size] = _peak(run)
+        sizes[size] = sink.size
+        core._db.close()
+    # four times the entries, and the output, about the same memory
+    assert sizes[LARGE] > 3 * sizes[SMALL], sizes
+    assert peaks[LARGE] < 1.2 * peaks[SMALL], peaks
+
+
+def _unchunked(core, kw, fmt):
+    # the report rendered from one PfimEntry per row, read in one go
+    query = core.report(kw)
+    rows = list(core._db.fetch(query.query, *query.args))
+    running = kw.get("runningBalance")
+    balance = 0.0
+    entries = []
+    for row in rows:
+        entry = _make_entry(row)
+        if running:
+            balance += entry.amount
+            entry = tuple(entry) + (balance,)
+        entries.append(entry)
+    out = io.StringIO()
+    Report(fmt, balance=bool(running)).write(entries, out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("fmt,name", list(itertools.product(
+    Report.FORMATS, REPORTS)))
+def test_chunked_report_matches_unchunked(core, fmt, name):
+    kw = REPORTS[name]
+    expected = _unchunked(core, kw, fmt)
+    core.report(kw)
+    out = io.StringIO()
+    Report(fmt, balance=bool(kw.get("runningBalance"))).write_batches(
+        core.make_output().report, out)
+    assert out.getvalue() == expected
+    if kw.get("runningBalance"):
+        return
+    # batches, and chunks of lines, of any size
+    query = core.report(kw)
+    for size in (1, 7, 1000):
+        batches = [PfimEntryBatch.from_rows(rows, TagTable()) for rows in
+            _row_chunks(core._db.fetch(query.query, *query.args), size)]
+        out = io.StringIO()
+        Report(fmt, chunksize=size).write_batches(batches, out)
+        assert out.getvalue() == expected, size
@@ -0,0 +1,61 @@
+"""Keyset pages: --limit and the --after-cursor token."""
+
+import base64
+import json
+
+import pytest
+
+from pfim._cmd_parser import _cmd_parser
+from pfim.pfim import _decode_cursor
+
+
+def _token(sorts, key):
+    text = json.dumps([list(sorts), key])
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+def _pages(core, **kw):
+    # the dates of every page of a report, and the pages read
+    dates, token, pages = [], None, 0
+    while True:
+        core.report(dict(kw, cursorQuery=token, outFormat="csv"))
+        page = [entry.date.isoformat()
+            for batch in core.make_output().report for entry in batch]
+        dates.extend(page)
+        pages += 1
+        token = core.cursor
+        if token is None:
+            return dates, pages
+
+
+def test_pages_cover_the_report(core):
+    core.report({"outFormat": "csv"})
+    expected = [entry.date.isoformat()
+        for batch in core.make_output().report for entry in batch]
+    dates, pages = _pages(core, limitQuery=1000)
+    assert dates == sorted(expected)
+    assert pages == len(expected) // 1000 + 1
+
+
+def test_cursor_values():
+    key = ["2020-01-01", 3]
+    assert _decode_cursor(_token((), key), ()) == key
+    assert _decode_cursor(_token((), [None, 3.5]), ()) == [None, 3.5]
+
+
+@pytest.mark.parametrize("value", [{"id": 1}, [1], True])
+def test_invalid_cursor_values(value):
+    assert _decode_cursor(_token((), ["2020-01-01", value]), ()) is None
+
+
+def test_invalid_cursor_is_reported(core, caplog):
+    with pytest.raises(SystemExit):
+        core.report({"cursorQuery": _token((), ["2020-01-01", [1]])})
+    assert "Invalid cursor" in caplog.text
+
+
+@pytest.mark.parametrize("limit", ["0", "-3", "ten"])
+def test_limit_must_be_positive(limit, capsys):
+    with pytest.raises(SystemExit):
+        _cmd_parser().parse_args(["report", "--limit", limit])
+    assert "--limit" in capsys.readouterr().err
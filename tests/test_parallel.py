@@ -0,0 +1,70 @@
+"""report --summary-only --jobs N against the serial summary."""
+
+from datetime import date
+
+import pytest
+
+from conftest import day
+from pfim._parallel import date_chunks
+
+# bounds off month boundaries, which the monthly rollup can not answer
+BOUNDS = {"afterQuery": day(0.1), "beforeQuery": day(0.9)}
+
+
+def _summary(core, kw):
+    core.report(dict(kw, summaryOnly=True))
+    chunked = bool(core._chunks)
+    return chunked, core.make_output().summary
+
+
+def _same(got, expected):
+    assert (got.count, got.minimum, got.maximum) == (expected.count,
+        expected.minimum, expected.maximum)
+    assert got.mean == pytest.approx(expected.mean, rel=1e-12)
+    assert got.stdev == pytest.approx(expected.stdev, rel=1e-9)
+
+
+@pytest.mark.parametrize("kw", [BOUNDS, dict(BOUNDS, groupBy="tag"),
+    dict(BOUNDS, groupBy="month", tagQuery="food", expQuery=True)])
+def test_jobs_match_serial(core, kw):
+    chunked, expected = _summary(core, kw)
+    assert not chunked
+    chunked, got = _summary(core, dict(kw, jobs=2))
+    assert chunked
+    if "groupBy" not in kw:
+        got, expected = {None: got}, {None: expected}
+    assert got.keys() == expected.keys()
+    for group in expected:
+        _same(got[group], expected[group])
+
+
+def _days(chunks):
+    return [date.fromisoformat(day) for chunk in chunks for day in chunk]
+
+
+def test_single_day():
+    assert date_chunks("2024-02-29", "2024-02-29", 8) == [
+        ("2024-02-29", "2024-02-29")]
+
+
+def test_more_chunks_than_days():
+    assert date_chunks("2023-12-30", "2024-01-02", 10) == [
+        ("2023-12-30", "2023-12-30"), ("2023-12-31", "2023-12-31"),
+        ("2024-01-01", "2024-01-01"), ("2024-01-02", "2024-01-02")]
+
+
+@pytest.mark.parametrize("first, last, count", [
+    ("2020-01-01", "2022-12-31", 8), ("2020-01-01", "2020-01-10", 3),
+    ("2021-03-01", "2021-03-31", 1)])
+def test_chunks_cover_the_dates(first, last, count):
+    chunks = date_chunks(first, last, count)
+    assert 1 <= len(chunks) <= count
+    days = _days(chunks)
+    assert (days[0].isoformat(), days[-1].isoformat()) == (first, last)
+    # consecutive, without gaps or overlaps
+    for (_, stop), (start, _) in zip(chunks, chunks[1:]):
+        assert (date.fromisoformat(start) - date.fromisoformat(stop)).days == 1
+    sizes = [(date.fromisoformat(stop) - date.fromisoformat(start)).days + 1
+        for start, stop in chunks]
+    # of the same number of days, but for a shorter last one
+    assert len(set(sizes[:-1])) <= 1 and sizes[-1] <= sizes[0]
@@ -0,0 +1,91 @@
+"""Year-partitioned ledgers."""
+
+import pytest
+
+from pfim import pfim
+from pfim.pfim import PfimCore, _open_data
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """The default ledger and its partition files, in tmp_path."""
+    for name, base in (("_DBNAME", ".pfimdata.db"),
+        ("_PARTITION_DIR", ".pfimdata.d"), ("_PARTITION_LINK", ".pfimdata.dir")):
+        monkeypatch.setattr(pfim, name, str(tmp_path / base))
+    return tmp_path
+
+
+def _run(kw):
+    core = PfimCore(pfim._DBNAME, cache_size=0)
+    try:
+        return core.execute(kw)
+    finally:
+        core._db.close()
+
+
+def _record(day, amount):
+    _run({"cmd": "record", "expense": amount, "recdate": day,
+        "rectag": "tag", "descr": f"On {day}"})
+
+
+def _amounts():
+    data = _open_data(pfim._DBNAME)
+    try:
+        return sorted(row[0] for row in data.fetch(
+            "SELECT amount FROM pfim" if not data.partitioned else
+            " UNION ALL ".join(f"SELECT amount FROM {schema}.pfim"
+                for schemas in data.sources() for schema in schemas)))
+    finally:
+        data.close()
+
+
+def test_partition_dir_is_kept(home):
+    _record("2020-03-01", 1)
+    _record("2023-03-01", 2)
+    assert _run({"cmd": "partition", "partDir": str(home / "custom")}) == 0
+    _record("2024-03-01", 3)
+    data = _open_data(pfim._DBNAME)
+    assert data.partitioned and data.path == str(home / "custom")
+    data.close()
+    assert _amounts() == [-3.0, -2.0, -1.0]
+
+
+def test_missing_partition_dir(home):
+    _record("2020-03-01", 1)
+    _run({"cmd": "partition", "partDir": str(home / "custom")})
+    (home / "custom").rename(home / "moved")
+    with pytest.raises(SystemExit):
+        _open_data(pfim._DBNAME)
+
+
+def test_delete_refuses_archived_years(home):
+    for day in ("2020-03-01", "2023-03-01", "2024-03-01"):
+        _record(day, 1)
+    _run({"cmd": "partition"})
+    assert _run({"cmd": "archive", "arcYear": 2020}) == 0
+    with pytest.raises(SystemExit):
+        _run({"cmd": "delete", "rmAll": True})
+    with pytest.raises(SystemExit):
+        _run({"cmd": "update", "upExpense": ["2020-03-01", "1", "5"]})
+    assert _amounts() == [-1.0, -1.0, -1.0]
+    _run({"cmd": "delete", "rmADate": "2022-12-31", "rmTag": "tag"})
+    assert _amounts() == [-1.0]
+
+
+@pytest.mark.parametrize("kw", [
+    {"cmd": "update", "upRename": ["tag", "other"]},
+    {"cmd": "rebuild-rollups"},
+    {"cmd": "rebuild-rollups", "rollCheck": True},
+    {"cmd": "rebuild-search"},
+    {"cmd": "rebuild-search", "searchCheck": True},
+], ids=["rename", "rollups", "rollups-check", "search", "search-check"])
+def test_ledger_wide_commands_refuse_archived_years(home, kw, caplog):
+    for day in ("2020-03-01", "2024-03-01"):
+        _record(day, 1)
+    _run({"cmd": "partition"})
+    assert _run({"cmd": "archive", "arcYear": 2020}) == 0
+    with pytest.raises(SystemExit) as exc:
+        _run(kw)
+    assert exc.value.code == 1
+    assert "archived years can not be" in caplog.text
+    assert "2020" in caplog.text
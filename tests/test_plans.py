@@ -0,0 +1,35 @@
+"""Every filtered report must be answered with an index search."""
+
+import itertools
+import re
+
+import pytest
+
+from conftest import day
+
+FILTERS = {
+    "tag": {"tagQuery": "groceries"},
+    "on": {"onQuery": day(0.5)},
+    "after": {"afterQuery": day(0.75)},
+    "before": {"beforeQuery": day(0.25)},
+    "range": {"afterQuery": day(0.4), "beforeQuery": day(0.6)},
+    "tag-range": {"tagQuery": "groceries", "afterQuery": day(0.4),
+        "beforeQuery": day(0.6)},
+    "all": {},
+}
+KINDS = {"any": {}, "exp": {"expQuery": True}, "inc": {"incQuery": True}}
+
+
+def _scans(plan):
+    # the accesses to the ledger table that are not index searches
+    return [detail for detail in plan
+        if re.match(r"SCAN pfim\b", detail)]
+
+
+@pytest.mark.parametrize("fname,kname", [(f, k) for f, k in
+    itertools.product(FILTERS, KINDS) if f != "all" or k != "any"])
+def test_filtered_report_uses_index(core, fname, kname):
+    query = core.report(dict(FILTERS[fname], **KINDS[kname]))
+    plan = core._db.query_plan(query.query, *query.args)
+    assert plan
+    assert not _scans(plan), plan
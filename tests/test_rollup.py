@@ -0,0 +1,77 @@
+"""The monthly rollup against summaries of the ledger itself."""
+
+import pytest
+
+from pfim.pfim import PfimData, _compile_rollup_summary, _compile_summary
+
+MONTH = "2021-03"
+
+
+@pytest.fixture
+def data(filled):
+    data = PfimData(filled)
+    yield data
+    data.close()
+
+
+def _extremes(data, month, tag):
+    # the ids of the entries holding the minimum and maximum amount of a
+    # (month, tag) rollup row
+    query = ("SELECT id FROM pfim JOIN tags USING (tag_id) WHERE "
+        "substr(opdate, 1, 7) = ? AND tag = ? ORDER BY amount {}, id LIMIT 1")
+    return [next(data.fetch(query.format(order), month, tag))[0]
+        for order in ("ASC", "DESC")]
+
+
+def _check(data):
+    assert data.check_rollups() == []
+    for group in ("month", "tag", None):
+        rollup = list(data.fetch(_compile_rollup_summary((), False, group)))
+        ledger = list(data.fetch(_compile_summary((), False, group)))
+        assert [row[:2] + row[3:5] for row in rollup] == [
+            row[:2] + row[3:5] for row in ledger]
+        for got, expected in zip(rollup, ledger):
+            assert got[2] == pytest.approx(expected[2], rel=1e-12)
+            assert got[5] == pytest.approx(expected[5], rel=1e-12)
+
+
+def test_rollup_of_the_ledger(data):
+    _check(data)
+
+
+def test_deleted_extremes(data):
+    for tag in ("food", "salary"):
+        low, high = _extremes(data, MONTH, tag)
+        assert data.delete("DELETE FROM pfim WHERE id IN (?, ?)",
+            low, high) == 2
+    _check(data)
+
+
+def test_updated_extremes(data):
+    # the minimum moves inside its month, the maximum to another month
+    # where it is no extreme
+    low, high = _extremes(data, MONTH, "food")
+    assert data.update("UPDATE pfim SET amount = -0.01 WHERE id = ?",
+        low) == 1
+    assert data.update("UPDATE pfim SET opdate = '2020-07-15' WHERE id = ?",
+        high) == 1
+    low, high = _extremes(data, MONTH, "salary")
+    assert data.update("UPDATE pfim SET amount = 1e6 WHERE id = ?", low) == 1
+    _check(data)
+
+
+def test_emptied_month(data):
+    assert data.delete("DELETE FROM pfim WHERE substr(opdate, 1, 7) = ?",
+        MONTH) > 0
+    _check(data)
+
+
+def test_stale_rollup_is_reported(data):
+    conn = data._connect()
+    with conn:
+        conn.execute("UPDATE pfim_rollup SET maxval = maxval + 1 "
+            "WHERE month = ?", (MONTH,))
+    stale = data.check_rollups()
+    assert stale and {month for month, _, _ in stale} == {MONTH}
+    data.rebuild_rollups()
+    _check(data)
@@ -0,0 +1,73 @@
+"""A ledger written by an older pfim is upgraded when it is opened."""
+
+import sqlite3
+
+import pytest
+
+from pfim._cmd_parser import _cmd_parser
+from pfim.pfim import _SCHEMA, PfimCore, PfimData, _has_fts5
+
+
+@pytest.fixture
+def old_ledger(tmp_path):
+    """A version 1 ledger, from before the tag dictionary; its last entry
+    has been deleted."""
+    name = str(tmp_path / "old.db")
+    conn = sqlite3.connect(name)
+    for sql in _SCHEMA[0]:
+        conn.execute(sql)
+    conn.executemany("INSERT INTO pfim(opdate, tag, description, amount) "
+        "VALUES (?, ?, ?, ?)", [
+            ("2024-01-02", "home/rent", "January rent", -800.0),
+            ("2024-01-05", "salary", "Pay", 2500.0),
+            ("2024-01-09", "food", "Market", -42.5),
+            ("2024-01-10", "food", "Bakery", -3.0)])
+    conn.execute("DELETE FROM pfim WHERE id = 4")
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+    return name
+
+
+def test_upgrade_replaces_the_tag_column(old_ledger):
+    PfimData(old_ledger).close()
+    conn = sqlite3.connect(old_ledger)
+    try:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(pfim)")]
+        rows = conn.execute("SELECT pfim.id, tags.tag FROM pfim "
+            "JOIN tags USING (tag_id) ORDER BY pfim.id").fetchall()
+        indexes = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE tbl_name = 'pfim' "
+            "AND type = 'index'")}
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+    assert "tag" not in columns and "tag_id" in columns
+    assert rows == [(1, "home/rent"), (2, "salary"), (3, "food")]
+    assert {"pfim_opdate", "pfim_kind_opdate", "pfim_tag_opdate"} <= indexes
+    assert version == len(_SCHEMA)
+
+
+def test_upgrade_keeps_ids_and_triggers(old_ledger):
+    core = PfimCore(old_ledger, cache_size=0)
+    try:
+        core.execute(vars(_cmd_parser().parse_args(["record", "--exp", "12",
+            "--date", "2024-02-01", "--tag", "food", "--descr", "Groceries"])))
+        core.report({"tagQuery": "food", "outFormat": "csv"})
+        amounts = [entry.amount for batch in core.make_output().report
+            for entry in batch]
+        conn = sqlite3.connect(old_ledger)
+        try:
+            ids = [row[0] for row in conn.execute("SELECT id FROM pfim")]
+        finally:
+            conn.close()
+        # the id of the deleted entry is not given again
+        assert ids == [1, 2, 3, 5]
+        assert sorted(amounts) == [-42.5, -12.0]
+        if _has_fts5():
+            assert core._db.has_search()
+            core.report({"searchQuery": "groceries", "outFormat": "csv"})
+            assert [entry.description for batch in core.make_output().report
+                for entry in batch] == ["Groceries"]
+    finally:
+        core._db.close()
@@ -0,0 +1,76 @@
+"""report --search gives the same entries with FTS5 and with LIKE."""
+
+import pytest
+
+from pfim.pfim import _INSERT_SQL, PfimCore, PfimData, _has_fts5
+
+pytestmark = pytest.mark.skipif(not _has_fts5(), reason="SQLite has no FTS5")
+
+# whole words that are no part of one another, on which FTS5 and LIKE
+# agree: LIKE also matches inside words
+WORDS = ("lunch", "bistro", "groceries", "market", "fuel", "station",
+    "rent", "flat", "salary", "bonus")
+TERMS = ("lunch", "LUNCH", "bistro lunch", "gro*", "mark*", "fu* station",
+    "salary", "nothing", "flat rent")
+
+
+def _descriptions():
+    for i in range(600):
+        words = [WORDS[(i * step) % len(WORDS)] for step in (1, 3, 7)][
+            :1 + i % 3]
+        yield " ".join(word.capitalize() if i % 2 else word
+            for word in words) + f" #{i}"
+
+
+@pytest.fixture
+def searched(dbname):
+    data = PfimData(dbname)
+    data.add_entries(_INSERT_SQL, [(f"2022-{1 + i % 12:02}-{1 + i % 28:02}",
+        "tag", descr, -1.0 - i) for i, descr in enumerate(_descriptions())])
+    data.close()
+    return dbname
+
+
+def _found(dbname, term, monkeypatch, fts):
+    with monkeypatch.context() as patch:
+        if not fts:
+            patch.setattr(PfimData, "has_search", lambda self: False)
+        core = PfimCore(dbname, cache_size=0)
+        try:
+            core.report({"searchQuery": term})
+            assert ("MATCH" in core._query.query) == fts
+            return sorted(entry.description
+                for batch in core.make_output().report for entry in batch)
+        finally:
+            core._db.close()
+
+
+def _check(dbname, monkeypatch):
+    for term in TERMS:
+        assert _found(dbname, term, monkeypatch, True) == _found(
+            dbname, term, monkeypatch, False), term
+
+
+def test_fts_and_like_agree(searched, monkeypatch):
+    assert _found(searched, "gro*", monkeypatch, True)
+    _check(searched, monkeypatch)
+
+
+def test_fts_and_like_agree_after_edits(searched, monkeypatch):
+    descriptions = list(_descriptions())
+    core = PfimCore(searched, cache_size=0)
+    try:
+        # descriptions changed, entries deleted and recorded one by one
+        # after the bulk insert was indexed
+        assert core.update({"upDescr": ["2022-03-03", descriptions[2],
+            "Market flat"]}) == 1
+        assert core.update({"upDescr": ["2022-05-05", descriptions[4],
+            "Fuel station"]}) == 1
+        assert core.delete({"rmDate": "2022-07-07"}) > 0
+        core.record({"expense": 1.0, "recdate": "2022-08-08", "rectag": "tag",
+            "descr": "Bistro lunch bonus"})
+    finally:
+        core._db.close()
+    assert _found(searched, "flat", monkeypatch, True).count(
+        "Market flat") == 1
+    _check(searched, monkeypatch)
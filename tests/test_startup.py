@@ -0,0 +1,44 @@
+"""The CLI entry point must start without the database layer."""
+
+import os
+import re
+import subprocess
+import sys
+
+from conftest import _ROOT
+
+# a budget for the imports of pfim.__main__, generous enough for a loaded
+# machine; the benchmark suite holds them to a tighter one
+BUDGET_MS = 100
+HEAVY = ("pfim.pfim", "sqlite3", "logging")
+
+
+def _run(*args):
+    env = dict(os.environ, PYTHONPATH=_ROOT, PFIM_NO_DAEMON="1")
+    return subprocess.run([sys.executable, *args], env=env, cwd=_ROOT,
+        capture_output=True, text=True, check=True)
+
+
+def test_main_does_not_import_database_layer():
+    proc = _run("-X", "importtime", "-c", "import sys, pfim.__main__; "
+        f"print(sorted(set(sys.modules) & set({HEAVY!r})))")
+    assert proc.stdout.strip() == "[]"
+    imported = re.findall(r"import time:.*\| +(\S+)$", proc.stderr, re.M)
+    assert "pfim.__main__" in imported
+    assert not set(imported) & set(HEAVY)
+
+
+def test_main_imports_within_budget():
+    proc = _run("-X", "importtime", "-c", "import pfim.__main__")
+    cumulative = {match.group(2): int(match.group(1)) for match in re.finditer(
+        r"import time:\s+\d+ \|\s+(\d+) \| +(\S+)$", proc.stderr, re.M)}
+    assert cumulative["pfim"] + cumulative["pfim.__main__"] <= (
+        BUDGET_MS * 1000)
+
+
+def test_version_does_not_open_ledger(tmp_path):
+    proc = subprocess.run([sys.executable, "-m", "pfim", "--version"],
+        env=dict(os.environ, PYTHONPATH=_ROOT, HOME=str(tmp_path),
+            PFIM_NO_DAEMON="1"), capture_output=True, text=True, check=True)
+    assert proc.stdout.strip()
+    assert not os.listdir(tmp_path)
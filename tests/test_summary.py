@@ -0,0 +1,75 @@
+"""Summaries computed by the database against the values themselves."""
+
+import io
+import statistics
+from datetime import timedelta
+
+import pytest
+
+from conftest import START, day, generate
+from pfim.pfim import _INSERT_SQL, PfimCore, PfimData
+
+# large amounts that vary little: their sums of squares cancel out
+LARGE = [(START + timedelta(i)).isoformat() for i in range(400)]
+
+
+def _summary(core, kw):
+    core.report(dict(kw, summaryOnly=True))
+    return core.make_output().summary
+
+
+def _check(summary, amounts, rel=1e-9):
+    assert summary.count == len(amounts)
+    assert summary.minimum == min(amounts)
+    assert summary.maximum == max(amounts)
+    assert summary.mean == pytest.approx(statistics.fmean(amounts), rel=1e-12)
+    assert summary.stdev == pytest.approx(statistics.stdev(amounts), rel=rel)
+
+
+@pytest.mark.parametrize("kw", [{}, {"afterQuery": day(0.2),
+    "beforeQuery": day(0.7)}, {"tagQuery": "food"}, {"expQuery": True}])
+def test_summary_matches_entries(core, kw):
+    amounts = [row[3] for row in generate()
+        if (not kw.get("afterQuery") or kw["afterQuery"] < row[0] <
+            kw["beforeQuery"])
+        and kw.get("tagQuery", row[1]) == row[1]
+        and (not kw.get("expQuery") or row[3] < 0)]
+    _check(_summary(core, kw), amounts)
+
+
+@pytest.mark.parametrize("kw", [{}, {"afterQuery": LARGE[100],
+    "beforeQuery": LARGE[300]}, {"groupBy": "month"}])
+def test_summary_of_large_amounts(dbname, kw):
+    rows = [(opdate, "salary", "Pay", 1e9 + (i % 7) * 0.01)
+        for i, opdate in enumerate(LARGE)]
+    data = PfimData(dbname)
+    data.add_entries(_INSERT_SQL, rows)
+    data.close()
+    core = PfimCore(dbname, cache_size=0)
+    summary = _summary(core, kw)
+    core._db.close()
+    groups = {}
+    for opdate, _, _, amount in rows:
+        if kw.get("afterQuery") and not (
+            kw["afterQuery"] < opdate < kw["beforeQuery"]):
+            continue
+        groups.setdefault(opdate[:7] if "groupBy" in kw else None,
+            []).append(amount)
+    if "groupBy" not in kw:
+        summary = {None: summary}
+    assert summary.keys() == groups.keys()
+    # the amounts are only known to about 1e-7, a cent being 1e-2
+    for grp, amounts in groups.items():
+        _check(summary[grp], amounts, rel=1e-5)
+
+
+@pytest.mark.parametrize("kw, median", [({"summaryOnly": True}, False),
+    ({"summaryOnly": True, "afterQuery": day(0.2)}, False),
+    ({"onQuery": day(0.5)}, True)])
+def test_median_only_when_computed(core, kw, median):
+    # summaries from SQL or the rollup have no quantiles to show
+    out = io.StringIO()
+    assert core.execute(dict(kw, cmd="report"), file=out) == 0
+    assert "Count:" in out.getvalue()
+    assert ("Median:" in out.getvalue()) == median
+    assert "None" not in out.getvalue()
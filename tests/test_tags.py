@@ -0,0 +1,47 @@
+"""Each thread keeps its own copy of the tag dictionary."""
+
+import threading
+
+from pfim.pfim import PfimData
+
+
+def _in_thread(func):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_threads_agree_on_tag_ids(dbname):
+    data = PfimData(dbname)
+    try:
+        ids = data.tag_ids(["home/rent", "food"])
+        other = _in_thread(lambda: data.tag_ids(["food", "salary"]))
+        assert other["food"] == ids["food"]
+        # created by the other thread's connection
+        assert data.tag_ids(["salary"], create=False) == {
+            None: None, "salary": other["salary"]}
+    finally:
+        data.close()
+
+
+def test_rolled_back_tags_stay_in_their_thread(dbname):
+    data = PfimData(dbname)
+    try:
+        ids = data.tag_ids(["food"])
+
+        def rolled_back():
+            conn = data._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            created = data.tag_ids(["travel"])
+            conn.rollback()
+            data.forget_tags()
+            return created, data.tag_ids(["travel"], create=False)
+        created, after = _in_thread(rolled_back)
+        assert created["travel"] is not None
+        assert after["travel"] is None
+        assert data.tag_ids(["food", "travel"], create=False) == {
+            None: None, "food": ids["food"], "travel": None}
+    finally:
+        data.close()
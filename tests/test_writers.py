@@ -0,0 +1,196 @@
+"""Concurrent writers: retries on a locked ledger and group commits."""
+
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import _ROOT
+from pfim.pfim import _INSERT_SQL, GroupCommitWriter, PfimCore, PfimData
+
+WRITERS = 4
+RECORDS = 50
+DAY = "2024-03-01"
+
+
+def _record_entries(dbname, sock, worker, ready, go):
+    # a writer process: once go is set, records RECORDS entries into
+    # dbname, through the server listening on sock if any
+    if sock is None:
+        core = PfimCore(dbname, cache_size=0)
+    else:
+        from pfim._server import forward
+    ready.release()
+    go.wait()
+    for i in range(RECORDS):
+        descr = f"Writer {worker} entry {i}"
+        if sock is None:
+            core.record({"expense": 1.0, "recdate": DAY, "rectag": "stress",
+                "descr": descr})
+        elif forward(["record", "--exp", "1", "--date", DAY, "--tag",
+            "stress", "--descr", descr], sock) != 0:
+            sys.exit(1)
+
+
+def _descriptions(dbname):
+    conn = sqlite3.connect(dbname)
+    try:
+        return sorted(row[0] for row in
+            conn.execute("SELECT description FROM pfim"))
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def server(tmp_path, dbname):
+    """The socket of a `pfim serve` on the ledger dbname."""
+    from pfim._server import forward_probe
+    sock = str(tmp_path / "pfim.sock")
+    proc = subprocess.Popen([sys.executable, "-c",
+        "import sys; from pfim._server import serve; "
+        "serve(sys.argv[1], sys.argv[2])", sock, dbname],
+        env=dict(os.environ, PYTHONPATH=_ROOT))
+    try:
+        deadline = time.monotonic() + 30
+        while not (os.path.exists(sock) and forward_probe(sock)):
+            assert proc.poll() is None, "pfim serve exited"
+            assert time.monotonic() < deadline, "pfim serve does not listen"
+            time.sleep(0.05)
+        yield sock
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.mark.parametrize("mode", ["direct", "server"])
+def test_no_entry_is_lost(request, dbname, mode):
+    sock = request.getfixturevalue("server") if mode == "server" else None
+    context = multiprocessing.get_context("spawn")
+    ready, go = context.Semaphore(0), context.Event()
+    procs = [context.Process(target=_record_entries,
+        args=(dbname, sock, worker, ready, go)) for worker in range(WRITERS)]
+    for proc in procs:
+        proc.start()
+    for _ in procs:
+        ready.acquire()
+    go.set()
+    for proc in procs:
+        proc.join()
+    assert [proc.exitcode for proc in procs] == [0] * WRITERS
+    assert _descriptions(dbname) == sorted(f"Writer {worker} entry {i}"
+        for worker in range(WRITERS) for i in range(RECORDS))
+
+
+def _insert(data, descr):
+    ids = data.tag_ids(["stress"])
+    return _INSERT_SQL, (DAY, ids["stress"], descr, -1.0)
+
+
+def test_group_commit_writer(dbname):
+    data = PfimData(dbname)
+    inserts = [_insert(data, f"Entry {i}") for i in range(100)]
+    writer = GroupCommitWriter(data)
+    # the writer waits for the lock while the statements queue up
+    blocker = sqlite3.connect(dbname)
+    blocker.execute("BEGIN IMMEDIATE")
+    try:
+        futures = [writer.submit(*insert) for insert in inserts]
+        blocker.rollback()
+        assert [future.result(timeout=10) for future in futures] == [1] * 100
+    finally:
+        blocker.close()
+        writer.close()
+        data.close()
+    assert writer.statements == 100
+    assert writer.commits < 10
+    assert len(_descriptions(dbname)) == 100
+
+
+def test_failed_statement_leaves_its_group(dbname):
+    data = PfimData(dbname)
+    inserts = [_insert(data, f"Entry {i}") for i in range(10)]
+    writer = GroupCommitWriter(data)
+    try:
+        futures = [writer.submit(*insert) for insert in inserts[:5]]
+        bad = writer.submit("INSERT INTO nowhere VALUES (1)")
+        futures += [writer.submit(*insert) for insert in inserts[5:]]
+        assert [future.result(timeout=10) for future in futures] == [1] * 10
+        with pytest.raises(sqlite3.OperationalError, match="no such table"):
+            bad.result(timeout=10)
+    finally:
+        writer.close()
+        data.close()
+    assert len(_descriptions(dbname)) == 10
+
+
+def _blocked(dbname):
+    # a PfimData that waits 10ms for a lock, the insert of an entry, and
+    # a connection holding the write lock of dbname
+    data = PfimData(dbname)
+    data._connect().execute("PRAGMA busy_timeout = 10")
+    insert = _insert(data, "Retried")
+    blocker = sqlite3.connect(dbname)
+    blocker.execute("BEGIN IMMEDIATE")
+    return data, insert, blocker
+
+
+def test_retrying_waits_for_the_lock(dbname):
+    data, insert, blocker = _blocked(dbname)
+    conn = data._connect()
+    attempts = []
+
+    def write():
+        attempts.append(len(attempts) + 1)
+        if len(attempts) == 2:
+            # the other writer is done
+            blocker.rollback()
+        with conn:
+            conn.execute(*insert)
+        return len(attempts)
+    try:
+        assert data._retrying(conn, write) == 2
+        assert not conn.in_transaction
+        assert _descriptions(dbname) == ["Retried"]
+    finally:
+        blocker.close()
+        data.close()
+
+
+def test_retrying_gives_up(dbname):
+    data, insert, blocker = _blocked(dbname)
+    data.retries = 2
+    conn = data._connect()
+    attempts = []
+
+    def write():
+        attempts.append(1)
+        with conn:
+            conn.execute(*insert)
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            data._retrying(conn, write)
+        assert len(attempts) == 3
+        assert not conn.in_transaction
+    finally:
+        blocker.close()
+        data.close()
+
+
+def test_retrying_does_not_retry_other_errors(dbname):
+    data = PfimData(dbname)
+    conn = data._connect()
+    attempts = []
+
+    def write():
+        attempts.append(1)
+        conn.execute("INSERT INTO nowhere VALUES (1)")
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="no such table"):
+            data._retrying(conn, write)
+        assert len(attempts) == 1
+    finally:
+        data.close()